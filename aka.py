@@ -46,18 +46,929 @@ import datetime
 import time
 import re
 import sqlite3
-import requests
+import itertools
+import operator
+import collections
+import io
+import array
+import fnmatch
+import bisect
+import csv
+import ipaddress
+import socket
+import functools
+import queue
+import threading
+import urllib.parse
+import urllib.request
+import json
 
 DEFAULT_CONFIG = {
-    "ENABLE_PURGE":     False,  # Enable the PURGE command.
+    "BUFFER_WRITES":    False,  # Queue events in memory and write them to the database in batches.
+    "BACKUP_PAGES":     1000,   # Number of database pages the backup command copies per step.
+    "CHECKPOINT_INTERVAL": 300, # Number of seconds between WAL checkpoints.
+    "DURABILITY":       "BALANCED", # SAFE, BALANCED, or FAST. See DURABILITY_PROFILES.
+    "ENABLE_PURGE":     False,  # Enable the PURGE command and the retention policies.
+    "FLUSH_INTERVAL":   2,      # Number of seconds between writes of the event buffer when BUFFER_WRITES is enabled.
+    "FLUSH_MAX_BATCH":  500,    # Write the event buffer early once it holds this many rows.
+    "GEO_CACHE_SIZE":   1000,   # Number of geo answers kept in memory in front of the geo_cache table.
+    "GEO_FILE":         "geoip.csv", # IP range file used by the FILE geo provider. Relative paths are in the module's data directory.
+    "GEO_NEGATIVE_TTL": 3600,   # Number of seconds a failed geo answer (private or reserved address) is cached.
+    "GEO_PROVIDER":     "HTTP", # HTTP asks GEO_URL, FILE looks the address up in GEO_FILE without any network access.
+    "GEO_TTL":          604800, # Number of seconds a geo answer is cached.
+    "GEO_URL":          "http://ip-api.com/json/{}?fields=country,regionName,city,lat,lon,timezone,mobile,proxy,query,reverse,status,message", # Geo provider, {} is replaced with the IP or host.
+    "HISTORY_DEPTH":    2,      # Number of levels `history --deep` follows shared nicks, idents, and hosts.
+    "HISTORY_MAX_NODES": 5000,  # Stop `history` expanding once this many nicks, idents, and hosts have been found.
+    "ID_CACHE_SIZE":    50000,  # Number of network/nick/ident/host/channel ids of each kind a database writer keeps in memory.
+    "JOURNAL":          False,  # Append events to the journal and fold them into the "users" counters every JOURNAL_ROLLUP_INTERVAL.
+    "JOURNAL_RETENTION": 7,     # Number of days journal events are kept for the timeline command after they have been rolled up.
+    "JOURNAL_ROLLUP_INTERVAL": 60, # Number of seconds between journal rollups.
+    "PAGE_EXPIRY":      300,    # Number of seconds an unfinished result is kept for the more command.
+    "PAGE_SIZE":        50,     # Number of lines a command prints before waiting for more.
+    "PERF":             False,  # Time every hook and SQL statement for the perf command.
+    "PROCESS_CHUNK":    5000,   # Number of rows the process command writes per second.
+    "PURGE_BATCH":      2000,   # Number of rows a purge deletes per second, each batch in its own transaction.
+    "RAWQUERY_ROWS":    1000,   # Maximum number of rows rawquery prints.
+    "RAWQUERY_TIMEOUT": 5,      # Number of seconds rawquery may run before it is interrupted.
     "RECORD_KICK":      True,   # Record kicking in the "users" table.
     "RECORD_MODERATED": False,  # Record kicking, banning, and quieting in the "moderated" table.
     "RECORD_WHOIS":     True,   # Record /whois output.
     "RECORD_WHOWAS":    True,   # Record /whowas output.
-    "VACUUM_ON_LOAD":   False,  # Perform SQLite VACUUM command when module is loaded. This setting will reset itself to FALSE when finished.
-    "WHO_ON_JOIN":      True    # Send a /who #channel when you join a channel on your client.
+    "RETENTION_INTERVAL": 3600, # Number of seconds between runs of the retention policies.
+    "SEARCH_BATCH":     5000,   # Number of rows added to the search index per second while it is rebuilt.
+    "SEARCH_INDEX":     False,  # Keep a full text index of gecos, account, and last message for the search command.
+    "SLOW_QUERY_MS":    100,    # With PERF enabled, statements taking at least this many milliseconds go to the slow query log.
+    "STATS_RECONCILE_INTERVAL": 86400, # Number of seconds between exact recounts of the stats counters, in the background.
+    "STORM_THRESHOLD":  20,     # Number of QUITs within a second that counts as a netsplit. Quits are then written in one transaction when it is over.
+    "VACUUM_ON_LOAD":   False,  # Run the compact command when the module is loaded. This setting will reset itself to FALSE when finished.
+    "VACUUM_PAGES":     1000,   # Number of free pages returned to the file system per second after a purge.
+    "WHO_INTERVAL":     2,      # Minimum number of seconds between WHO requests on a network. The next one also waits for the previous reply to finish.
+    "WHO_ON_JOIN":      True,   # Send a /who #channel when you join a channel on your client.
+    "WRITER_QUEUE_SIZE": 10000, # Maximum number of events waiting for the writer thread. Events are dropped when it is full.
+    "WRITER_THREAD":    False   # Write events to the database from a background thread with its own connection.
 }
 
+# Stored in PRAGMA user_version. Bump this and add a db_upgrade_<N> method for each schema change.
+SCHEMA_VERSION = 8
+
+# PRAGMA settings applied to every database connection for each DURABILITY setting.
+# SAFE syncs every commit to disk. BALANCED only syncs at checkpoints, a power loss can lose the last few commits but never corrupts the database.
+# FAST never syncs and leaves it up to the operating system.
+DURABILITY_PROFILES = {
+    "SAFE":     {"journal_mode": "WAL", "synchronous": "FULL",   "cache_size": -8000,  "mmap_size": 0,         "temp_store": "DEFAULT"},
+    "BALANCED": {"journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -32000, "mmap_size": 67108864,  "temp_store": "MEMORY"},
+    "FAST":     {"journal_mode": "WAL", "synchronous": "OFF",    "cache_size": -65536, "mmap_size": 268435456, "temp_store": "MEMORY"}
+}
+
+# The module timer checkpoints every CHECKPOINT_INTERVAL seconds. The automatic checkpoint only runs when a burst grows the WAL
+# past WAL_AUTOCHECKPOINT pages before that, and the WAL file is truncated back to JOURNAL_SIZE_LIMIT bytes when it is reset.
+WAL_AUTOCHECKPOINT = 4000
+JOURNAL_SIZE_LIMIT = 16777216
+
+# Valid values for the settings that are neither True/False nor a number.
+CONFIG_CHOICES = {
+    "DURABILITY": sorted(DURABILITY_PROFILES),
+    "GEO_PROVIDER": ["FILE", "HTTP"]
+}
+
+# Free text settings. These are stored as entered instead of in upper case.
+CONFIG_TEXT = ("GEO_FILE", "GEO_URL")
+
+# Batch, page, and queue sizes. 0 would stop a batch job or `more` from ever finishing or make a bounded queue unbounded.
+CONFIG_POSITIVE = ("BACKUP_PAGES", "FLUSH_MAX_BATCH", "PAGE_SIZE", "PROCESS_CHUNK", "PURGE_BATCH", "SEARCH_BATCH", "VACUUM_PAGES", "WRITER_QUEUE_SIZE")
+
+# Opens a connection to the database with the pragmas of a durability profile.
+# Read-only connections never take write locks, in WAL mode they do not wait on writers either.
+def db_connect(path, durability, readonly=False):
+    if readonly:
+        conn = sqlite3.connect("file:{}?mode=ro".format(urllib.request.pathname2url(path)), uri=True, timeout=30)
+    else:
+        conn = sqlite3.connect(path, timeout=30)
+    db_apply_profile(conn, durability, readonly)
+    return conn
+
+def db_apply_profile(conn, durability, readonly=False):
+    profile = DURABILITY_PROFILES.get(durability, DURABILITY_PROFILES["BALANCED"])
+    if not readonly:
+        conn.execute("PRAGMA journal_mode={};".format(profile["journal_mode"]))
+        conn.execute("PRAGMA wal_autocheckpoint={};".format(WAL_AUTOCHECKPOINT))
+        conn.execute("PRAGMA journal_size_limit={};".format(JOURNAL_SIZE_LIMIT))
+    conn.execute("PRAGMA synchronous={};".format(profile["synchronous"]))
+    conn.execute("PRAGMA cache_size={};".format(profile["cache_size"]))
+    conn.execute("PRAGMA mmap_size={};".format(profile["mmap_size"]))
+    conn.execute("PRAGMA temp_store={};".format(profile["temp_store"]))
+
+# The network, nick, ident, host, and channel strings are stored once in their own table and referenced by id.
+ID_TABLES = {
+    "network": "network_ids",
+    "nick":    "nick_ids",
+    "ident":   "ident_ids",
+    "host":    "host_ids",
+    "channel": "channel_ids"
+}
+
+# Which id table each of the leading parameters of a user_records / moderated_records write is resolved against.
+USER_DIMS      = ("network", "nick", "ident", "host", "channel")
+MODERATED_DIMS = ("network", "nick", "ident", "host", "channel", "nick", "ident", "host")
+
+# Event types are stored as integers in journal_records. The names live in the journal_events table.
+JOURNAL_EVENTS = {
+    "join":    1,
+    "part":    2,
+    "quit":    3,
+    "kicked":  4,
+    "privmsg": 5,
+    "notice":  6,
+    "nick":    7,
+    "nicked":  8
+}
+
+# Folds journal events with ids in (start, end] into the user_records counters.
+# New rows are created first with the same starting values the direct writes use, the counters and latest event are then added on top.
+JOURNAL_ROLLUP_INSERT = "INSERT OR IGNORE INTO user_records (network_id, nick_id, ident_id, host_id, channel_id, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits) \
+    SELECT network_id, nick_id, ident_id, host_id, channel_id, '', '', time, time, 0, event NOT IN ({join}, {nick}, {nicked}), 0, 0, 0 \
+    FROM (SELECT network_id, nick_id, ident_id, host_id, channel_id, MIN(id), time, event FROM journal_records WHERE id > ? AND id <= ? GROUP BY network_id, nick_id, ident_id, host_id, channel_id);".format(**JOURNAL_EVENTS)
+JOURNAL_ROLLUP_UPDATE = "UPDATE user_records SET texts = user_records.texts + g.texts, joins = user_records.joins + g.joins, kicks = user_records.kicks + g.kicks, \
+    parts = user_records.parts + g.parts, quits = user_records.quits + g.quits, \
+    event = CASE WHEN g.time >= user_records.lastseen THEN g.event ELSE user_records.event END, \
+    message = CASE WHEN g.time >= user_records.lastseen THEN g.message ELSE user_records.message END, \
+    lastseen = MAX(user_records.lastseen, g.time), account = IFNULL(g.account, user_records.account), gecos = IFNULL(g.gecos, user_records.gecos) \
+    FROM (SELECT s.*, j.time AS time, e.name AS event, IFNULL(j.message, '') AS message, \
+        (SELECT account FROM journal_records WHERE id = s.account_id) AS account, (SELECT gecos FROM journal_records WHERE id = s.gecos_id) AS gecos \
+        FROM (SELECT network_id, nick_id, ident_id, host_id, channel_id, MAX(id) AS last_id, SUM(event IN ({privmsg}, {notice})) AS texts, SUM(event = {join}) AS joins, \
+            SUM(event = {kicked}) AS kicks, SUM(event = {part}) AS parts, SUM(event = {quit}) AS quits, \
+            MAX(CASE WHEN account IS NOT NULL THEN id END) AS account_id, MAX(CASE WHEN gecos IS NOT NULL THEN id END) AS gecos_id \
+            FROM journal_records WHERE id > ? AND id <= ? GROUP BY network_id, nick_id, ident_id, host_id, channel_id) s \
+        JOIN journal_records j ON j.id = s.last_id JOIN journal_events e ON e.id = j.event) g \
+    WHERE user_records.network_id = g.network_id AND user_records.nick_id = g.nick_id AND user_records.ident_id = g.ident_id \
+    AND user_records.host_id = g.host_id AND user_records.channel_id = g.channel_id;".format(**JOURNAL_EVENTS)
+
+# Queued like any other write so it runs in the same transaction and on the same connection as the events before it.
+# aka_meta keeps the id of the last event that was rolled up. Events older than `cutoff` are pruned once they have been rolled up.
+def journal_rollup(cur, cutoff):
+    row = cur.execute("SELECT value FROM aka_meta WHERE key = 'journal_rollup_id';").fetchone()
+    start = row[0] if row else 0
+    end = cur.execute("SELECT IFNULL(MAX(id), 0) FROM journal_records;").fetchone()[0]
+    if end > start:
+        cur.execute(JOURNAL_ROLLUP_INSERT, (start, end))
+        cur.execute(JOURNAL_ROLLUP_UPDATE, (start, end))
+        cur.execute("INSERT OR REPLACE INTO aka_meta (key, value) VALUES ('journal_rollup_id', ?);", (end,))
+    cur.execute("DELETE FROM journal_records WHERE id <= ? AND time < ?;", (end, cutoff))
+
+# Every IRC event is turned into an AkaEvent once and normalized there. The kind picks the statement in EVENT_STATEMENTS.
+class AkaEvent(object):
+    __slots__ = ("kind", "network", "nick", "ident", "host", "channel", "event", "message", "account", "gecos", "time")
+
+    def __init__(self, kind, network, nick, ident, host, channel, event=None, message=None, account=None, gecos=None):
+        self.kind = kind
+        self.network = network.lower()
+        self.nick = nick.lower()
+        self.ident = ident.lower()
+        self.host = host.lower()
+        self.channel = channel.lower()
+        self.event = event
+        self.message = message
+        self.account = account.lower() if account is not None else None
+        self.gecos = gecos.lower() if gecos is not None else None
+        self.time = int(time.time())
+
+USER_RECORDS_INSERT = "INSERT INTO user_records (network_id, nick_id, ident_id, host_id, channel_id, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account, gecos) VALUES "
+USER_RECORDS_CONFLICT = " ON CONFLICT(network_id, nick_id, ident_id, host_id, channel_id) DO UPDATE SET "
+
+# One UPSERT per kind of event: the INSERT, one row of VALUES, the ON CONFLICT clause, and the AkaEvent fields the row is bound to.
+# The network, nick, ident, host, and channel come first and are resolved to ids. A NULL account or gecos leaves the stored one alone.
+# The row is kept separate so an event seen in many channels (QUIT, NICK) can be written with a single multi-row statement.
+EVENT_STATEMENTS = {
+    "join":    (USER_RECORDS_INSERT, "(?, ?, ?, ?, ?, ?, '', ?, ?, 0, 1, 0, 0, 0, ?, ?)", USER_RECORDS_CONFLICT +
+                "event = EXCLUDED.event, message = '', lastseen = EXCLUDED.lastseen, joins = joins + 1, account = IFNULL(EXCLUDED.account, account), gecos = IFNULL(EXCLUDED.gecos, gecos);",
+                ("event", "time", "time", "account", "gecos")),
+    "kick":    (USER_RECORDS_INSERT, "(?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 1, 1, 0, 0, NULL, NULL)", USER_RECORDS_CONFLICT +
+                "event = EXCLUDED.event, message = EXCLUDED.message, lastseen = EXCLUDED.lastseen, kicks = kicks + 1;",
+                ("event", "message", "time", "time")),
+    "part":    (USER_RECORDS_INSERT, "(?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 1, 0, 1, 0, ?, NULL)", USER_RECORDS_CONFLICT +
+                "event = EXCLUDED.event, message = EXCLUDED.message, lastseen = EXCLUDED.lastseen, parts = parts + 1, account = IFNULL(EXCLUDED.account, account);",
+                ("event", "message", "time", "time", "account")),
+    "quit":    (USER_RECORDS_INSERT, "(?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 1, 0, 0, 1, ?, NULL)", USER_RECORDS_CONFLICT +
+                "event = EXCLUDED.event, message = EXCLUDED.message, lastseen = EXCLUDED.lastseen, quits = quits + 1, account = IFNULL(EXCLUDED.account, account);",
+                ("event", "message", "time", "time", "account")),
+    "nick":    (USER_RECORDS_INSERT, "(?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 0, 0, 0, 0, ?, NULL)", USER_RECORDS_CONFLICT +
+                "event = EXCLUDED.event, message = EXCLUDED.message, lastseen = EXCLUDED.lastseen, account = IFNULL(EXCLUDED.account, account);",
+                ("event", "message", "time", "time", "account")),
+    # A query gets a '1' in the joins column. Don't bother with a second statement for query windows.
+    "message": (USER_RECORDS_INSERT, "(?, ?, ?, ?, ?, ?, ?, ?, ?, 1, 1, 0, 0, 0, NULL, NULL)", USER_RECORDS_CONFLICT +
+                "event = EXCLUDED.event, message = EXCLUDED.message, lastseen = EXCLUDED.lastseen, texts = texts + 1;",
+                ("event", "message", "time", "time")),
+    "who":     (USER_RECORDS_INSERT, "(?, ?, ?, ?, ?, '/who', '', ?, ?, 0, 1, 0, 0, 0, ?, ?)", USER_RECORDS_CONFLICT +
+                "lastseen = EXCLUDED.lastseen, account = IFNULL(EXCLUDED.account, account), gecos = IFNULL(EXCLUDED.gecos, gecos);",
+                ("time", "time", "account", "gecos")),
+    "whois":   (USER_RECORDS_INSERT, "(?, ?, ?, ?, ?, '', '', ?, ?, 0, 0, 0, 0, 0, ?, ?)", USER_RECORDS_CONFLICT +
+                "lastseen = EXCLUDED.lastseen, account = EXCLUDED.account, gecos = EXCLUDED.gecos;",
+                ("time", "time", "account", "gecos")),
+    "whowas":  (USER_RECORDS_INSERT, "(?, ?, ?, ?, ?, '', '', ?, ?, 0, 0, 0, 0, 0, ?, ?)", USER_RECORDS_CONFLICT +
+                "account = EXCLUDED.account, gecos = EXCLUDED.gecos;",
+                ("time", "time", "account", "gecos")),
+    "process": (USER_RECORDS_INSERT, "(?, ?, ?, ?, ?, NULL, NULL, ?, ?, NULL, NULL, NULL, NULL, NULL, NULL, NULL)", USER_RECORDS_CONFLICT +
+                "lastseen = EXCLUDED.lastseen;",
+                ("time", "time")),
+    # With JOURNAL enabled the events in JOURNAL_EVENTS are appended here instead.
+    "journal": ("INSERT INTO journal_records (network_id, nick_id, ident_id, host_id, channel_id, time, event, message, account, gecos) VALUES ", "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", ";",
+                lambda event: (event.network, event.nick, event.ident, event.host, event.channel, event.time, JOURNAL_EVENTS[event.event], event.message or None, event.account, event.gecos))
+}
+EVENT_FIELDS = {kind: fields if callable(fields) else operator.attrgetter(*(USER_DIMS + fields)) for kind, (insert, row, conflict, fields) in EVENT_STATEMENTS.items()}
+
+# Rows per multi-row statement. Older SQLite builds only allow 999 parameters per statement.
+EVENT_ROWS = {kind: 999 // row.count('?') for kind, (insert, row, conflict, fields) in EVENT_STATEMENTS.items()}
+
+# The statement text for writing `rows` events of a kind at once. Cached so sqlite3 reuses the prepared statement.
+@functools.lru_cache(maxsize=None)
+def event_statement(kind, rows=1):
+    insert, row, conflict, fields = EVENT_STATEMENTS[kind]
+    return insert + ", ".join([row] * rows) + conflict
+
+# QUIT reasons of a netsplit are the names of the two servers that lost each other. Servers prefix real quit messages with "Quit: ".
+NETSPLIT_REASON = re.compile(r"^[\w.-]+\.[\w-]+ [\w.-]+\.[\w-]+$")
+
+# Resolves strings to their ids for one connection, adding new ones as needed.
+# The most recently used ids of each kind are kept in an LRU so the hot path rarely touches the id tables.
+class AkaIds(object):
+
+    def __init__(self, cur, size):
+        self.cur = cur
+        self.size = size
+        self.caches = {kind: collections.OrderedDict() for kind in ID_TABLES}
+        self.hits = 0
+        self.misses = 0
+
+    # Replaces the first len(kinds) parameters of a write with their ids. Cache hits are handled inline, this runs for every event.
+    def resolve(self, kinds, params):
+        values = []
+        for kind, value in zip(kinds, params):
+            cache = self.caches[kind]
+            id = cache.get(value)
+            if id is None:
+                id = self.get(kind, value)
+            else:
+                cache.move_to_end(value)
+                self.hits += 1
+            values.append(id)
+        values.extend(params[len(kinds):])
+        return values
+
+    def get(self, kind, value):
+        if value is None:
+            return None
+        cache = self.caches[kind]
+        if value in cache:
+            cache.move_to_end(value)
+            self.hits += 1
+            return cache[value]
+        self.misses += 1
+        row = self.cur.execute("SELECT id FROM {} WHERE value = ?;".format(ID_TABLES[kind]), (value,)).fetchone()
+        if row:
+            id = row[0]
+        elif kind == "host":
+            self.cur.execute("INSERT INTO host_ids (value, rvalue) VALUES (?, ?);", (value, value[::-1]))
+            id = self.cur.lastrowid
+        else:
+            self.cur.execute("INSERT INTO {} (value) VALUES (?);".format(ID_TABLES[kind]), (value,))
+            id = self.cur.lastrowid
+        cache[value] = id
+        if len(cache) > self.size:
+            cache.popitem(last=False)
+        return id
+
+    # Ids added in a transaction that was rolled back no longer exist.
+    def clear(self):
+        for cache in self.caches.values():
+            cache.clear()
+
+# Number of rows a write adds. A multi-row statement carries a list with one tuple per row.
+def write_rows(sql, params):
+    return len(params) if isinstance(params, list) and not callable(sql) else 1
+
+# Holds pending writes and applies them to the database in a single transaction.
+# Consecutive writes using the same statement are sent with one executemany() call.
+# The first len(kinds) parameters of a write are strings that get replaced by their ids.
+# A write can also be a function, it is called with the cursor and its parameters inside the transaction.
+# When the transaction fails because of one write, the writes are retried one at a time and only the bad ones are dropped.
+class AkaWriter(object):
+
+    def __init__(self, conn, cache_size):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.ids = AkaIds(self.cur, cache_size)
+        self.pending = []
+        self.rows = 0
+        self.commits = 0
+        self.failed = 0
+        self.error = None
+        self.last_flush = time.time()
+        self.perf = None
+        self.context = None
+
+    # Timed cursors while PERF is enabled, plain ones otherwise.
+    def instrument(self, perf, context=None):
+        self.perf = perf
+        self.context = context
+        self.cur = self.ids.cur = perf_cursor(self.conn, perf, context)
+
+    def add(self, sql, params, kinds=()):
+        self.pending.append((sql, params, kinds))
+        self.rows += write_rows(sql, params)
+
+    # Returns the number of writes applied. A locked or unwritable database (OperationalError) fails every write the same way,
+    # so the batch is dropped and the error raised instead of retrying.
+    def flush(self):
+        pending = self.pending
+        self.pending = []
+        self.rows = 0
+        self.last_flush = time.time()
+        if not pending:
+            return 0
+        try:
+            self.apply(pending)
+            return len(pending)
+        except sqlite3.OperationalError as e:
+            self.failed += len(pending)
+            self.error = e
+            raise
+        except sqlite3.Error as e:
+            if len(pending) == 1:
+                self.failed += 1
+                self.error = e
+                return 0
+        applied = 0
+        for write in pending:
+            try:
+                self.apply([write])
+                applied += 1
+            except sqlite3.Error as e:
+                self.failed += 1
+                self.error = e
+        return applied
+
+    def apply(self, pending):
+        try:
+            for sql, group in itertools.groupby(pending, key=operator.itemgetter(0)):
+                if callable(sql):
+                    for function, params, kinds in group:
+                        function(self.cur, *params)
+                else:
+                    self.cur.executemany(sql, [self.resolve(params, kinds) for sql, params, kinds in group])
+            start = time.perf_counter()
+            self.conn.commit()
+            if self.perf:
+                self.perf.statement("COMMIT", time.perf_counter() - start, self.context)
+        except sqlite3.Error:
+            self.conn.rollback()
+            self.ids.clear()
+            raise
+        self.commits += 1
+
+    # The parameters of a multi-row statement are a list with one tuple per row, kinds applies to each row.
+    def resolve(self, params, kinds):
+        if not kinds:
+            return params
+        if isinstance(params, list):
+            return [value for row in params for value in self.ids.resolve(kinds, row)]
+        return self.ids.resolve(kinds, params)
+
+# Seconds the ZNC thread waits at most for the writer thread when a hook needs a row that may still be queued.
+WRITER_WAIT = 1
+
+# Owns a separate sqlite3 connection and applies queued writes so disk I/O never runs on the ZNC thread.
+# Events are immutable (sql, params, kinds, queued_at) tuples. When the queue is full new events are dropped and counted.
+# `lock` is held while a batch is written. The module holds it around the few writes it still makes on its own connection,
+# so they wait for one batch instead of racing the thread for the database write lock.
+class AkaWriterThread(threading.Thread):
+
+    def __init__(self, path, durability, size, batch, cache_size, lock):
+        threading.Thread.__init__(self, name="aka-writer")
+        self.daemon = True
+        self.lock = lock
+        self.path = path
+        self.durability = durability
+        self.batch = batch
+        self.cache_size = cache_size
+        self.queue = queue.Queue(maxsize=size)
+        self.perf = None
+        self.queued = 0
+        self.applied = 0
+        self.dropped = 0
+        self.errors = 0
+        self.commits = 0
+        self.lag = 0.0
+
+    def put(self, sql, params, kinds=()):
+        try:
+            self.queue.put_nowait((sql, params, kinds, time.time()))
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        # Blocks until everything already queued has been written.
+        self.queue.put(None)
+        self.join()
+
+    # Blocks until everything queued so far has been written, for at most `timeout` seconds.
+    def wait(self, timeout):
+        queued = self.queued
+        deadline = time.time() + timeout
+        while self.applied + self.errors < queued and self.is_alive() and time.time() < deadline:
+            time.sleep(0.005)
+
+    def run(self):
+        conn = db_connect(self.path, self.durability)
+        writer = AkaWriter(conn, self.cache_size)
+        running = True
+        while running:
+            items = [self.queue.get()]
+            rows = write_rows(*items[0][:2]) if items[0] else 0
+            while rows < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+                if items[-1]:
+                    rows += write_rows(*items[-1][:2])
+            if None in items:
+                running = False
+                items = [item for item in items if item is not None]
+            if not items:
+                continue
+            for sql, params, kinds, queued in items:
+                writer.add(sql, params, kinds)
+            if writer.perf is not self.perf:
+                writer.instrument(self.perf, "writer thread")
+            try:
+                with self.lock:
+                    applied = writer.flush()
+            except sqlite3.Error:
+                applied = 0
+            self.applied += applied
+            self.errors += len(items) - applied
+            self.commits = writer.commits
+            self.lag = time.time() - items[0][3]
+        conn.close()
+
+# Upper bounds in seconds of the PERF latency buckets. The last bucket holds everything slower.
+PERF_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0)
+PERF_LABELS = ("<0.1ms", "<1ms", "<10ms", "<100ms", "<1s", ">=1s")
+
+# Number of statements kept in the slow query log, and of hooks and statements `perf` lists.
+PERF_SLOW_LOG = 100
+PERF_TOP = 10
+
+# Statements are counted by their shape. String literals become ?, repeated VALUES rows and runs of ? are collapsed.
+@functools.lru_cache(maxsize=4096)
+def perf_statement(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", "?", ' '.join(sql.split()))
+    sql = re.sub(r"(\([^()]*\))(?:, \1)+", r"\1, ...", sql)
+    return re.sub(r"\?(?:, \?)+", "?, ...", sql)
+
+# Counts, total and maximum time, and a latency histogram for every hook and statement shape, plus the slow query log.
+# Statements are also timed on the writer thread, so updates take the lock.
+class AkaPerf(object):
+
+    def __init__(self, threshold):
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.context = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.hooks = {}
+            self.statements = {}
+            self.slow = collections.deque(maxlen=PERF_SLOW_LOG)
+            self.started = time.time()
+
+    # A stat is [count, total, max, bucket counts...].
+    def add(self, table, key, seconds):
+        stat = table.get(key)
+        if stat is None:
+            stat = table[key] = [0, 0.0, 0.0] + [0] * len(PERF_LABELS)
+        stat[0] += 1
+        stat[1] += seconds
+        stat[2] = max(stat[2], seconds)
+        stat[3 + bisect.bisect_right(PERF_BUCKETS, seconds)] += 1
+
+    def hook(self, name, seconds):
+        with self.lock:
+            self.add(self.hooks, name, seconds)
+
+    def statement(self, sql, seconds, context):
+        with self.lock:
+            self.add(self.statements, perf_statement(sql), seconds)
+            if seconds >= self.threshold:
+                self.slow.append((time.time(), seconds, context or self.context or "unknown", ' '.join(sql.split())))
+
+# Times execute() and executemany(). For a SELECT that is the time to the first row, which is where SQLite does the
+# sorting and grouping, reading the rest is left out.
+class AkaPerfCursor(sqlite3.Cursor):
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return sqlite3.Cursor.execute(self, sql, params)
+        finally:
+            self.perf.statement(sql, time.perf_counter() - start, self.context)
+
+    def executemany(self, sql, params):
+        start = time.perf_counter()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, params)
+        finally:
+            self.perf.statement(sql, time.perf_counter() - start, self.context)
+
+def perf_cursor(conn, perf, context=None):
+    if not perf:
+        return conn.cursor()
+    cursor = conn.cursor(AkaPerfCursor)
+    cursor.perf = perf
+    cursor.context = context
+    return cursor
+
+# The rest of a long result, `more` prints the next page. Lines come from a generator that usually reads straight from an
+# open cursor, so only one page is ever in memory. With a connection and a timeout, each page gets its own time budget.
+class AkaPager(object):
+
+    def __init__(self, lines, conn=None, timeout=0):
+        self.lines = lines
+        self.conn = conn
+        self.timeout = timeout
+        self.ahead = None
+        self.used = time.time()
+
+    # Returns the next page and whether there is more after it.
+    def next_page(self, size):
+        self.used = time.time()
+        if self.timeout:
+            deadline = time.time() + self.timeout
+            self.conn.set_progress_handler(lambda: time.time() > deadline, RAWQUERY_STEPS)
+        try:
+            page = [self.ahead] if self.ahead is not None else []
+            page.extend(itertools.islice(self.lines, size + 1 - len(page)))
+        finally:
+            if self.timeout:
+                self.conn.set_progress_handler(None, RAWQUERY_STEPS)
+        self.ahead = page.pop() if len(page) > size else None
+        return page, self.ahead is not None
+
+    def close(self):
+        if hasattr(self.lines, 'close'):
+            self.lines.close()
+        if self.conn:
+            self.conn.close()
+
+# Number of SQLite virtual machine steps between rawquery time checks.
+RAWQUERY_STEPS = 10000
+
+# Exact per network counts, the same columns as network_stats.
+STATS_EXACT = "SELECT network_id, COUNT(*), COUNT(DISTINCT nick_id), COUNT(DISTINCT ident_id), COUNT(DISTINCT host_id), COUNT(DISTINCT channel_id) FROM user_records GROUP BY network_id"
+
+# Adds the differences found by AkaStatsThread. Runs inside a writer transaction.
+def stats_adjust(cur, deltas):
+    cur.executemany("INSERT INTO network_stats (network_id, records, nicks, idents, hosts, channels) VALUES (?, ?, ?, ?, ?, ?) \
+        ON CONFLICT(network_id) DO UPDATE SET records = records + EXCLUDED.records, nicks = nicks + EXCLUDED.nicks, idents = idents + EXCLUDED.idents, \
+        hosts = hosts + EXCLUDED.hosts, channels = channels + EXCLUDED.channels;", deltas)
+
+# Recounts the network_stats counters exactly on its own connection. The counts and the counters are read in one transaction,
+# so the differences stay correct while the triggers keep counting new rows.
+class AkaStatsThread(threading.Thread):
+
+    def __init__(self, path, durability):
+        threading.Thread.__init__(self, name="aka-stats")
+        self.daemon = True
+        self.path = path
+        self.durability = durability
+        self.deltas = []
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+
+    def run(self):
+        try:
+            conn = db_connect(self.path, self.durability, True)
+            try:
+                conn.execute("BEGIN;")
+                exact = {row[0]: row[1:] for row in conn.execute(STATS_EXACT + ";").fetchall()}
+                counted = {row[0]: row[1:] for row in conn.execute("SELECT network_id, records, nicks, idents, hosts, channels FROM network_stats;").fetchall()}
+            finally:
+                conn.close()
+            for network_id in set(exact) | set(counted):
+                delta = [a - b for a, b in zip(exact.get(network_id, (0,) * 5), counted.get(network_id, (0,) * 5))]
+                if any(delta):
+                    self.deltas.append([network_id] + delta)
+        except Exception as e:
+            self.error = str(e)
+        self.finished = time.time()
+
+# Seconds the backup waits between steps so the disk is not saturated.
+BACKUP_SLEEP = 0.05
+
+# Copies the database on its own connection so neither command blocks ZNC. `backup` uses the online backup API BACKUP_PAGES
+# pages per step, `compact` writes a VACUUMed copy with VACUUM INTO. Both read from one snapshot. In WAL mode writers carry on
+# while it is open and the backup never has to restart.
+class AkaCopyThread(threading.Thread):
+
+    def __init__(self, path, durability, target, compact, pages):
+        threading.Thread.__init__(self, name="aka-copy")
+        self.daemon = True
+        self.path = path
+        self.durability = durability
+        self.target = target
+        self.compact = compact
+        self.pages = pages
+        self.conn = None
+        self.total = 0
+        self.remaining = 0
+        self.error = None
+        self.started = time.time()
+        self.reported = self.started
+        self.finished = None
+
+    def stop(self):
+        if self.conn:
+            self.conn.interrupt()
+        self.join(1)
+
+    def run(self):
+        try:
+            self.conn = db_connect(self.path, self.durability, True)
+            self.total = self.remaining = self.conn.execute("PRAGMA page_count;").fetchone()[0]
+            if self.compact:
+                self.conn.execute("VACUUM INTO ?;", (self.target,))
+            else:
+                # Every step reads from this one transaction.
+                self.conn.execute("BEGIN;")
+                self.conn.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()
+                target = sqlite3.connect(self.target)
+                try:
+                    self.conn.backup(target, pages=self.pages, progress=self.progress, sleep=BACKUP_SLEEP)
+                finally:
+                    target.close()
+            self.remaining = 0
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            if self.conn:
+                self.conn.close()
+            self.finished = time.time()
+
+    def progress(self, status, remaining, total):
+        self.total = total
+        self.remaining = remaining
+
+# One network (or one channel of it) being purged PURGE_BATCH rows at a time.
+# Network wide retention policies skip (`keep`) the channels that have a policy of their own.
+class AkaPurge(object):
+
+    def __init__(self, network, channel, cutoff, keep, verbose):
+        self.network = network
+        self.channel = channel
+        self.cutoff = cutoff
+        self.keep = keep
+        self.verbose = verbose
+        self.deleted = 0
+
+    def label(self):
+        return "{} {}".format(self.network, self.channel) if self.channel else self.network
+
+# A running `process` command: the rows from the nick list snapshot and how many have been written.
+class AkaImport(object):
+
+    def __init__(self, scope, rows):
+        self.scope = scope
+        self.rows = rows
+        self.done = 0
+        self.started = time.time()
+        self.reported = self.started
+        # (writer thread, its queued count after the last row), the import is finished once the thread has applied that many.
+        self.waiting = None
+
+# One user who is currently in at least one of our channels. `last` is their latest (channel, event, message, time) since we saw them.
+class AkaPresent(object):
+    __slots__ = ('ident', 'host', 'account', 'channels', 'last')
+
+    def __init__(self):
+        self.ident = ''
+        self.host = ''
+        self.account = None
+        self.channels = set()
+        self.last = None
+
+# Who is in which of our channels right now on one network, keyed by lowercase nick. Seeded from the ZNC nick lists
+# and kept current by JOIN/PART/QUIT/NICK/KICK and WHO replies, so kicks and lookups for online users need no SQL.
+class AkaPresence(object):
+
+    def __init__(self):
+        self.users = {}
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, nick):
+        return self.users.get(nick.lower())
+
+    # Values that are not known (empty ident/host from a NAMES list, no account) never overwrite known ones.
+    def add(self, nick, ident, host, channel, account=None):
+        user = self.users.get(nick.lower())
+        if user is None:
+            user = self.users[nick.lower()] = AkaPresent()
+        if ident:
+            user.ident = ident.lower()
+        if host:
+            user.host = host.lower()
+        if account and account != '*' and account != '0':
+            user.account = account.lower()
+        if channel:
+            user.channels.add(channel.lower())
+        return user
+
+    def remove(self, nick, channel):
+        user = self.users.get(nick.lower())
+        if user:
+            user.channels.discard(channel.lower())
+            if not user.channels:
+                del self.users[nick.lower()]
+        return user
+
+    def quit(self, nick):
+        return self.users.pop(nick.lower(), None)
+
+    def rename(self, old_nick, new_nick):
+        user = self.users.pop(old_nick.lower(), None)
+        if user:
+            self.users[new_nick.lower()] = user
+        return user
+
+    # We left the channel ourselves.
+    def leave(self, channel):
+        for nick in [nick for nick, user in self.users.items() if channel.lower() in user.channels]:
+            self.remove(nick, channel)
+
+    # Users matching a GLOB pattern on their nick, ident, host, or any of the three.
+    def match(self, type, pattern):
+        pattern = pattern.lower()
+        if not type or type == 'nick':
+            if not any(char in pattern for char in '*?['):
+                user = self.users.get(pattern)
+                if user or type:
+                    return [user] if user else []
+        matches = []
+        for nick, user in self.users.items():
+            if (type in (None, 'nick') and fnmatch.fnmatchcase(nick, pattern)) or (type in (None, 'ident') and fnmatch.fnmatchcase(user.ident, pattern)) \
+                or (type in (None, 'host') and fnmatch.fnmatchcase(user.host, pattern)) or (type == 'account' and user.account and fnmatch.fnmatchcase(user.account, pattern)):
+                matches.append(user)
+        return matches
+
+# WHO requests wait this many seconds for RPL_ENDOFWHO (315) before the next one is sent anyway.
+WHO_TIMEOUT = 60
+
+# Hosts that can be geolocated: IPv4 (also dashed, as in cloaks like 1-2-3-4.isp.net), IPv6, and resolvable names.
+GEO_IPV4 = re.compile(r"(?:[0-9]{1,3}(\.|\-)){3}[0-9]{1,3}")
+GEO_IPV6 = re.compile("^((?:[0-9A-Fa-f]{1,4}))((?::[0-9A-Fa-f]{1,4}))*::((?:[0-9A-Fa-f]{1,4}))"
+                      "((?::[0-9A-Fa-f]{1,4}))*|((?:[0-9A-Fa-f]{1,4}))((?::[0-9A-Fa-f]{1,4})){7}$")
+GEO_RDNS = re.compile(r"^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*"
+                      r"([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$")
+
+# Number of seconds in a duration like 30m, 12h, 7d, or 2w. A plain number is days.
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_duration(value):
+    match = re.match(r"^(\d+)([smhdw]?)$", value.lower())
+    if not match or not int(match.group(1)):
+        raise ValueError("invalid duration: {}".format(value))
+    return int(match.group(1)) * DURATION_UNITS[match.group(2) or 'd']
+
+# The reverse of parse_duration(), in the largest unit that fits exactly.
+def format_duration(seconds):
+    for unit in "wdhm":
+        if seconds % DURATION_UNITS[unit] == 0:
+            return "{}{}".format(seconds // DURATION_UNITS[unit], unit)
+    return "{}s".format(seconds)
+
+# Returns the address to geolocate for a host, or None if the host is a cloak or otherwise unusable.
+def geo_address(host):
+    host = str(host)
+    match = GEO_IPV4.search(host)
+    if match:
+        return re.sub(r'[^\w.]', ".", match.group(0))
+    if GEO_IPV6.search(host) or (GEO_RDNS.search(host) and '.' in host):
+        return host
+    return None
+
+# IP range file for the FILE geo provider. One range per line: start,end,country[,region[,city[,lat[,lon[,timezone]]]]]
+# start and end are IPv4 or IPv6 addresses (or plain integers). Lines starting with # are skipped.
+# IPv4 ranges are kept in sorted arrays of 32 bit integers, IPv6 ranges in sorted lists. A lookup is one binary search.
+# Identical locations are stored once and ranges refer to them by index.
+class AkaGeoIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.locations = []
+        started = time.time()
+        seen = {}
+        v4 = []
+        v6 = []
+        with open(path, newline='', encoding='utf-8') as handle:
+            for row in csv.reader(handle):
+                if len(row) < 3 or row[0].startswith('#'):
+                    continue
+                try:
+                    start = ipaddress.ip_address(int(row[0]) if row[0].isdigit() else row[0])
+                    end = ipaddress.ip_address(int(row[1]) if row[1].isdigit() else row[1])
+                except ValueError:
+                    continue
+                location = tuple(row[2:8])
+                if location not in seen:
+                    seen[location] = len(self.locations)
+                    self.locations.append(location)
+                (v4 if start.version == 4 else v6).append((int(start), int(end), seen[location]))
+        v4.sort()
+        v6.sort()
+        self.v4_starts = array.array('I', [start for start, end, location in v4])
+        self.v4_ends = array.array('I', [end for start, end, location in v4])
+        self.v4_locations = array.array('L', [location for start, end, location in v4])
+        self.v6_starts = [start for start, end, location in v6]
+        self.v6_ends = [end for start, end, location in v6]
+        self.v6_locations = array.array('L', [location for start, end, location in v6])
+        self.load_time = time.time() - started
+
+    def __len__(self):
+        return len(self.v4_starts) + len(self.v6_starts)
+
+    # Returns an answer in the same shape as ip-api.com so both providers are printed the same way.
+    def lookup(self, address):
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return {"status": "fail", "message": "not an IP address"}
+        value = int(ip)
+        if ip.version == 4:
+            starts, ends, locations = self.v4_starts, self.v4_ends, self.v4_locations
+        else:
+            starts, ends, locations = self.v6_starts, self.v6_ends, self.v6_locations
+        index = bisect.bisect_right(starts, value) - 1
+        if index < 0 or value > ends[index]:
+            return {"status": "fail", "message": "not in {}".format(os.path.basename(self.path))}
+        location = self.locations[locations[index]] + ('',) * 6
+        return {"status": "success", "country": location[0], "regionName": location[1], "city": location[2], "lat": location[3], "lon": location[4],
+                "timezone": location[5], "proxy": None, "mobile": None, "query": str(ip), "reverse": ""}
+
+# Seconds the geo thread waits for the HTTP provider before the lookup fails.
+GEO_TIMEOUT = 10
+
+# Looks up geo answers so neither the HTTP request nor loading the range file ever runs on the ZNC thread.
+# Answers are (ip, data, error) tuples in `results`, the module picks them up on its timer.
+class AkaGeoThread(threading.Thread):
+
+    def __init__(self, provider, url, path):
+        threading.Thread.__init__(self, name="aka-geo")
+        self.daemon = True
+        self.provider = provider
+        self.url = url
+        self.path = path
+        self.index = None
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+
+    def stop(self):
+        self.requests.put(None)
+        self.join(1)
+
+    def run(self):
+        while True:
+            ip = self.requests.get()
+            if ip is None:
+                break
+            try:
+                if self.provider == "FILE":
+                    self.results.put((ip, self.lookup_file(ip), None))
+                else:
+                    with urllib.request.urlopen(self.url.format(urllib.parse.quote(ip)), timeout=GEO_TIMEOUT) as response:
+                        self.results.put((ip, json.loads(response.read().decode("utf-8")), None))
+            except Exception as e:
+                self.results.put((ip, None, str(e)))
+
+    # The range file is loaded on first use and again whenever GEO_FILE changes. Host names are resolved first.
+    def lookup_file(self, ip):
+        if self.index is None or self.index.path != self.path:
+            self.index = AkaGeoIndex(self.path)
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            ip = socket.getaddrinfo(ip, None)[0][4][0]
+        return self.index.lookup(ip)
+
+# Runs once a second for the lifetime of the module.
+class AkaTimer(znc.Timer):
+
+    def RunJob(self):
+        self.GetModule().on_tick()
+
 class aka(znc.Module):
     module_types = [znc.CModInfo.UserModule]
     description = "Tracks users, allowing tracing and history viewing of nicks, hosts, and channels"
@@ -65,22 +976,30 @@ class aka(znc.Module):
 
     HELP_COMMANDS = (
         ('all'        , ''                                                  , 'Get all information on a user (nick, ident, or host)'),
-        ('history'    , '<user> [--type=type]'                              , 'Show history for a user'),
-        ('users'      , '<#channel1> [<#channel2>] ... [<channel #>]'       , 'Show common users between a list of channel(s)'),
-        ('channels'   , '<user1> [<user2>] ... [<user #>] [--type=type]'    , 'Show common channels between a list of user(s) (nicks, idents, or hosts, including mixed)'),
+        ('history'    , '<user> [--type=type] [--deep] [--geo]'             , 'Show history for a user. --deep follows shared nicks, idents, and hosts HISTORY_DEPTH levels, --geo geolocates every host'),
+        ('users'      , '<#channel1> [<#channel2>] ... [-<#channel>] [--any] [--since=7d]', 'Show common users between a list of channel(s). -#channel leaves out users seen there, --any shows users of any of the channels, --since only counts users seen in that window'),
+        ('channels'   , '<user1> [<user2>] ... [-<user>] [--type=type] [--any] [--since=7d] [--online]', 'Show common channels between a list of user(s) (nicks, idents, or hosts, including mixed). -user leaves out their channels, --any shows channels of any of them, --since only counts records seen in that window, --online only uses the channels they are in right now'),
         ('seen'       , '<user> [<#channel>] [--type=type]'                 , 'Display last time user was seen doing something.'),
+        ('timeline'   , '<user> [--type=type]'                              , 'Show the last 50 journaled events for a user. Needs JOURNAL enabled.'),
+        ('search'     , '<terms> [--all] [--raw] | --rebuild'               , 'Search gecos, account, and last message, best matches first. Needs SEARCH_INDEX enabled.'),
         ('geo'        , '<user> [--type=type]'                              , 'Geolocates user (nick, ident, host, IP, or domain)'),
         ('who'        , '<scope>'                                           , 'Update userdata on all users in the scope (#channel, network, or all)'),
         ('process'    , '<scope>'                                           , 'Add all current users in the scope (#channel, network, or all) to the database'),
-        ('rawquery'   , '<query>'                                           , 'Run raw sqlite3 query and return results'),
+        ('more'       , ''                                                  , 'Show the next page of the last long result.'),
+        ('rawquery'   , '[--write] [--csv|--tsv] <query>'                   , 'Run raw sqlite3 query and return results. Read-only unless --write is given.'),
+        ('explain'    , '<command>'                                         , 'Show the SQLite query plan for the lookups a command runs.'),
+        ('perf'       , '[--slow] [--reset]'                                , 'Show hook and SQL timings and the slow query log. --slow shows the whole log, --reset starts counting again. Needs PERF enabled.'),
         ('about'      , ''                                                  , 'Display information about aka'),
-        ('stats'      , ''                                                  , 'Print data stats for the current network and the size of the entire database.'),
+        ('stats'      , '[--sizes] [--reconcile]'                           , 'Print data stats for the current network and the size of the entire database. --sizes lists every table and index, --reconcile recounts the counters.'),
+        ('backup'     , '<file>'                                            , 'Copy the database to <file> in the background. Relative to the module data directory.'),
+        ('compact'    , ''                                                  , 'VACUUM the database into a new file in the background and swap it in when done.'),
         ('purge'      , '<number_of_days>'                                  , 'Purge everything older than <N> number of days based on the lastseen for the current network.'),
+        ('retention'  , '[<days>|off] [<#channel>]'                         , 'Show or set how many days records are kept for the current network or a channel.'),
         ('config'     , '<variable> <value>'                                , 'Set configuration variables.'),
         ('getconfig'  , ''                                                  , 'Print the current configuration.'),
         ('offenses'   , '<in #channel> nick|host'                           , 'Display moderation history for nick or host. You can specify a channel'),
         ('help'       , ''                                                  , 'Print help for using the module'),
-        ('NOTE'       ,  'User Types'                                       , 'Valid user types are nick, ident, and host.'),
+        ('NOTE'       ,  'User Types'                                       , 'Valid user types are nick, ident, host, and account.'),
         ('NOTE'       ,  'Wildcard Searches'                                , '<user> supports * and ? GLOB wildcard syntax (combinable at start, middle, and end).')
     )
 
@@ -88,96 +1007,416 @@ class aka(znc.Module):
         self.USER = self.GetUser().GetUserName()
         self.configure()
         self.db_setup()
+        self.writer = AkaWriter(self.conn, int(self.nv['ID_CACHE_SIZE']))
+        self.writer_thread = None
+        # Held around writes on self.conn, see AkaWriterThread.
+        self.write_lock = threading.Lock()
+        self.last_checkpoint = time.time()
+        self.last_rollup = time.time()
+        self.quit_window = 0
+        self.quit_count = 0
+        self.last_quit = 0
+        self.storm = False
+        self.storms = 0
+        self.storm_quits = 0
+        self.holding = False
+        self.who_queues = {}
+        self.who_sent = {}
+        self.who_buffers = {}
+        self.who_requests = 0
+        self.who_replies = 0
+        self.import_job = None
+        self.purge_jobs = collections.deque()
+        self.purge_vacuum = False
+        self.purge_run = None
+        self.purge_last = None
+        self.last_retention = time.time()
+        self.copy_job = None
+        self.compacting = False
+        self.stats_job = None
+        self.stats_reconciled = None
+        self.last_reconcile = time.time()
+        self.ingested = 0
+        self.ingest_samples = collections.deque(maxlen=61)
+        self.pagers = {}
+        self.search_run = None
+        self.geo_thread = None
+        self.geo_cache = collections.OrderedDict()
+        self.geo_pending = {}
+        self.geo_hits = 0
+        self.geo_misses = 0
+        self.explaining = False
+        self.presences = {}
+        self.perf = None
+        self.apply_config()
+        if self.nv['VACUUM_ON_LOAD'] == "TRUE":
+            self.SetNV('VACUUM_ON_LOAD', "FALSE")
+            self.cmd_compact()
+        self.CreateTimer(AkaTimer, interval=1, cycles=0, label="aka_timer", description="Flushes the aka event buffer.")
         return True
 
+    def OnShutdown(self):
+        # An unfinished compaction is abandoned, the events it was holding back go to the current database.
+        if self.copy_job:
+            self.copy_job.stop()
+            self.copy_job = None
+            self.compacting = False
+        if self.geo_thread:
+            self.geo_thread.stop()
+            self.geo_thread = None
+        for pager in self.pagers.values():
+            pager.close()
+        self.pagers = {}
+        self.flush_writes()
+        if self.writer_thread:
+            self.writer_thread.stop()
+            self.writer_thread = None
+
+    # Brings the running state in line with the current settings. Called on load and after every config change.
+    def apply_config(self):
+        # Typed copy of the settings so the event handlers do not parse strings on every line.
+        self.settings = {}
+        for setting, default in DEFAULT_CONFIG.items():
+            if isinstance(default, bool):
+                self.settings[setting] = self.nv[setting] == "TRUE"
+            elif isinstance(default, int):
+                self.settings[setting] = int(self.nv[setting])
+            else:
+                self.settings[setting] = self.nv[setting]
+        if self.settings['DURABILITY'] != self.durability:
+            self.durability = self.settings['DURABILITY']
+            db_apply_profile(self.conn, self.durability)
+            db_apply_profile(self.rconn, self.durability, True)
+            if self.writer_thread:
+                self.writer_thread.stop()
+                self.writer_thread = None
+        if self.settings['WRITER_THREAD'] and not self.writer_thread and not self.compacting:
+            self.flush_writes()
+            self.writer_thread = AkaWriterThread(self.db_path, self.durability, self.settings['WRITER_QUEUE_SIZE'], self.settings['FLUSH_MAX_BATCH'], self.settings['ID_CACHE_SIZE'], self.write_lock)
+            self.writer_thread.perf = self.perf
+            self.writer_thread.start()
+        elif not self.settings['WRITER_THREAD'] and self.writer_thread:
+            self.writer_thread.stop()
+            self.writer_thread = None
+        if self.geo_thread:
+            if self.geo_thread.provider != self.settings['GEO_PROVIDER']:
+                self.geo_cache.clear()
+            self.geo_thread.provider = self.settings['GEO_PROVIDER']
+            self.geo_thread.url = self.settings['GEO_URL']
+            self.geo_thread.path = self.geo_path()
+        if self.settings['PERF'] != (self.perf is not None):
+            self.perf = AkaPerf(0) if self.settings['PERF'] else None
+            self.perf_instrument()
+        if self.perf:
+            self.perf.threshold = self.settings['SLOW_QUERY_MS'] / 1000.0
+        # Whatever is left in the journal is folded in once more after it is turned off.
+        if not self.settings['JOURNAL']:
+            self.rollup_journal()
+        # The search index is created when it is turned on and dropped when it is turned off. A compaction in progress would
+        # lose the change, apply_config() runs again when it is done.
+        if not self.compacting and self.settings['SEARCH_INDEX'] != self.search_exists():
+            with self.write_lock:
+                if self.settings['SEARCH_INDEX']:
+                    self.search_create()
+                else:
+                    self.search_drop()
+
+    # With PERF enabled every hook is wrapped by an instance attribute of the same name, ZNC finds it before the method.
+    # Turning it off removes them again, so nothing is left in the way of the hooks.
+    def perf_instrument(self):
+        self.cur = perf_cursor(self.conn, self.perf)
+        self.rcur = perf_cursor(self.rconn, self.perf)
+        self.writer.instrument(self.perf)
+        if self.writer_thread:
+            self.writer_thread.perf = self.perf
+        for name in [name for name in type(self).__dict__ if name.startswith("On") and name not in ("OnLoad", "OnShutdown")] + ["on_tick"]:
+            if self.perf:
+                setattr(self, name, self.perf_hook(name, getattr(type(self), name).__get__(self)))
+            else:
+                self.__dict__.pop(name, None)
+
+    def perf_hook(self, name, method):
+        perf = self.perf
+        @functools.wraps(method)
+        def hook(*args):
+            key = name
+            if name == "OnModCommand":
+                key = "command {}".format((str(args[0]).split() or [''])[0].lower())
+            context, perf.context = perf.context, key
+            start = time.perf_counter()
+            try:
+                return method(*args)
+            finally:
+                perf.hook(key, time.perf_counter() - start)
+                perf.context = context
+        return hook
+
+    def on_tick(self):
+        if self.storm and time.time() - self.last_quit >= 1:
+            self.storm = False
+            self.flush_writes()
+        if self.writer.pending and time.time() - self.writer.last_flush >= self.settings['FLUSH_INTERVAL']:
+            self.flush_writes()
+        if time.time() - self.last_checkpoint >= self.settings['CHECKPOINT_INTERVAL']:
+            self.checkpoint()
+        if self.settings['JOURNAL'] and time.time() - self.last_rollup >= self.settings['JOURNAL_ROLLUP_INTERVAL']:
+            self.rollup_journal()
+        if self.import_job:
+            self.run_import()
+        if self.settings['ENABLE_PURGE'] and not self.purge_run and time.time() - self.last_retention >= self.settings['RETENTION_INTERVAL']:
+            self.retention_run()
+        if self.purge_run and not self.compacting:
+            with self.write_lock:
+                self.run_purge()
+        if self.search_run and not self.compacting:
+            with self.write_lock:
+                self.run_search()
+        if self.copy_job:
+            self.run_copy()
+        if self.stats_job and not self.stats_job.is_alive():
+            self.stats_finish()
+        elif not self.stats_job and time.time() - self.last_reconcile >= self.settings['STATS_RECONCILE_INTERVAL']:
+            self.stats_reconcile()
+        self.ingest_samples.append((time.time(), self.ingested))
+        for name in [name for name, pager in self.pagers.items() if time.time() - pager.used >= self.settings['PAGE_EXPIRY']]:
+            self.pagers.pop(name).close()
+        if self.geo_thread:
+            self.geo_results()
+        if self.who_queues:
+            self.who_run()
+
+    # A checkpoint cannot reset the WAL while a reader still has an older snapshot open, a pager's connection, the stats
+    # recount, or a backup. Without any of them the WAL is checkpointed and truncated. The busy timeout is dropped meanwhile so
+    # a writer thread in the middle of a commit makes it give up until the next interval instead of stalling ZNC.
+    def checkpoint(self):
+        self.last_checkpoint = time.time()
+        if self.pagers or self.stats_job or self.copy_job:
+            self.cur.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchall()
+            return
+        self.cur.execute("PRAGMA busy_timeout=0;")
+        try:
+            with self.write_lock:
+                self.cur.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+        finally:
+            self.cur.execute("PRAGMA busy_timeout=30000;")
+
+    # All event writes go through here. With BUFFER_WRITES enabled they are queued and written by on_tick().
+    def write(self, sql, params, kinds=()):
+        if self.writer_thread:
+            self.writer_thread.put(sql, params, kinds)
+            return
+        self.writer.add(sql, params, kinds)
+        if (not self.settings['BUFFER_WRITES'] and not self.storm and not self.holding) or self.writer.rows >= self.settings['FLUSH_MAX_BATCH']:
+            self.flush_writes()
+
+    # Nothing is written while `compact` runs, events stay in the buffer until the compacted copy is in place.
+    def flush_writes(self):
+        if self.compacting:
+            return 0
+        return self.writer.flush()
+
+    def rollup_journal(self):
+        self.last_rollup = time.time()
+        self.write(journal_rollup, (int(time.time()) - self.settings['JOURNAL_RETENTION'] * 86400,))
+
+    # Runs a lookup on the read-only connection. While `explain` is running the query plan is printed first.
+    # Pass a cursor of its own for results that are read lazily by a pager, self.rcur is reused by the next lookup.
+    def query(self, sql, params=(), cursor=None):
+        if self.explaining:
+            self.PutModule("\x02Query:\x02 {}".format(' '.join(sql.split())))
+            depth = {0: 0}
+            for id, parent, notused, detail in self.rcur.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall():
+                depth[id] = depth.get(parent, 0) + 1
+                self.PutModule("{}{}".format("  " * depth[id], detail))
+        return (cursor or self.rcur).execute(sql, params)
+
+    # Prints the first PAGE_SIZE lines and keeps the rest for `more`. One pending result per network, a new one replaces it.
+    def page(self, lines, conn=None, timeout=0):
+        name = self.GetNetwork().GetName().lower()
+        if name in self.pagers:
+            self.pagers.pop(name).close()
+        self.pagers[name] = AkaPager(iter(lines), conn, timeout)
+        self.cmd_more()
+
+    # Results read lazily by a pager get a read-only connection of their own. An open statement pins its connection to one
+    # snapshot, on the shared lookup connection it would hide new events from every other command until the pager is done.
+    def page_connection(self):
+        return db_connect(self.db_path, self.durability, True)
+
+    def cmd_more(self):
+        name = self.GetNetwork().GetName().lower()
+        pager = self.pagers.get(name)
+        if not pager:
+            self.PutModule("Nothing more to show.")
+            return
+        try:
+            lines, more = pager.next_page(self.settings['PAGE_SIZE'])
+        except sqlite3.Error as e:
+            lines, more = ['Error: %s' % e], False
+        for line in lines:
+            self.PutModule(line)
+        if more:
+            self.PutModule("Type \x02more\x02 for the next {} lines.".format(self.settings['PAGE_SIZE']))
+        else:
+            self.pagers.pop(name).close()
+
+    # Presence index for the current network. Built from the ZNC nick lists the first time it is needed.
+    def presence(self):
+        network = self.GetNetwork()
+        name = network.GetName().lower()
+        presence = self.presences.get(name)
+        if presence is None:
+            presence = self.presences[name] = AkaPresence()
+            for chan in network.GetChans():
+                self.presence_seed(presence, chan)
+        return presence
+
+    def presence_seed(self, presence, chan):
+        channel = chan.GetName()
+        for name, nick in chan.GetNicks().items():
+            presence.add(nick.GetNick(), nick.GetIdent(), nick.GetHost(), channel)
+
+    def OnIRCDisconnected(self):
+        name = self.GetNetwork().GetName().lower()
+        self.presences.pop(name, None)
+        self.who_queues.pop(name, None)
+        self.who_sent.pop(name, None)
+        self.who_buffers.pop(name, None)
+
     def OnJoinMessage(self, msg):
-        channel = str(msg.GetChan().GetName()).replace("'","''")
-        gecos   = str(msg.GetParam(2)).replace("'","''")
-        self.process_join(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, 'join', msg.GetParam(1), gecos)
+        nick = msg.GetNick()
+        user = self.presence().add(nick.GetNick(), nick.GetIdent(), nick.GetHost(), msg.GetChan().GetName(), msg.GetParam(1))
+        user.last = (msg.GetChan().GetName().lower(), 'join', '', int(time.time()))
+        self.ingest(AkaEvent("join", self.GetNetwork().GetName(), nick.GetNick(), nick.GetIdent(), nick.GetHost(), msg.GetChan().GetName(), 'join', None, msg.GetParam(1), msg.GetParam(2)))
 
-    # KNOWN ISSUES:
-    # It is possible to get NULL 'ident' and 'host' entries for the kicked nick. This happens when the user does not exist in the database and they get kicked.
+    # The kicked user's ident and host come from the presence index. Only users we never saw a userhost for fall back to the database,
+    # and users that are not in the database either are recorded with an empty ident and host.
     def OnKickMessage(self, msg):
-        if self.nv['RECORD_KICK'] == "TRUE" or self.nv['RECORD_MODERATED'] == "TRUE":
-            channel = str(msg.GetChan().GetName().replace("'","''"))
-            self.cur.execute("SELECT ident, host, MAX(lastseen) FROM users WHERE network = '{0}' AND nick = '{1}';".format(self.GetNetwork().GetName().lower(), msg.GetKickedNick().lower()))
-            for row in self.cur:
-                self.on_kick_process(msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, msg.GetKickedNick(), row[0], row[1], msg.GetReason())
+        channel = str(msg.GetChan().GetName())
+        presence = self.presence()
+        user = presence.get(msg.GetKickedNick())
+        if user:
+            user.last = (channel.lower(), 'kicked', str(msg.GetReason()), int(time.time()))
+        if self.settings['RECORD_KICK'] or self.settings['RECORD_MODERATED']:
+            if user and user.ident and user.host:
+                ident, host = user.ident, user.host
+            else:
+                # The kicked user's last sighting may still be in the event buffer, the writer thread's queue, or the journal.
+                if self.settings['JOURNAL']:
+                    self.rollup_journal()
+                self.flush_writes()
+                if self.writer_thread:
+                    self.writer_thread.wait(WRITER_WAIT)
+                row = self.query("SELECT ident, host, MAX(lastseen) FROM users WHERE network = ? AND nick = ?;", (self.GetNetwork().GetName().lower(), msg.GetKickedNick().lower())).fetchone()
+                ident, host = row[0] or '', row[1] or ''
+            self.on_kick_process(msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, msg.GetKickedNick(), ident, host, msg.GetReason())
+        self.presence_part(presence, msg.GetKickedNick(), channel)
+
+    # Drops the channel for the user, or every user in it when we are the one leaving.
+    def presence_part(self, presence, nick, channel):
+        if nick.lower() == self.GetNetwork().GetCurNick().lower():
+            presence.leave(channel)
+            return None
+        return presence.remove(nick, channel)
 
     def OnPartMessage(self, msg):
-        channel  = str(msg.GetChan().GetName()).replace("'","''")
-        partmsg  = str(msg.GetReason()).replace("'","''")
-        if msg.GetTag('account'):
-            self.process_part_account(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, 'part', partmsg, msg.GetTag('account'))
-        else:
-            self.process_part(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, 'part', partmsg)
+        nick = msg.GetNick()
+        presence = self.presence()
+        user = self.presence_part(presence, nick.GetNick(), msg.GetChan().GetName())
+        if user:
+            user.last = (msg.GetChan().GetName().lower(), 'part', str(msg.GetReason()), int(time.time()))
+        self.ingest(AkaEvent("part", self.GetNetwork().GetName(), nick.GetNick(), nick.GetIdent(), nick.GetHost(), msg.GetChan().GetName(), 'part', str(msg.GetReason()), msg.GetTag('account') or None))
 
     def OnQuitMessage(self, msg, vChans):
-        quitmsg  = str(msg.GetReason()).replace("'","''")
-        if msg.GetTag('account'):
-            for chan in vChans:
-                channel = str(chan.GetName().replace("'","''"))
-                self.process_quit_account(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, 'quit', quitmsg, msg.GetTag('account'))
-        else:
-            for chan in vChans:
-                channel = str(chan.GetName().replace("'","''"))
-                self.process_quit(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, 'quit', quitmsg)
-
-    # The OnUser...Message events will add a '1' into the join column since it shares the same process_message code for channels.
+        nick = msg.GetNick()
+        network = self.GetNetwork().GetName()
+        quitmsg = str(msg.GetReason())
+        account = msg.GetTag('account') or None
+        self.presence().quit(nick.GetNick())
+        self.track_quit(quitmsg)
+        if vChans:
+            self.ingest(*[AkaEvent("quit", network, nick.GetNick(), nick.GetIdent(), nick.GetHost(), chan.GetName(), 'quit', quitmsg, account) for chan in vChans])
+
+    # A netsplit drops thousands of users within a second or two. While it lasts quits are buffered and written in one transaction
+    # once it is over, even with BUFFER_WRITES disabled. It starts on the first netsplit QUIT or once STORM_THRESHOLD quits arrive within a second.
+    def track_quit(self, reason):
+        now = time.time()
+        if now - self.quit_window >= 1:
+            self.quit_window = now
+            self.quit_count = 0
+        self.quit_count += 1
+        self.last_quit = now
+        if not self.storm and (self.quit_count >= self.settings['STORM_THRESHOLD'] or NETSPLIT_REASON.match(reason)):
+            self.storm = True
+            self.storms += 1
+        if self.storm:
+            self.storm_quits += 1
+
+    # The OnUser...Message events will add a '1' into the join column since it shares the same statement for channels.
     def OnUserTextMessage(self, msg):
-        nick  = self.GetNetwork().GetCurNick()
-        ident = self.GetNetwork().GetIRCNick().GetIdent()
-        host  = self.GetNetwork().GetIRCNick().GetHost()
-        self.process_message(self.GetNetwork().GetName(), nick, ident, host, msg.GetTarget(), 'privmsg', msg.GetText())
+        self.on_user_message(msg, 'privmsg', msg.GetText())
 
     def OnUserActionMessage(self, msg):
-        nick  = self.GetNetwork().GetCurNick()
-        ident = self.GetNetwork().GetIRCNick().GetIdent()
-        host  = self.GetNetwork().GetIRCNick().GetHost()
-        self.process_message(self.GetNetwork().GetName(), nick, ident, host, msg.GetTarget(), 'privmsg', '* ' + msg.GetText())
+        self.on_user_message(msg, 'privmsg', '* ' + msg.GetText())
 
     def OnUserNoticeMessage(self, msg):
-        nick  = self.GetNetwork().GetCurNick()
-        ident = self.GetNetwork().GetIRCNick().GetIdent()
-        host  = self.GetNetwork().GetIRCNick().GetHost()
-        self.process_message(self.GetNetwork().GetName(), nick, ident, host, msg.GetTarget(), 'notice', msg.GetText())
+        self.on_user_message(msg, 'notice', msg.GetText())
+
+    def on_user_message(self, msg, event, text):
+        network = self.GetNetwork()
+        self.ingest(AkaEvent("message", network.GetName(), network.GetCurNick(), network.GetIRCNick().GetIdent(), network.GetIRCNick().GetHost(), str(msg.GetTarget()), event, text))
 
     # TODO: Update gecos.
     def OnNickMessage(self, msg, vChans):
-        if msg.GetTag('account'):
-            for chan in vChans:
-                channel = str(chan.GetName().replace("'","''"))
-                self.process_nick_change_new_account(self.GetNetwork().GetName(), msg.GetOldNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, msg.GetNewNick(), msg.GetTag('account'))
-                self.process_nick_change_old_account(self.GetNetwork().GetName(), msg.GetNewNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, msg.GetOldNick(), msg.GetTag('account'))
-        else:
-            for chan in vChans:
-                channel = str(chan.GetName().replace("'","''"))
-                self.process_nick_change_new(self.GetNetwork().GetName(), msg.GetOldNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, msg.GetNewNick())
-                self.process_nick_change_old(self.GetNetwork().GetName(), msg.GetNewNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), channel, msg.GetOldNick())
+        network = self.GetNetwork().GetName()
+        ident = msg.GetNick().GetIdent()
+        host = msg.GetNick().GetHost()
+        old_nick = msg.GetOldNick()
+        new_nick = msg.GetNewNick()
+        account = msg.GetTag('account') or None
+        user = self.presence().rename(old_nick, new_nick)
+        if user and vChans:
+            user.last = (vChans[0].GetName().lower(), 'nicked', old_nick.lower(), int(time.time()))
+        events = []
+        for chan in vChans:
+            channel = chan.GetName()
+            events.append(AkaEvent("nick", network, old_nick, ident, host, channel, 'nick', new_nick.lower(), account))
+            events.append(AkaEvent("nick", network, new_nick, ident, host, channel, 'nicked', old_nick.lower(), account))
+        if events:
+            self.ingest(*events)
 
     def OnChanActionMessage(self, msg):
-        self.process_message(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), msg.GetChan().GetName(), 'privmsg' , '* ' + msg.GetText())
+        self.on_message(msg, msg.GetChan().GetName(), 'privmsg', '* ' + msg.GetText())
 
     def OnChanNoticeMessage(self, msg):
-        self.process_message(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), msg.GetChan().GetName(), 'notice', msg.GetText())
+        self.on_message(msg, msg.GetChan().GetName(), 'notice', msg.GetText())
 
     def OnChanTextMessage(self, msg):
-        self.process_message(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), msg.GetChan().GetName(), 'privmsg', msg.GetText())
+        self.on_message(msg, msg.GetChan().GetName(), 'privmsg', msg.GetText())
 
     def OnPrivActionMessage(self, msg):
-        self.process_message(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), 'query', 'privmsg', '* ' + msg.GetText())
+        self.on_message(msg, 'query', 'privmsg', '* ' + msg.GetText())
 
     def OnPrivNoticeMessage(self, msg):
         # Don't log server notices.
         if (msg.GetNick().GetIdent() == ''): return
-        self.process_message(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), 'query', 'notice', msg.GetText())
+        self.on_message(msg, 'query', 'notice', msg.GetText())
 
     def OnPrivTextMessage(self, msg):
-        self.process_message(self.GetNetwork().GetName(), msg.GetNick().GetNick(), msg.GetNick().GetIdent(), msg.GetNick().GetHost(), 'query', 'privmsg', msg.GetText())
+        self.on_message(msg, 'query', 'privmsg', msg.GetText())
+
+    # Channel messages and notices:
+    # Private messages and notices:
+    def on_message(self, msg, channel, event, text):
+        nick = msg.GetNick()
+        user = self.presence().get(nick.GetNick())
+        if user:
+            user.last = (channel.lower(), event, text, int(time.time()))
+        self.ingest(AkaEvent("message", self.GetNetwork().GetName(), nick.GetNick(), nick.GetIdent(), nick.GetHost(), channel, event, text))
 
     def OnUserJoinMessage(self, msg):
-        if self.nv['WHO_ON_JOIN'] == "TRUE":
-            self.PutIRC("WHO %s" % msg.GetTarget())
+        if self.settings['WHO_ON_JOIN']:
+            self.who_queue(self.GetNetwork(), msg.GetTarget())
 
 
 
@@ -197,7 +1436,7 @@ class aka(znc.Module):
             whois_nick  = msg.GetParam(1)
             whois_ident = msg.GetParam(2)
             whois_host  = msg.GetParam(3)
-            whois_gecos = str(msg.GetParam(5)).replace("'","''")
+            whois_gecos = msg.GetParam(5)
 
         if (msg.GetCode() == 314):
             global whowas_nick
@@ -210,15 +1449,15 @@ class aka(znc.Module):
             whowas_nick  = msg.GetParam(1)
             whowas_ident = msg.GetParam(2)
             whowas_host  = msg.GetParam(3)
-            whowas_gecos = str(msg.GetParam(5)).replace("'","''")
-            if self.nv['RECORD_WHOWAS'] == "TRUE":
-                self.process_whowas(self.GetNetwork().GetName(), whowas_nick, whowas_ident, whowas_host, whowas_account, whowas_gecos)
+            whowas_gecos = msg.GetParam(5)
+            if self.settings['RECORD_WHOWAS']:
+                self.ingest(AkaEvent("whowas", self.GetNetwork().GetName(), whowas_nick, whowas_ident, whowas_host, '/whowas', None, None, whowas_account, whowas_gecos))
 
         # End of /whois
         # :do.foobar.com 318 KindOne KindOne :End of /WHOIS list.
         if (msg.GetCode() == 318):
-            if self.nv['RECORD_WHOIS'] == "TRUE":
-                self.process_whois(self.GetNetwork().GetName(), whois_nick, whois_ident, whois_host, whois_account, whois_gecos)
+            if self.settings['RECORD_WHOIS']:
+                self.ingest(AkaEvent("whois", self.GetNetwork().GetName(), whois_nick, whois_ident, whois_host, '/whois', None, None, whois_account, whois_gecos))
 
         # Account
         # :do.foobar.com 330 KindOne KindOne kindone :is logged in as
@@ -228,8 +1467,8 @@ class aka(znc.Module):
 
         # End of /whowas
         if (msg.GetCode() == 369):
-            if self.nv['RECORD_WHOWAS'] == "TRUE":
-                self.process_whowas(self.GetNetwork().GetName(), whowas_nick, whowas_ident, whowas_host, whowas_account, whowas_gecos)
+            if self.settings['RECORD_WHOWAS']:
+                self.ingest(AkaEvent("whowas", self.GetNetwork().GetName(), whowas_nick, whowas_ident, whowas_host, '/whowas', None, None, whowas_account, whowas_gecos))
 
         # /who #channel
         #                            0       1      2               3          4               5
@@ -238,9 +1477,20 @@ class aka(znc.Module):
           nick  = msg.GetParam(5)
           ident = msg.GetParam(2)
           host  = msg.GetParam(3)
-          chan  = str(msg.GetParam(1)).replace("'","''")
-          gecos = str(msg.GetParam(7)).replace("'","''")
-          self.process_user_who(self.GetNetwork().GetName(), nick, ident, host, chan, gecos)
+          chan  = msg.GetParam(1)
+          gecos = msg.GetParam(7)
+          self.presence().add(nick, ident, host, chan if chan != '*' else None)
+          self.who_reply(AkaEvent("who", self.GetNetwork().GetName(), nick, ident, host, chan, '/who', None, None, gecos))
+        # End of /who, everything since the last one is written in one transaction.
+        # :sodium.libera.chat 315 KindOne #channel :End of /WHO list.
+        if (msg.GetCode() == 315):
+          self.who_end(self.GetNetwork().GetName().lower(), msg.GetParam(1).lower())
+        # End of /names, the nick list of a channel we just joined is complete.
+        # :sodium.libera.chat 366 KindOne #channel :End of /NAMES list.
+        if (msg.GetCode() == 366):
+          chan = self.GetNetwork().FindChan(msg.GetParam(1))
+          if chan:
+              self.presence_seed(self.presence(), chan)
         # /cap req userhost-in-names
         # TODO - Figure out how to remove op/voice status.
         #if (msg.GetCode() == 353):
@@ -256,10 +1506,11 @@ class aka(znc.Module):
             nick  = msg.GetParam(6)
             ident = msg.GetParam(3)
             host  = msg.GetParam(4)
-            chan  = str(msg.GetParam(2)).replace("'","''")
+            chan  = msg.GetParam(2)
             account  = msg.GetParam(10)
-            gecos = str(msg.GetParam(11)).replace("'","''")
-            self.process_user_mirc_who(self.GetNetwork().GetName(), nick, ident, host, chan, account, gecos)
+            gecos = msg.GetParam(11)
+            self.presence().add(nick, ident, host, chan if chan != '*' else None, account)
+            self.who_reply(AkaEvent("who", self.GetNetwork().GetName(), nick, ident, host, chan, '/who', None, account, gecos))
 
 
         # TODO - Deal with accountname.
@@ -274,11 +1525,64 @@ class aka(znc.Module):
             gecos = self.GetNetwork().GetRealName()
             account = '0'
             for channel in self.GetNetwork().GetChans():
-                self.process_join(self.GetNetwork().GetName(), nick, ident, host, channel.GetName(), 'join', account, gecos)
+                self.ingest(AkaEvent("join", self.GetNetwork().GetName(), nick, ident, host, channel.GetName(), 'join', None, account, gecos))
+
+    # WHO requests go out one at a time per network, at most one every WHO_INTERVAL seconds, so `who all` does not get us killed for flooding.
+    # WHOX is used when the server supports it to also get the account.
+    def who_queue(self, network, channel):
+        channels = self.who_queues.setdefault(network.GetName().lower(), collections.deque())
+        if channel.lower() not in channels:
+            channels.append(channel.lower())
+
+    # Called from on_tick().
+    def who_run(self):
+        now = time.time()
+        for network in self.GetUser().GetNetworks():
+            name = network.GetName().lower()
+            channels = self.who_queues.get(name)
+            if not channels:
+                continue
+            if not network.IsIRCConnected():
+                channels.clear()
+                continue
+            if name in self.who_sent:
+                channel, sent = self.who_sent[name]
+                if now - sent < self.settings['WHO_INTERVAL'] or (channel and now - sent < WHO_TIMEOUT):
+                    continue
+                if channel:
+                    # No RPL_ENDOFWHO. Write what did arrive.
+                    self.who_end(name, channel)
+            channel = channels.popleft()
+            sock = network.GetIRCSock()
+            if sock and sock.GetISupport("WHOX", "-") != "-":
+                network.PutIRC("WHO {} %acdfhlnrstu,995".format(channel))
+            else:
+                network.PutIRC("WHO {}".format(channel))
+            self.who_sent[name] = (channel, now)
+            self.who_requests += 1
+        for name in [name for name, channels in self.who_queues.items() if not channels]:
+            del self.who_queues[name]
+
+    def who_reply(self, event):
+        self.who_buffers.setdefault(event.network, []).append(event)
+        self.who_replies += 1
+
+    def who_end(self, name, channel):
+        if name in self.who_sent and self.who_sent[name][0] == channel:
+            self.who_sent[name] = (None, self.who_sent[name][1])
+        events = self.who_buffers.pop(name, None)
+        if events:
+            self.holding = True
+            try:
+                self.ingest(*events)
+            finally:
+                self.holding = False
+            if not self.settings['BUFFER_WRITES'] and not self.storm:
+                self.flush_writes()
 
     def OnMode(self, op, channel, mode, arg, added, nochange):
-        channel = str(channel).replace("'","''")
-        if self.nv['RECORD_MODERATED'] == "TRUE":
+        if self.settings['RECORD_MODERATED']:
+            channel = str(channel)
             mode = chr(mode)
             if added:
                 char = '+'
@@ -288,248 +1592,184 @@ class aka(znc.Module):
             if mode == "b" or mode == "q":
                 self.process_moderated(self.GetNetwork().GetName(), op.GetNick(), op.GetIdent(), op.GetHost(), channel, mode, None, str(arg).split('!')[0], str((arg).split('@')[0]).split('!')[1], str(arg).split('@')[1], added)
 
+    # Single entry point for user events. With JOURNAL enabled the events it covers are appended instead of updating the users row.
+    # Several events of the same kind (one IRC line seen in many channels) are written with one multi-row statement.
+    def ingest(self, *events):
+        self.ingested += len(events)
+        kind = events[0].kind
+        if self.settings['JOURNAL'] and events[0].event in JOURNAL_EVENTS:
+            kind = "journal"
+        fields = EVENT_FIELDS[kind]
+        if len(events) == 1:
+            self.write(event_statement(kind), fields(events[0]), USER_DIMS)
+            return
+        size = EVENT_ROWS[kind]
+        for index in range(0, len(events), size):
+            chunk = events[index:index+size]
+            self.write(event_statement(kind, len(chunk)), [fields(event) for event in chunk], USER_DIMS)
+
     def process_moderated(self, network, op_nick, op_ident, op_host, channel, action, message, offender_nick, offender_ident, offender_host, added):
         # TODO: Convert this...
         time    = datetime.datetime.now()
-        self.cur.execute("INSERT INTO moderated (network, op_nick, op_ident, op_host, channel, action, message, offender_nick, offender_ident, offender_host, added, time) \
+        self.write("INSERT INTO moderated_records (network_id, op_nick_id, op_ident_id, op_host_id, channel_id, offender_nick_id, offender_ident_id, offender_host_id, action, message, added, time) \
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", \
-        (network.lower(), op_nick, op_ident, op_host, channel, action, message, offender_nick, offender_ident, offender_host, added, time))
-        self.conn.commit()
-
-    def process_user_who(self, network, nick, ident, host, channel, gecos):
-        gecos = str(gecos).replace("'","''")
-        channel = str(channel).replace("'","''")
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, gecos) \
-            VALUES (?, ?, ?, ?, ?, '/who', '', strftime('%s', 'now'), strftime('%s', 'now'), '0', '1', '0', '0', '0', ?) ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set gecos = EXCLUDED.gecos, lastseen = strftime('%s', 'now');", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), gecos.lower()))
-        self.conn.commit()
-
-    def process_user_mirc_who(self, network, nick, ident, host, channel, account, gecos):
-        gecos = str(gecos).replace("'","''")
-        channel = str(channel).replace("'","''")
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account, gecos) \
-            VALUES (?, ?, ?, ?, ?, '/who', '', strftime('%s', 'now'), strftime('%s', 'now'), '0', '1', '0', '0', '0', ?, ?) ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set gecos = EXCLUDED.gecos, account = EXCLUDED.account, lastseen = strftime('%s', 'now');", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), account.lower(), gecos.lower()))
-        self.conn.commit()
-
-    def process_join(self, network, nick, ident, host, channel, event, account, gecos):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account, gecos) \
-            VALUES (?, ?, ?, ?, ?, ?, '', strftime('%s', 'now'), strftime('%s', 'now'), '0', '1', '0', '0', '0', ?, ?) ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set message = '', event = EXCLUDED.event, lastseen = strftime('%s', 'now'), joins = joins + 1, account = EXCLUDED.account, gecos = EXCLUDED.gecos;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), event, account.lower(), gecos.lower()))
-        self.conn.commit()
+        (network.lower(), op_nick, op_ident, op_host, channel, offender_nick, offender_ident, offender_host, action, message, added, time), MODERATED_DIMS)
 
     def on_kick_process(self, op_nick, op_ident, op_host, channel, nick, ident, host, message):
-        message = str(message).replace("'","''")
-        if self.nv['RECORD_KICK'] == "TRUE":
-            self.process_kick(self.GetNetwork().GetName(), nick, ident, host, channel, 'kicked', message)
-        if self.nv['RECORD_MODERATED'] == "TRUE":
+        message = str(message)
+        if self.settings['RECORD_KICK']:
+            self.ingest(AkaEvent("kick", self.GetNetwork().GetName(), nick, ident, host, channel, 'kicked', message))
+        if self.settings['RECORD_MODERATED']:
             self.process_moderated(self.GetNetwork().GetName(), op_nick, op_ident, op_host, channel, 'k', message, nick, ident, host, None)
 
-    def process_kick(self, network, nick, ident, host, channel, event, message):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits) \
-            VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%s', 'now'), strftime('%s', 'now'), '0', '1', '1', '0', '0') ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set event = EXCLUDED.event, message = EXCLUDED.message, lastseen = strftime('%s', 'now'), kicks = kicks + 1 ;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), event, message))
-        self.conn.commit()
-
-    def process_part(self, network, nick, ident, host, channel, event, message):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits) \
-            VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%s', 'now'), strftime('%s', 'now'), '0', '1', '0', '1', '0') ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set event = EXCLUDED.event, message = EXCLUDED.message, lastseen = strftime('%s', 'now'), parts = parts + 1 ;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), event, message))
-        self.conn.commit()
-
-    def process_part_account(self, network, nick, ident, host, channel, event, message, account):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account) \
-            VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%s', 'now'), strftime('%s', 'now'), '0', '1', '0', '1', '0', ?) ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set event = EXCLUDED.event, message = EXCLUDED.message, account = EXCLUDED.account, lastseen = strftime('%s', 'now'), parts = parts + 1 ;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), event, message, account.lower()))
-        self.conn.commit()
-
-    def process_quit(self, network, nick, ident, host, channel, event, message):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits) \
-            VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%s', 'now'), strftime('%s', 'now'), '0', '1', '0', '0', '1') ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set event = EXCLUDED.event, message = EXCLUDED.message, lastseen = strftime('%s', 'now'), quits = quits + 1 ;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), event, message))
-        self.conn.commit()
-
-    def process_quit_account(self, network, nick, ident, host, channel, event, message, account):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account) \
-            VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%s', 'now'), strftime('%s', 'now'), '0', '1', '0', '0', '1', ?) ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set event = EXCLUDED.event, message = EXCLUDED.message, lastseen = strftime('%s', 'now'), account = EXCLUDED.account, quits = quits + 1 ;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), event, message, account.lower()))
-        self.conn.commit()
-
-    def process_nick_change_new(self, network, nick, ident, host, channel, message):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits) \
-            VALUES (?, ?, ?, ?, ?, 'nick', ?, strftime('%s', 'now'), strftime('%s', 'now'), '0', '0', '0', '0', '0') ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set message = EXCLUDED.message, lastseen = strftime('%s', 'now'), event = EXCLUDED.event;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), message.lower()))
-        self.conn.commit()
-
-    def process_nick_change_old(self, network, nick, ident, host, channel, message):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits) \
-            VALUES (?, ?, ?, ?, ?, 'nicked', ?, strftime('%s', 'now'), strftime('%s', 'now'), '0', '0', '0', '0', '0') ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set message = EXCLUDED.message, lastseen = strftime('%s', 'now'), event = EXCLUDED.event;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), message.lower()))
-        self.conn.commit()
-
-    def process_nick_change_new_account(self, network, nick, ident, host, channel, message, account):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account) \
-            VALUES (?, ?, ?, ?, ?, 'nick', ?, strftime('%s', 'now'), strftime('%s', 'now'), '0', '0', '0', '0', '0', ?) ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set message = EXCLUDED.message, lastseen = strftime('%s', 'now'), event = EXCLUDED.event, account = EXCLUDED.account;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), message.lower(), account.lower()))
-        self.conn.commit()
-
-    def process_nick_change_old_account(self, network, nick, ident, host, channel, message, account):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account) \
-            VALUES (?, ?, ?, ?, ?, 'nicked', ?, strftime('%s', 'now'), strftime('%s', 'now'), '0', '0', '0', '0', '0', ?) ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set message = EXCLUDED.message, lastseen = strftime('%s', 'now'), event = EXCLUDED.event, account = EXCLUDED.account;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), message.lower(), account.lower()))
-        self.conn.commit()
-
-    # Channel messages and notices:
-    # Private messages and notices:
-    # NOTES:
-    # A query will get a '1' in the joins column. Don't bother creating a second process_message for query windows.
-    def process_message(self, network, nick, ident, host, channel, event, message):
-        channel = str(channel).replace("'","''")
-        message = str(message).replace("'","''")
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits) \
-            VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%s', 'now'), strftime('%s', 'now'), '1', '1', '0', '0', '0') ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set event = EXCLUDED.event, message = EXCLUDED.message, lastseen = strftime('%s', 'now'), texts = texts + 1;", \
-            (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower(), event, message))
-        self.conn.commit()
-
-    def process_user(self, network, nick, ident, host, channel):
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, firstseen, lastseen) VALUES (?, ?, ?, ?, ?, strftime('%s', 'now'), strftime('%s', 'now')) ON CONFLICT(network,nick,ident,host,channel) DO UPDATE set lastseen = strftime('%s', 'now') ;", (network.lower(), nick.lower(), ident.lower(), host.lower(), channel.lower()))
-        self.conn.commit()
-
-    def process_whois(self, network, whois_nick, whois_ident, whois_host, whois_account, whois_gecos):
-        gecos = str(whois_gecos).replace("'","''")
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account, gecos) \
-            VALUES (?, ?, ?, ?, '/whois', '', '', strftime('%s', 'now'), strftime('%s', 'now'), '0', '0', '0', '0', '0', ?, ?) ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set account = EXCLUDED.account ,gecos = EXCLUDED.gecos, lastseen = strftime('%s', 'now');", \
-            (network.lower(), whois_nick.lower(), whois_ident.lower(), whois_host.lower(), whois_account.lower(), whois_gecos.lower()))
-        self.conn.commit()
-
-    def process_whowas(self, network, whowas_nick, whowas_ident, whowas_host, whowas_account, whowas_gecos):
-        gecos = str(whowas_gecos).replace("'","''")
-        self.cur.execute("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account, gecos) \
-            VALUES (?, ?, ?, ?, '/whowas', '', '', strftime('%s', 'now'), strftime('%s', 'now'), '0', '0', '0', '0', '0', ?, ?) ON CONFLICT(network,nick,ident,host,channel) \
-            DO UPDATE set account = EXCLUDED.account ,gecos = EXCLUDED.gecos;", \
-            (network.lower(), whowas_nick.lower(), whowas_ident.lower(), whowas_host.lower(), whowas_account.lower(), whowas_gecos.lower()))
-        self.conn.commit()
-
+    # Takes one snapshot of the nick lists in the scope. The rows are written PROCESS_CHUNK at a time by on_tick() so ZNC keeps running.
     def cmd_process(self, scope):
-        self.PutModule("Processing {}.".format(scope))
+        if self.import_job:
+            self.PutModule("Already processing \x02{}\x02 ({} of {} rows). Try again when it is done.".format(self.import_job.scope, self.import_job.done, len(self.import_job.rows)))
+            return
         if scope == 'all':
-            nets = self.GetUser().GetNetworks()
-            for net in nets:
-                chans = net.GetChans()
-                for chan in chans:
-                    nicks = chan.GetNicks()
-                    for nick in nicks.items():
-                        self.process_user(net.GetName(), nick[1].GetNick(), nick[1].GetIdent(), nick[1].GetHost(), chan.GetName())
+            chans = [(net, chan) for net in self.GetUser().GetNetworks() for chan in net.GetChans()]
         elif scope == 'network':
-            chans = self.GetNetwork().GetChans()
-            for chan in chans:
-                nicks = chan.GetNicks()
-                for nick in nicks.items():
-                    self.process_user(self.GetNetwork().GetName(), nick[1].GetNick(), nick[1].GetIdent(), nick[1].GetHost(), chan.GetName())
+            chans = [(self.GetNetwork(), chan) for chan in self.GetNetwork().GetChans()]
         else:
-            nicks = self.GetNetwork().FindChan(scope).GetNicks()
-            for nick in nicks.items():
-                self.process_user(self.GetNetwork().GetName(), nick[1].GetNick(), nick[1].GetIdent(), nick[1].GetHost(), scope)
-        self.PutModule("{} processed.".format(scope))
-
-    def cmd_history(self, type, user, deep):
+            chans = [(self.GetNetwork(), self.GetNetwork().FindChan(scope))]
+        fields = EVENT_FIELDS["process"]
+        rows = []
+        for net, chan in chans:
+            network = net.GetName()
+            channel = chan.GetName()
+            for name, nick in chan.GetNicks().items():
+                rows.append(fields(AkaEvent("process", network, nick.GetNick(), nick.GetIdent(), nick.GetHost(), channel)))
+        self.import_job = AkaImport(scope, rows)
+        self.PutModule("Processing \x02{}\x02: {} rows in {} channel(s).".format(scope, len(rows), len(chans)))
+        self.run_import()
+
+    # One chunk of the running process job, written with executemany() in a single transaction.
+    def run_import(self):
+        job = self.import_job
+        if job.done < len(job.rows):
+            size = self.settings['PROCESS_CHUNK']
+            sql = event_statement("process")
+            if self.writer_thread:
+                # Never take more than the writer queue has room for, the rest waits for the next tick.
+                size = min(size, self.writer_thread.queue.maxsize - self.writer_thread.queue.qsize())
+                for row in job.rows[job.done:job.done+size]:
+                    self.writer_thread.put(sql, row, USER_DIMS)
+            else:
+                for row in job.rows[job.done:job.done+size]:
+                    self.writer.add(sql, row, USER_DIMS)
+                self.flush_writes()
+            job.done = min(job.done + size, len(job.rows))
+            if job.done >= len(job.rows) and self.writer_thread:
+                job.waiting = (self.writer_thread, self.writer_thread.queued)
+        elapsed = time.time() - job.started
+        # A writer thread that was stopped since has written everything it had queued.
+        thread, queued = job.waiting or (None, 0)
+        if thread is self.writer_thread and thread and thread.applied + thread.errors < queued:
+            return
+        if job.done >= len(job.rows):
+            self.import_job = None
+            self.PutModule("\x02{}\x02 processed: {} rows in {:.2f}s ({:.0f} rows/sec).".format(job.scope, job.done, elapsed, job.done / max(elapsed, 0.001)))
+        elif time.time() - job.reported >= 5:
+            job.reported = time.time()
+            self.PutModule("Processing \x02{}\x02: {} of {} rows ({:.0f}%), {:.0f} rows/sec.".format(job.scope, job.done, len(job.rows), 100.0 * job.done / len(job.rows), job.done / max(elapsed, 0.001)))
+
+    def cmd_history(self, type, user, deep, geo=False):
         user_query = self.generate_user_query(type, user)
+        network = self.GetNetwork().GetName().lower()
         self.PutModule("Looking up \x02history\x02 for \x02{}\x02, please be patient...".format(user.lower()))
-        if type:
-            thing = type
-            self.cur.execute("SELECT DISTINCT nick, ident, host FROM users WHERE network = '{0}' AND ({1});".format(self.GetNetwork().GetName().lower(), re.sub(r'([\[\]])', '[\\1]', user_query)))
-            data = self.cur.fetchall()
-            nicks = set(); idents = set(); hosts = set();
-            if len(data) > 0:
-                for row in data:
-                    if thing == "nick":
-                        nicks.add("nick = '" + row[0] + "'")
-                        self.cur.execute("SELECT DISTINCT nick, ident, host FROM users WHERE network = '{}' AND ({})".format(self.GetNetwork().GetName().lower(), ' '.join(nicks)))
-                    if thing == "ident":
-                        idents.add("ident = '" + row[1] + "'")
-                        self.cur.execute("SELECT DISTINCT nick, ident, host FROM users WHERE network = '{}' AND ({})".format(self.GetNetwork().GetName().lower(), ' '.join(idents)))
-                    if thing == "host":
-                        hosts.add("host = '" + row[2] + "'")
-                        self.cur.execute("SELECT DISTINCT nick, ident, host FROM users WHERE network = '{}' AND ({})".format(self.GetNetwork().GetName().lower(), ' '.join(hosts)))
-                data = self.cur.fetchall()
-                nicks.clear(); idents.clear(); hosts.clear()
-                for row in data:
-                    if deep:
-                        nicks.add(row[0]); idents.add(row[1]); hosts.add(row[2]);
-                        self.cur.execute("SELECT DISTINCT nick, ident, host FROM users WHERE network = '{0}' AND (nick GLOB '{1}' OR ident GLOB '{2}' OR host GLOB '{3}');".format(self.GetNetwork().GetName().lower(), re.sub(r'([\[\]])', '[\\1]', row[0]), re.sub(r'([\[\]])', '[\\1]', row[1]), re.sub(r'([\[\]])', '[\\1]', row[2])))
-                        data_inner = self.cur.fetchall()
-                        for row_inner in data_inner:
-                            nicks.add(row_inner[0]); idents.add(row_inner[1]); hosts.add(row_inner[2]);
-                    else:
-                        nicks.add(row[0]); idents.add(row[1]); hosts.add(row[2]);
-                self.display_results(nicks, idents, hosts)
-                self.PutModule("History for {} \x02complete\x02.".format(user.lower()))
+        start = time.time()
+        seeds = self.query("SELECT DISTINCT nick, ident, host FROM users WHERE network = '{0}' AND ({1});".format(network, re.sub(r'([\[\]])', '[\\1]', user_query))).fetchall()
+        if len(seeds) > 0:
+            if deep:
+                rows, depth, truncated = self.expand_identities(network, seeds, ('nick', 'ident', 'host'), self.settings['HISTORY_DEPTH'], self.settings['HISTORY_MAX_NODES'])
+            elif type == 'account':
+                # The account already ties the rows together, --deep expands from them.
+                rows, depth, truncated = set(seeds), 0, False
+            elif type:
+                rows, depth, truncated = self.expand_identities(network, seeds, (type,), 1, self.settings['HISTORY_MAX_NODES'])
             else:
-                self.PutModule("No history found for \x02{}\x02".format(user.lower()))
-        else:
-
-            self.cur.execute("SELECT DISTINCT nick, host FROM users WHERE network = '{0}' AND ({1});".format(self.GetNetwork().GetName().lower(), re.sub(r'([\[\]])', '[\\1]', user_query)))
-            data = self.cur.fetchall()
+                rows, depth, truncated = self.expand_identities(network, seeds, ('nick', 'host'), 1, self.settings['HISTORY_MAX_NODES'])
             nicks = set(); idents = set(); hosts = set();
-            if len(data) > 0:
-                for row in data:
-                    nicks.add("nick = '" + row[0] + "' OR"); hosts.add("host = '" + row[1] + "' OR");
-                self.cur.execute("SELECT DISTINCT nick, ident, host FROM users WHERE network = '{}' AND ({} {})".format(self.GetNetwork().GetName().lower(), ' '.join(nicks), ' '.join(hosts)[:-3]))
-                data = self.cur.fetchall()
-                nicks.clear(); hosts.clear()
-                for row in data:
-                    if deep:
-                        nicks.add(row[0]); idents.add(row[1]); hosts.add(row[2]);
-                        self.cur.execute("SELECT DISTINCT nick, ident, host FROM users WHERE network = '{0}' AND (nick GLOB '{1}' OR ident GLOB '{2}' OR host GLOB '{3}');".format(self.GetNetwork().GetName().lower(), re.sub(r'([\[\]])', '[\\1]', row[0]), re.sub(r'([\[\]])', '[\\1]', row[1]), re.sub(r'([\[\]])', '[\\1]', row[2])))
-                        data_inner = self.cur.fetchall()
-                        for row_inner in data_inner:
-                            nicks.add(row_inner[0]); idents.add(row_inner[1]); hosts.add(row_inner[2]);
-                    else:
-                        nicks.add(row[0]); idents.add(row[1]); hosts.add(row[2]);
-                self.display_results(nicks, idents, hosts)
-                self.PutModule("History for {} \x02complete\x02.".format(user.lower()))
-            else:
-                self.PutModule("No history found for \x02{}\x02".format(user.lower()))
-
+            for row in rows:
+                nicks.add(row[0]); idents.add(row[1]); hosts.add(row[2]);
+            if geo:
+                self.geo_hosts(hosts)
+            tail = []
+            if truncated:
+                tail.append("Stopped after \x02{}\x02 nicks, idents, and hosts (HISTORY_MAX_NODES).".format(self.settings['HISTORY_MAX_NODES']))
+            tail.append("History for {} \x02complete\x02. ({} identities, {} level(s), {:.2f}s)".format(user.lower(), len(rows), depth, time.time() - start))
+            self.page(itertools.chain(self.display_results(nicks, idents, hosts), tail))
+        else:
+            self.PutModule("No history found for \x02{}\x02".format(user.lower()))
+
+    # Breadth first expansion of the identity graph. Every nick, ident, and host is a node and each (nick, ident, host) row links its three values.
+    # A level runs one set based query per edge type for everything found on the previous level instead of one query per row.
+    # Stops after `depth` levels or once `cap` nodes have been found. Returns the rows, the number of levels run, and whether the cap was hit.
+    def expand_identities(self, network, seeds, edges, depth, cap):
+        columns = {'nick': 0, 'ident': 1, 'host': 2}
+        rows = set(); nodes = set(); visited = set();
+        frontier = set(); truncated = False
+        for row in seeds:
+            rows.add(row)
+            for edge in edges:
+                frontier.add((edge, row[columns[edge]]))
+        for row in rows:
+            nodes.update(zip(('nick', 'ident', 'host'), row))
+        level = 0
+        while level < depth and frontier and not truncated:
+            level += 1
+            visited.update(frontier)
+            found = set()
+            for edge in edges:
+                values = sorted(value for kind, value in frontier if kind == edge)
+                # Stay well below SQLITE_MAX_VARIABLE_NUMBER. Matching on the id table keeps a long list on the
+                # (network_id, <edge>_id) index, the users view stops using it past a few hundred values.
+                for index in range(0, len(values), 500):
+                    chunk = values[index:index+500]
+                    found.update(self.query("SELECT k.value, i.value, h.value FROM (SELECT DISTINCT nick_id, ident_id, host_id FROM user_records \
+                        WHERE network_id = (SELECT id FROM network_ids WHERE value = ?) AND {0}_id IN (SELECT id FROM {0}_ids WHERE value IN ({1}))) r \
+                        JOIN nick_ids k ON k.id = r.nick_id JOIN ident_ids i ON i.id = r.ident_id JOIN host_ids h ON h.id = r.host_id;".format(edge, ', '.join('?' * len(chunk))), [network] + chunk).fetchall())
+            frontier = set()
+            for row in found - rows:
+                if len(nodes) >= cap:
+                    truncated = True
+                    break
+                rows.add(row)
+                nodes.update(zip(('nick', 'ident', 'host'), row))
+                for edge in edges:
+                    if (edge, row[columns[edge]]) not in visited:
+                        frontier.add((edge, row[columns[edge]]))
+        return rows, level, truncated
+
+    # Geolocates every usable host from a history lookup. Answers that are not cached yet arrive after the history output.
+    def geo_hosts(self, hosts):
+        located = 0
+        for host in sorted(hosts):
+            ip = geo_address(host)
+            if ip:
+                located += 1
+                self.geo_lookup(ip, "\x02{}\x02".format(host), host, True)
+        self.PutModule("Geolocating \x02{}\x02 of \x02{}\x02 host(s).".format(located, len(hosts)))
+
+    # Yields the lines for `page()`, 100 values per line.
     def display_results(self, nicks, idents, hosts):
-        nicks = sorted(list(nicks)); idents = sorted(list(idents)); hosts = sorted(list(hosts));
         size = 100
-        index = 0
-        while index < len(nicks):
-            self.PutModule("\x02Nick(s):\x02 " + ', '.join(nicks[index:index+size]))
-            index += size
-        index = 0
-        while index < len(idents):
-            self.PutModule("\x02Ident(s):\x02 " + ', '.join(idents[index:index+size]))
-            index += size
-        index = 0
-        while index < len(hosts):
-            self.PutModule("\x02Host(s):\x02 " + ', '.join(hosts[index:index+size]))
-            index += size
+        for label, values in (("Nick(s)", nicks), ("Ident(s)", idents), ("Host(s)", hosts)):
+            values = sorted(values)
+            for index in range(0, len(values), size):
+                yield "\x02{}:\x02 ".format(label) + ', '.join(values[index:index+size])
 
+    # A nick that is online is answered from the presence index once it joined or did something while we were there.
+    # Users we only know from a NAMES or WHO reply have no last event and are looked up in the database.
     def cmd_seen(self, type, user, channel):
-        user_query = self.generate_user_query(type, user)
-        if channel:
-            self.cur.execute("SELECT nick, ident, host, channel, event, message, MAX(lastseen) FROM (SELECT * from users WHERE message IS NOT NULL) WHERE network = '{0}' AND channel = '{1}' AND ({2});".format(self.GetNetwork().GetName().lower(), channel.lower(), re.sub(r'([\[\]])', '[\\1]', user_query)))
-
+        present = None
+        if type in (None, 'nick') and not any(char in user for char in '*?['):
+            present = self.presence().get(user)
+        if present and present.last and (not channel or present.last[0] == channel.lower()):
+            data = (user.lower(), present.ident, present.host) + present.last
         else:
-            self.cur.execute("SELECT nick, ident, host, channel, event, message, MAX(lastseen) FROM (SELECT * from users WHERE message IS NOT NULL) \
-                 WHERE network = '{0}' AND ({1});".format(self.GetNetwork().GetName().lower(), re.sub(r'([\[\]])', '[\\1]', user_query)))
-        data = self.cur.fetchone()
+            data = self.cmd_seen_query(type, user, channel)
         try:
             self.PutModule("\x02{}\x02 ({}@{}) was last seen in \x02{}\x02 at \x02{}\x02 doing \x02{}\x02: \"{}\"."\
                 .format(data[0], data[1], data[2],str(data[3]).replace("''","'"), datetime.datetime.fromtimestamp(int(data[6])).strftime('%Y-%m-%d %H:%M:%S'), data[4], str(data[5]).replace("''","'")))
@@ -538,135 +1778,642 @@ class aka(znc.Module):
                 self.PutModule("\x02{}\x02 has \x02\x034not\x03\x02 been seen in \x02{}\x02.".format(user.lower(), channel.lower()))
             else:
                 self.PutModule("\x02{}\x02 has \x02\x034not\x03\x02 been seen.".format(user.lower()))
+        if present:
+            self.PutModule("\x02{}\x02 is \x02online\x02 in: {}".format(user.lower(), ', '.join(sorted(present.channels))))
 
-    def cmd_users(self, type, user):
+    def cmd_seen_query(self, type, user, channel):
         user_query = self.generate_user_query(type, user)
-        self.cur.execute("SELECT DISTINCT nick, host, ident FROM users WHERE network = '{0}' AND ({1});".format(self.GetNetwork().GetName().lower(), re.sub(r'([\[\]])', '[\\1]', user_query)))
-        data = self.cur.fetchall()
-        chans = set()
-        for row in data:
-            chans.add(row[0])
-        self.PutModule("\x02{}\x02 has been seen in \x02channels\x02: {}".format(user.lower(), ', '.join(sorted(chans))))
+        if channel:
+            self.query("SELECT nick, ident, host, channel, event, message, MAX(lastseen) FROM (SELECT * from users WHERE message IS NOT NULL) WHERE network = '{0}' AND channel = '{1}' AND ({2});".format(self.GetNetwork().GetName().lower(), channel.lower(), re.sub(r'([\[\]])', '[\\1]', user_query)))
 
-    def cmd_channels(self, type, users):
-        chan_lists = []
-        for user in users:
+        else:
+            self.query("SELECT nick, ident, host, channel, event, message, MAX(lastseen) FROM (SELECT * from users WHERE message IS NOT NULL) \
+                 WHERE network = '{0}' AND ({1});".format(self.GetNetwork().GetName().lower(), re.sub(r'([\[\]])', '[\\1]', user_query)))
+        return self.rcur.fetchone()
+
+    # Newest journal events first, printed oldest to newest. Only covers the last JOURNAL_RETENTION days.
+    def cmd_timeline(self, type, user):
+        if type:
             user_query = self.generate_user_query(type, user)
-            chans = []
-            self.cur.execute("SELECT DISTINCT channel FROM users WHERE network = '{0}' AND ({1});".format(self.GetNetwork().GetName().lower(), re.sub(r'([\[\]])', '[\\1]', user_query)))
-            data = self.cur.fetchall()
-            for row in data:
-                chans.append(row[0])
-            chan_lists.append(chans)
-        shared_chans = set(chan_lists[0])
-        for chan in chan_lists[1:]:
-            shared_chans.intersection_update(chan)
-        self.PutModule("Common \x02channels\x02 for \x02{}:\x02 {}".format(', '.join(users), ', '.join(sorted(shared_chans))))
-
-    def cmd_users(self, channels):
-        nick_lists = []; ident_lists = []; host_lists = [];
-        for channel in channels:
-            nicks = []; idents = []; hosts = [];
-            self.cur.execute("SELECT DISTINCT nick, ident, host FROM users WHERE network = '{}' AND channel = '{}';".format(self.GetNetwork().GetName().lower(), channel.lower()))
-            data = self.cur.fetchall()
-            for row in data:
-                nicks.append(row[0]); idents.append(row[1]); hosts.append(row[2]);
-            nick_lists.append(nicks); ident_lists.append(idents); host_lists.append(hosts);
-        nicks = set(nick_lists[0]); idents = set(ident_lists[0]); hosts = set(host_lists[0]);
-        for nick in nick_lists[1:]:
-            nicks.intersection_update(nick)
-        for ident in ident_lists[1:]:
-            idents.intersection_update(ident)
-        for host in host_lists[1:]:
-            hosts.intersection_update(host)
-        self.PutModule("Common \x02users\x02 for \x02{}:\x02".format(', '.join(channels)))
-        self.display_results(nicks, idents, hosts)
-
-    def cmd_compare_users(self, type, users):
-        self.PutModule("Users compared.")
+        else:
+            user_query = ' OR '.join(self.generate_user_query(kind, user) for kind in ('nick', 'ident', 'host'))
+        self.query("SELECT time, nick, ident, host, channel, event, message FROM journal WHERE network_id = (SELECT id FROM network_ids WHERE value = ?) AND ({0}) ORDER BY id DESC LIMIT 50;".format(re.sub(r'([\[\]])', '[\\1]', user_query)), (self.GetNetwork().GetName().lower(),))
+        data = self.rcur.fetchall()
+        if len(data) > 0:
+            for time, nick, ident, host, channel, event, message in reversed(data):
+                self.PutModule("\x02{}\x02 \x02{}\x02 ({}@{}) in \x02{}\x02 {}{}".format(datetime.datetime.fromtimestamp(time).strftime('%Y-%m-%d %H:%M:%S'), nick, ident, host, str(channel).replace("''","'"), event, ": \"{}\"".format(str(message).replace("''","'")) if message else ''))
+            self.PutModule("Timeline for {} \x02complete\x02. ({} events)".format(user.lower(), len(data)))
+        elif not self.settings['JOURNAL']:
+            self.PutModule("No timeline found for \x02{}\x02. JOURNAL is disabled.".format(user.lower()))
+        else:
+            self.PutModule("No timeline found for \x02{}\x02".format(user.lower()))
+
+    # Plain terms are quoted so punctuation in a spam signature is not read as FTS5 syntax, a trailing * keeps prefix matching.
+    # --raw passes the terms through as an FTS5 query (column filters, OR, NOT, NEAR). --all searches every network.
+    def cmd_search(self, args):
+        if not self.settings['SEARCH_INDEX']:
+            self.PutModule("SEARCH_INDEX IS CURRENTLY DISABLED")
+            return
+        if "--rebuild" in args:
+            if self.compacting:
+                self.PutModule("Wait for \x02compact\x02 to finish first.")
+                return
+            with self.write_lock:
+                self.search_drop()
+                self.search_create()
+            return
+        flags = [arg for arg in args if arg.startswith('--')]
+        terms = [arg for arg in args if not arg.startswith('--')]
+        if not terms:
+            raise ValueError("no terms")
+        if "--raw" in flags:
+            match = ' '.join(terms)
+        else:
+            match = ' '.join('"{}"{}'.format(term.rstrip('*').replace('"', '""'), '*' if term.endswith('*') else '') for term in terms)
+        sql = "SELECT u.network, u.nick, u.ident, u.host, u.channel, u.lastseen, highlight(user_search, 0, '\x02', '\x02'), highlight(user_search, 1, '\x02', '\x02'), \
+            highlight(user_search, 2, '\x02', '\x02') FROM user_search JOIN users u ON u.id = user_search.rowid WHERE user_search MATCH ?"
+        params = [match]
+        if "--all" not in flags:
+            sql += " AND u.network_id = (SELECT id FROM network_ids WHERE value = ?)"
+            params.append(self.GetNetwork().GetName().lower())
+        if self.search_run:
+            self.PutModule("The search index is being rebuilt, results may be incomplete.")
+        conn = self.page_connection()
+        self.page(self.search_lines(conn, sql + " ORDER BY rank;", params, ' '.join(terms), "--all" in flags), conn)
+
+    def search_lines(self, conn, sql, params, terms, everywhere):
+        cursor = perf_cursor(conn, self.perf)
+        count = 0
+        try:
+            for network, nick, ident, host, channel, lastseen, gecos, account, message in self.query(sql, params, cursor):
+                count += 1
+                fields = ["{}: {}".format(name, value) for name, value in (("gecos", gecos), ("account", account), ("message", message)) if value]
+                yield "\x02{}\x02!{}@{} in \x02{}\x02{} on {}: {}".format(nick, ident, host, str(channel).replace("''","'"), " ({})".format(network) if everywhere else '',
+                    datetime.datetime.fromtimestamp(lastseen).strftime('%Y-%m-%d %H:%M:%S'), ', '.join(fields))
+        except sqlite3.Error as e:
+            yield 'Error: %s' % e
+            return
+        finally:
+            cursor.close()
+        if count:
+            yield "Search for \x02{}\x02 \x02complete\x02. ({} results)".format(terms, count)
+        else:
+            yield "No results for \x02{}\x02".format(terms)
 
-    def cmd_geo(self, type, user):
-        user_query = self.generate_user_query(type, user)
+    def search_exists(self):
+        return self.cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_search';").fetchone() is not None
+
+    # Full text index of gecos, account, and last message, one row per user_records row with the same rowid. Kept current by
+    # triggers, so every write path updates it. Existing rows are added by run_search() SEARCH_BATCH at a time. The triggers
+    # delete and insert instead of INSERT OR REPLACE, a trigger takes the conflict handling of the upsert that fired it.
+    def search_create(self):
+        try:
+            self.cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(gecos, account, message);")
+        except sqlite3.OperationalError as e:
+            self.PutModule("\x02\x034Search index not created\x03\x02: {}. Setting SEARCH_INDEX to FALSE.".format(e))
+            self.SetNV('SEARCH_INDEX', "FALSE")
+            self.settings['SEARCH_INDEX'] = False
+            return
+        self.cur.execute("CREATE TRIGGER IF NOT EXISTS user_records_search_insert AFTER INSERT ON user_records \
+            WHEN COALESCE(NEW.gecos, NEW.account, NULLIF(NEW.message, '')) IS NOT NULL BEGIN \
+            DELETE FROM user_search WHERE rowid = NEW.id; \
+            INSERT INTO user_search (rowid, gecos, account, message) VALUES (NEW.id, NEW.gecos, NEW.account, NEW.message); \
+            END;")
+        self.cur.execute("CREATE TRIGGER IF NOT EXISTS user_records_search_update AFTER UPDATE OF gecos, account, message ON user_records \
+            WHEN NEW.gecos IS NOT OLD.gecos OR NEW.account IS NOT OLD.account OR NEW.message IS NOT OLD.message BEGIN \
+            DELETE FROM user_search WHERE rowid = NEW.id; \
+            INSERT INTO user_search (rowid, gecos, account, message) VALUES (NEW.id, NEW.gecos, NEW.account, NEW.message); \
+            END;")
+        self.cur.execute("CREATE TRIGGER IF NOT EXISTS user_records_search_delete AFTER DELETE ON user_records BEGIN \
+            DELETE FROM user_search WHERE rowid = OLD.id; \
+            END;")
+        self.conn.commit()
+        self.search_run = [0, 0, time.time()]
+        self.PutModule("Building the search index in the background, {} rows per second.".format(self.settings['SEARCH_BATCH']))
 
-        ipv4 = re.compile(r"(?:[0-9]{1,3}(\.|\-)){3}[0-9]{1,3}")
-        ipv6 = re.compile("^((?:[0-9A-Fa-f]{1,4}))((?::[0-9A-Fa-f]{1,4}))*::((?:[0-9A-Fa-f]{1,4}))"
-                          "((?::[0-9A-Fa-f]{1,4}))*|((?:[0-9A-Fa-f]{1,4}))((?::[0-9A-Fa-f]{1,4})){7}$")
+    def search_drop(self):
+        for trigger in ("insert", "update", "delete"):
+            self.cur.execute("DROP TRIGGER IF EXISTS user_records_search_{};".format(trigger))
+        self.cur.execute("DROP TABLE IF EXISTS user_search;")
+        self.conn.commit()
+        self.search_run = None
+
+    # One step of the search index build, called from on_tick(). Rows are added in id order. A row the triggers already
+    # indexed is replaced with the same values, so events written during the build are never lost or doubled.
+    def run_search(self):
+        run = self.search_run
+        end = self.cur.execute("SELECT id FROM user_records WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?;", (run[0], self.settings['SEARCH_BATCH'] - 1)).fetchone()
+        sql = "INSERT OR REPLACE INTO user_search (rowid, gecos, account, message) SELECT id, gecos, account, message FROM user_records \
+            WHERE id > ? AND COALESCE(gecos, account, NULLIF(message, '')) IS NOT NULL"
+        params = [run[0]]
+        if end:
+            sql += " AND id <= ?"
+            params.append(end[0])
+        run[1] += self.cur.execute(sql + ";", params).rowcount
+        self.conn.commit()
+        if end:
+            run[0] = end[0]
+            return
+        self.search_run = None
+        self.PutModule("Search index built, {} rows in {:.1f}s.".format(run[1], time.time() - run[2]))
+
+    # Channels all of the included users were seen in (any of them with --any) and none of the excluded ones, answered by one
+    # query. With --since only records seen in that window count, for the excluded users too. The unary + keeps the planner
+    # on the user and channel indexes, the lastseen index would read the whole window.
+    def cmd_channels(self, type, users, online=False, any=False, since=None):
+        included, excluded = [user for user in users if not user.startswith('-')], [user[1:] for user in users if user.startswith('-')]
+        if online:
+            self.cmd_channels_online(type, included, excluded, any)
+            return
+        network = "network_id = (SELECT id FROM network_ids WHERE value = '{0}')".format(self.GetNetwork().GetName().lower().replace("'", "''"))
+        window = " AND +lastseen >= {}".format(int(time.time()) - since) if since else ""
+        conditions = ["({})".format(re.sub(r'([\[\]])', '[\\1]', self.generate_user_query(type, user))) for user in included]
+        sql = " UNION ALL ".join("SELECT channel_id, {0} AS member FROM user_records WHERE {1} AND {2}{3}".format(index, network, condition, window) for index, condition in enumerate(conditions))
+        sql = "SELECT channel_id FROM ({0}) GROUP BY channel_id{1}".format(sql, "" if any else " HAVING COUNT(DISTINCT member) = {}".format(len(conditions)))
+        for user in excluded:
+            sql += " EXCEPT SELECT channel_id FROM user_records WHERE {0} AND ({1}){2}".format(network, re.sub(r'([\[\]])', '[\\1]', self.generate_user_query(type, user)), window)
+        shared_chans = [row[0] for row in self.query("SELECT value FROM channel_ids WHERE id IN ({}) ORDER BY value;".format(sql)).fetchall()]
+        self.PutModule("{} \x02channels\x02{} for \x02{}:\x02 {}".format("Any" if any else "Common", self.since_label(since), ', '.join(users), ', '.join(shared_chans)))
+
+    # Same as `channels` but only the channels the users are in right now, answered from the presence index.
+    def cmd_channels_online(self, type, users, excluded=(), any=False):
+        presence = self.presence()
+        shared_chans = None
+        for user in users:
+            chans = set()
+            for present in presence.match(type, user):
+                chans.update(present.channels)
+            if shared_chans is None:
+                shared_chans = chans
+            elif any:
+                shared_chans.update(chans)
+            else:
+                shared_chans.intersection_update(chans)
+        for user in excluded:
+            for present in presence.match(type, user):
+                shared_chans.difference_update(present.channels)
+        self.PutModule("{} \x02channels\x02 (online) for \x02{}:\x02 {}".format("Any" if any else "Common", ', '.join(users + ['-' + user for user in excluded]), ', '.join(sorted(shared_chans))))
+
+    # Nicks, idents, and hosts seen in all of the included channels (any of them with --any) and none of the excluded ones.
+    # Each is grouped and counted per channel by SQLite on the network/channel index, only the answer is read back.
+    def cmd_users(self, channels, any=False, since=None):
+        included = sorted(set(channel.lower() for channel in channels if not channel.startswith('-')))
+        excluded = sorted(set(channel[1:].lower() for channel in channels if channel.startswith('-')))
+        if not included:
+            self.PutModule("You must specify at least one channel.")
+            return
+        network = self.GetNetwork().GetName().lower()
+        # The unary + keeps the planner on the channel index. Without it, it reads the whole network in id order to skip the
+        # GROUP BY sort, or the whole window off the lastseen index.
+        window = " AND +lastseen >= ?" if since else ""
+        selects = []
+        params = []
+        for kind in ("nick", "ident", "host"):
+            select = "SELECT {0}_id FROM user_records WHERE network_id = (SELECT id FROM network_ids WHERE value = ?) \
+                AND channel_id IN (SELECT id FROM channel_ids WHERE value IN ({1})){2}".format(kind, ', '.join('?' * len(included)), window)
+            params += [network] + included + ([int(time.time()) - since] if since else [])
+            if any:
+                select += " GROUP BY +{}_id".format(kind)
+            else:
+                select += " GROUP BY +{0}_id HAVING COUNT(DISTINCT channel_id) = {1}".format(kind, len(included))
+            if excluded:
+                select += " EXCEPT SELECT {0}_id FROM user_records WHERE network_id = (SELECT id FROM network_ids WHERE value = ?) \
+                    AND channel_id IN (SELECT id FROM channel_ids WHERE value IN ({1})){2}".format(kind, ', '.join('?' * len(excluded)), window)
+                params += [network] + excluded + ([int(time.time()) - since] if since else [])
+            selects.append("SELECT '{0}', value FROM {0}_ids WHERE id IN ({1})".format(kind, select))
+        found = {"nick": [], "ident": [], "host": []}
+        for kind, value in self.query(" UNION ALL ".join(selects) + ";", params).fetchall():
+            found[kind].append(value)
+        self.PutModule("{} \x02users\x02{} for \x02{}:\x02".format("Any" if any else "Common", self.since_label(since), ', '.join(channels)))
+        self.page(self.display_results(found["nick"], found["ident"], found["host"]))
+
+    def since_label(self, since):
+        return " seen in the last \x02{}\x02".format(format_duration(since)) if since else ""
 
-        rdns = re.compile(r"^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*"
-                          r"([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$")
+    def cmd_geo(self, type, user):
+        user_query = self.generate_user_query(type, user)
 
-        if (re.search(ipv6, str(user)) or re.search(ipv4, str(user)) or (re.search(rdns, str(user)) and '.' in str(user))):
+        if geo_address(user):
             host = user
 
-        self.cur.execute("SELECT host, nick, ident FROM users WHERE network = '{0}' AND ({1}) ORDER BY time DESC;".format(self.GetNetwork().GetName().lower(), re.sub(r'([\[\]])', '[\\1]', user_query)))
-        data = self.cur.fetchall()
+        self.query("SELECT host, nick, ident FROM users WHERE network = '{0}' AND ({1}) ORDER BY lastseen DESC;".format(self.GetNetwork().GetName().lower(), re.sub(r'([\[\]])', '[\\1]', user_query)))
+        data = self.rcur.fetchall()
         for row in data:
-            if (re.search(ipv6, str(row[0])) or re.search(ipv4, str(row[0])) or (re.search(rdns, str(row[0])) and '.' in str(row[0]))):
+            if geo_address(row[0]):
                 host = row[0]
                 nick = row[1]
                 ident = row[2]
                 break
         try:
-            if re.search(ipv4, str(host)):
-                ip = re.sub('[^\w.]',".",((re.search(ipv4, str(host))).group(0)))
-            elif re.search(ipv6, str(host)) or re.search(rdns, str(host)):
-                ip = str(host)
-            url = 'http://ip-api.com/json/' + ip + '?fields=country,regionName,city,lat,lon,timezone,mobile,proxy,query,reverse,status,message'
-            loc = requests.get(url)
-            loc_json = loc.json()
-
-            if loc_json["status"] != "fail":
-                try:
-                    user = "\x02{}\x02 ({}@{})".format(nick.lower(), ident.lower(), host.lower())
-                except:
-                    user = "\x02{}\x02 (no matching user)".format(user.lower())
-                self.PutModule("{} is located in \x02{}, {}, {}\x02 ({}, {}) / Timezone: {} / Proxy: {} / Mobile: {} / IP: {} / rDNS: {}".format(user, loc_json["city"], loc_json["regionName"], loc_json["country"], loc_json["lat"], loc_json["lon"], loc_json["timezone"], loc_json["proxy"], loc_json["mobile"], loc_json["query"], loc_json["reverse"]))
-            else:
-                self.PutModule("\x02\x034Unable to geolocate\x03\x02 user \x02{}\x02. (Reason: {})".format(user.lower(), loc_json["message"]))
+            ip = geo_address(host)
+            try:
+                label = "\x02{}\x02 ({}@{})".format(nick.lower(), ident.lower(), host.lower())
+            except:
+                label = "\x02{}\x02 (no matching user)".format(user.lower())
+            self.geo_lookup(ip, label, user.lower())
         except:
             self.PutModule("\x02\x034No valid host\x03\x02 for user \x02{}\x02".format(user.lower()))
 
+    # Answers come from the in-memory LRU, then the geo_cache table, and only then from the provider on the geo thread.
+    # Requests for an IP that is already being looked up wait for the same answer.
+    def geo_lookup(self, ip, label, user, quiet=False):
+        ip = ip.lower()
+        data = self.geo_cached(ip)
+        if data is not None:
+            self.geo_hits += 1
+            self.geo_report(label, user, data)
+            return
+        self.geo_misses += 1
+        if ip in self.geo_pending:
+            self.geo_pending[ip].append((label, user))
+            return
+        self.geo_pending[ip] = [(label, user)]
+        if not quiet:
+            self.PutModule("Geolocating \x02{}\x02...".format(user))
+        if not self.geo_thread:
+            self.geo_thread = AkaGeoThread(self.settings['GEO_PROVIDER'], self.settings['GEO_URL'], self.geo_path())
+            self.geo_thread.start()
+        self.geo_thread.requests.put(ip)
+
+    # Only HTTP answers go to the geo_cache table, the range file is as fast as the table and is always current.
+    def geo_cached(self, ip):
+        now = time.time()
+        if ip in self.geo_cache:
+            expires, data = self.geo_cache[ip]
+            if expires > now:
+                self.geo_cache.move_to_end(ip)
+                return data
+            del self.geo_cache[ip]
+        if self.settings['GEO_PROVIDER'] != "HTTP":
+            return None
+        row = self.query("SELECT data, expires FROM geo_cache WHERE ip = ? AND expires > ?;", (ip, int(now))).fetchone()
+        if row:
+            data = json.loads(row[0])
+            self.geo_remember(ip, row[1], data)
+            return data
+        return None
+
+    def geo_remember(self, ip, expires, data):
+        self.geo_cache[ip] = (expires, data)
+        self.geo_cache.move_to_end(ip)
+        while len(self.geo_cache) > self.settings['GEO_CACHE_SIZE']:
+            self.geo_cache.popitem(last=False)
+
+    # Called from on_tick() with whatever the geo thread has finished. Failed answers are cached for GEO_NEGATIVE_TTL, errors are not cached.
+    def geo_results(self):
+        while True:
+            try:
+                ip, data, error = self.geo_thread.results.get_nowait()
+            except queue.Empty:
+                break
+            waiting = self.geo_pending.pop(ip, [])
+            if data is not None:
+                failed = data.get("status") == "fail"
+                expires = int(time.time()) + (self.settings['GEO_NEGATIVE_TTL'] if failed else self.settings['GEO_TTL'])
+                self.geo_remember(ip, expires, data)
+                if self.settings['GEO_PROVIDER'] == "HTTP":
+                    self.write("INSERT OR REPLACE INTO geo_cache (ip, data, failed, expires) VALUES (?, ?, ?, ?);", (ip, json.dumps(data), int(failed), expires))
+            for label, user in waiting:
+                if data is not None:
+                    self.geo_report(label, user, data)
+                else:
+                    self.PutModule("\x02\x034Unable to geolocate\x03\x02 user \x02{}\x02. (Reason: {})".format(user, error))
+
+    def geo_path(self):
+        return os.path.join(self.GetSavePath(), self.settings['GEO_FILE'])
+
+    def geo_report(self, label, user, loc_json):
+        if loc_json.get("status") != "fail":
+            self.PutModule("{} is located in \x02{}, {}, {}\x02 ({}, {}) / Timezone: {} / Proxy: {} / Mobile: {} / IP: {} / rDNS: {}".format(label, loc_json.get("city"), loc_json.get("regionName"), loc_json.get("country"), loc_json.get("lat"), loc_json.get("lon"), loc_json.get("timezone"), loc_json.get("proxy"), loc_json.get("mobile"), loc_json.get("query"), loc_json.get("reverse")))
+        else:
+            self.PutModule("\x02\x034Unable to geolocate\x03\x02 user \x02{}\x02. (Reason: {})".format(user, loc_json.get("message")))
+
+    # Matches on the id tables so the lookup can use the (network_id, <type>_id) indexes on user_records.
+    # SQLite will not use a different index for each part of an OR on IN subqueries, so without a type the three matches are UNIONed by row id.
     def generate_user_query(self, type, user):
-        if type:
-            query = "{0} GLOB '{1}'".format(type, user.lower())
+        if type == 'host':
+            query = self.generate_host_query(user.lower())
+        elif type == 'account':
+            # '0' (WHOIS/WHOX) and '*' (extended-join) mean not logged in.
+            query = "account GLOB '{0}' AND account NOT IN ('0', '*')".format(user.lower())
+        elif type:
+            query = "{0}_id IN (SELECT id FROM {0}_ids WHERE value GLOB '{1}')".format(type, user.lower())
         else:
-            query = "nick GLOB '{0}' OR ident GLOB '{0}' OR host GLOB '{0}'".format(user.lower())
+            network = "network_id = (SELECT id FROM network_ids WHERE value = '{0}')".format(self.GetNetwork().GetName().lower().replace("'", "''"))
+            query = "id IN (SELECT id FROM user_records WHERE {0} AND nick_id IN (SELECT id FROM nick_ids WHERE value GLOB '{1}') \
+                UNION SELECT id FROM user_records WHERE {0} AND ident_id IN (SELECT id FROM ident_ids WHERE value GLOB '{1}') \
+                UNION SELECT id FROM user_records WHERE {0} AND {2})".format(network, user.lower(), self.generate_host_query(user.lower()))
         return query
 
-    def cmd_stats(self):
-        self.cur.execute("SELECT COUNT(DISTINCT nick), COUNT(DISTINCT ident), COUNT(DISTINCT host), COUNT(DISTINCT channel), COUNT(*) FROM users WHERE network = '{0}';".format(self.GetNetwork().GetName().lower()))
-        data = self.cur.fetchone()
+    # A leading wildcard defeats the host index. Reversing the pattern turns it into a prefix search on the rvalue index.
+    # Brackets are escaped by the callers after this, so they are always literal and reverse safely.
+    def generate_host_query(self, user):
+        if user.startswith('*') and not user.endswith('*'):
+            return "host_id IN (SELECT id FROM host_ids WHERE rvalue GLOB '{0}')".format(user[::-1])
+        return "host_id IN (SELECT id FROM host_ids WHERE value GLOB '{0}')".format(user)
+
+    # The counts come from network_stats, which triggers keep current and AkaStatsThread recounts every STATS_RECONCILE_INTERVAL seconds.
+    def cmd_stats(self, args=()):
+        if "--reconcile" in args:
+            self.stats_reconcile()
+        if "--sizes" in args:
+            self.cmd_stats_sizes()
+            return
+        network = self.GetNetwork().GetName().lower()
+        data = self.query("SELECT nicks, idents, hosts, channels, records FROM network_stats WHERE network_id = (SELECT id FROM network_ids WHERE value = ?);", (network,)).fetchone() or (0,) * 5
         self.PutModule("\x02Nick(s):\x02 {}".format(data[0]))
         self.PutModule("\x02Ident(s):\x02 {}".format(data[1]))
         self.PutModule("\x02Host(s):\x02 {}".format(data[2]))
         self.PutModule("\x02Channel(s):\x02 {}".format(data[3]))
         self.PutModule("\x02Size:\x02 {} MB".format(os.path.getsize(self.GetSavePath() + "/aka.db") >> 20))
         self.PutModule("\x02Total Records:\x02 {}".format(data[4]))
+        today = int(time.time()) // 86400
+        growth = self.query("SELECT IFNULL(SUM(records), 0), MIN(day) FROM network_growth WHERE network_id = (SELECT id FROM network_ids WHERE value = ?) AND day >= ? AND day < ?;", (network, today - 7, today)).fetchone()
+        added = self.query("SELECT records FROM network_growth WHERE network_id = (SELECT id FROM network_ids WHERE value = ?) AND day = ?;", (network, today)).fetchone()
+        if growth[1] is not None:
+            self.PutModule("\x02Growth:\x02 {:.0f} new records/day (last {} days), {} today".format(growth[0] / (today - growth[1]), today - growth[1], added[0] if added else 0))
+        else:
+            self.PutModule("\x02Growth:\x02 {} new records today".format(added[0] if added else 0))
+        if len(self.ingest_samples) > 1:
+            first, last = self.ingest_samples[0], self.ingest_samples[-1]
+            self.PutModule("\x02Ingest:\x02 {:.1f} events/s (last minute), {} events since load".format((last[1] - first[1]) / max(last[0] - first[0], 1), self.ingested))
+        if self.stats_job:
+            self.PutModule("\x02Stats Counters:\x02 recounting, started {:.0f}s ago".format(time.time() - self.stats_job.started))
+        elif self.stats_reconciled:
+            self.PutModule("\x02Stats Counters:\x02 recounted {} in {:.1f}s, {} network(s) corrected".format(datetime.datetime.fromtimestamp(self.stats_reconciled[0]).strftime('%Y-%m-%d %H:%M:%S'), self.stats_reconciled[1], self.stats_reconciled[2]))
+        sizes = dict(self.query("SELECT key, value FROM aka_meta WHERE key IN ('normalize_size_before', 'normalize_size_after');").fetchall())
+        if sizes:
+            self.PutModule("\x02Normalized Storage:\x02 {} KB before, {} KB after".format(sizes['normalize_size_before'] >> 10, sizes['normalize_size_after'] >> 10))
+        self.PutModule("\x02Id Cache:\x02 {} hits, {} misses".format(self.writer.ids.hits, self.writer.ids.misses))
+        if self.writer_thread:
+            writer = self.writer_thread
+            self.PutModule("\x02Writer Queue:\x02 {} / {} queued, {} written, {} dropped, {} failed, {} commits, {:.3f}s lag".format(writer.queue.qsize(), writer.queue.maxsize, writer.applied, writer.dropped, writer.errors, writer.commits, writer.lag))
+        else:
+            self.PutModule("\x02Write Buffer:\x02 {} rows pending, {} commits, {} failed{}".format(self.writer.rows, self.writer.commits, self.writer.failed, " (last error: {})".format(self.writer.error) if self.writer.error else ""))
+        self.PutModule("\x02Geo Cache:\x02 {} hits, {} misses, {} pending".format(self.geo_hits, self.geo_misses, len(self.geo_pending)))
+        if self.geo_thread and self.geo_thread.index:
+            index = self.geo_thread.index
+            self.PutModule("\x02Geo File:\x02 {} ranges, {} locations, loaded in {:.2f}s".format(len(index), len(index.locations), index.load_time))
+        policies = self.query("SELECT COUNT(*) FROM retention;").fetchone()[0]
+        page_size = self.query("PRAGMA page_size;").fetchone()[0]
+        self.PutModule("\x02Retention:\x02 {} policies, {}".format(policies, "every {}s".format(self.settings['RETENTION_INTERVAL']) if self.settings['ENABLE_PURGE'] else "disabled (ENABLE_PURGE)"))
+        if self.purge_run:
+            self.PutModule("\x02Purge:\x02 running{}, {} rows deleted, {:.1f} MB freed so far".format(" on " + self.purge_jobs[0].label() if self.purge_jobs else " incremental_vacuum", self.purge_run[1], self.purge_run[2] * page_size / 1048576.0))
+        if self.purge_last:
+            self.PutModule("\x02Last Purge:\x02 {}, {} rows deleted, {:.1f} MB freed in {:.1f}s".format(datetime.datetime.fromtimestamp(self.purge_last[0]).strftime('%Y-%m-%d %H:%M:%S'), self.purge_last[1], self.purge_last[2] * page_size / 1048576.0, self.purge_last[3]))
+        if self.search_run:
+            self.PutModule("\x02Search Index:\x02 building, {} rows indexed so far".format(self.search_run[1]))
+        else:
+            self.PutModule("\x02Search Index:\x02 {}".format("enabled" if self.settings['SEARCH_INDEX'] else "disabled (SEARCH_INDEX)"))
+        if self.perf:
+            with self.perf.lock:
+                counts = (sum(stat[0] for stat in self.perf.hooks.values()), sum(stat[0] for stat in self.perf.statements.values()), len(self.perf.slow))
+            self.PutModule("\x02Perf:\x02 {} hooks and {} statements timed, {} slow queries logged".format(*counts))
+        self.PutModule("\x02WHO Queue:\x02 {} queued, {} sent, {} replies".format(sum(len(channels) for channels in self.who_queues.values()), self.who_requests, self.who_replies))
+        self.PutModule("\x02Online:\x02 {} users in {} channel(s)".format(len(self.presence()), len(self.GetNetwork().GetChans())))
+        self.PutModule("\x02Netsplit Storms:\x02 {} ({} quits coalesced)".format(self.storms, self.storm_quits))
+        if self.settings['JOURNAL']:
+            # Ids only ever grow and old events are pruned from the low end, so the id range is the number of events.
+            self.PutModule("\x02Journal:\x02 {} events, last rollup {}s ago".format(self.query("SELECT IFNULL(MAX(id) - MIN(id) + 1, 0) FROM journal_records;").fetchone()[0], int(time.time() - self.last_rollup)))
+
+    # Size of every table and index. dbstat reads every page of the database, so this is only done when asked for.
+    def cmd_stats_sizes(self):
+        try:
+            rows = self.query("SELECT name, SUM(pgsize), SUM(ncell) FROM dbstat GROUP BY name ORDER BY 2 DESC;").fetchall()
+        except sqlite3.OperationalError:
+            self.PutModule("The sqlite3 library was built without the dbstat table, sizes are not available.")
+            return
+        for name, size, cells in rows:
+            self.PutModule("\x02{}\x02: {:.1f} MB, {} cells".format(name, size / 1048576.0, cells))
+
+    def stats_reconcile(self):
+        self.last_reconcile = time.time()
+        if not self.stats_job:
+            self.stats_job = AkaStatsThread(self.db_path, self.durability)
+            self.stats_job.start()
+
+    def stats_finish(self):
+        job = self.stats_job
+        self.stats_job = None
+        if job.error:
+            self.PutModule("\x02\x034Stats recount failed\x03\x02: {}".format(job.error))
+            return
+        if job.deltas:
+            self.write(stats_adjust, (job.deltas,))
+        self.stats_reconciled = (job.finished, job.finished - job.started, len(job.deltas))
+
+    # Hooks and statement shapes by total time spent, with the latency histogram, then the slow query log.
+    def cmd_perf(self, args=()):
+        if not self.perf:
+            self.PutModule("PERF IS CURRENTLY DISABLED")
+            return
+        perf = self.perf
+        with perf.lock:
+            hooks = sorted(perf.hooks.items(), key=lambda item: -item[1][1])
+            statements = sorted(perf.statements.items(), key=lambda item: -item[1][1])
+            slow = list(perf.slow)
+            started = perf.started
+        self.PutModule("\x02Perf:\x02 counting since {} ({}s), slow queries at {} ms or more".format(datetime.datetime.fromtimestamp(started).strftime('%Y-%m-%d %H:%M:%S'), int(time.time() - started), self.settings['SLOW_QUERY_MS']))
+        for title, rows in (("Hooks", hooks), ("Statements", statements)):
+            self.PutModule("\x02{}:\x02 {} total, top {} by time".format(title, len(rows), min(len(rows), PERF_TOP)))
+            for key, stat in rows[:PERF_TOP]:
+                buckets = ", ".join("{} {}".format(label, count) for label, count in zip(PERF_LABELS, stat[3:]) if count)
+                self.PutModule("  \x02{}\x02: {} calls, {:.3f}s total, {:.3f} ms avg, {:.3f} ms max ({})".format(key, stat[0], stat[1], stat[1] / stat[0] * 1000, stat[2] * 1000, buckets))
+        shown = slow if "--slow" in args else slow[-5:]
+        self.PutModule("\x02Slow Queries:\x02 {} logged, showing the last {}".format(len(slow), len(shown)))
+        for when, seconds, context, sql in shown:
+            self.PutModule("  {} \x02{:.1f} ms\x02 in {}: {}".format(datetime.datetime.fromtimestamp(when).strftime('%H:%M:%S'), seconds * 1000, context, sql))
+        if "--reset" in args:
+            perf.reset()
+            self.PutModule("Perf counters \x02reset\x02.")
 
     def cmd_purge(self, lastseen):
-        if self.nv['ENABLE_PURGE'] == "TRUE":
-            self.cur.execute("SELECT COUNT(*) FROM USERS WHERE network = '{0}' AND lastseen <= unixepoch('now', '-{1} days');".format(self.GetNetwork().GetName().lower(), lastseen))
-            count = self.cur.fetchone()
-            self.cur.execute("DELETE FROM USERS WHERE network = '{0}' AND lastseen <= unixepoch('now', '-{1} days');".format(self.GetNetwork().GetName().lower(), lastseen))
-            self.conn.commit()
-            self.PutModule("Purge of {} nick(s) on {} network complete.".format(count[0], self.GetNetwork().GetName().lower()))
+        if self.settings['ENABLE_PURGE']:
+            network = self.GetNetwork().GetName().lower()
+            self.purge_start([AkaPurge(network, None, int(time.time()) - int(lastseen) * 86400, False, True)])
+            self.PutModule("Purging records older than \x02{}\x02 days on \x02{}\x02 in the background, {} rows per second.".format(int(lastseen), network, self.settings['PURGE_BATCH']))
         else:
             self.PutModule("ENABLE_PURGE IS CURRENTLY DISABLED")
 
+    # Policies are kept per network, with an optional channel. A channel policy overrides the network one for that channel.
+    def cmd_retention(self, args):
+        network = self.GetNetwork().GetName().lower()
+        if args and self.compacting:
+            self.PutModule("Wait for \x02compact\x02 to finish first.")
+            return
+        if args and args[0] != 'off' and not (args[0].isdigit() and int(args[0]) > 0):
+            self.PutModule("Usage: retention [<days>|off] [<#channel>], <days> is a whole number of at least 1.")
+            return
+        if args:
+            channel = args[1].lower() if len(args) > 1 else ''
+            with self.write_lock:
+                if args[0] == 'off':
+                    self.cur.execute("DELETE FROM retention WHERE network = ? AND channel = ?;", (network, channel))
+                else:
+                    self.cur.execute("INSERT OR REPLACE INTO retention (network, channel, days) VALUES (?, ?, ?);", (network, channel, int(args[0])))
+                self.conn.commit()
+        policies = self.cur.execute("SELECT channel, days FROM retention WHERE network = ? ORDER BY channel;", (network,)).fetchall()
+        for channel, days in policies:
+            self.PutModule("\x02{}\x02: records not seen for \x02{}\x02 days are purged.".format(channel or network, days))
+        if not policies:
+            self.PutModule("No retention policies for \x02{}\x02.".format(network))
+        elif not self.settings['ENABLE_PURGE']:
+            self.PutModule("ENABLE_PURGE IS CURRENTLY DISABLED, the policies will not run.")
+
+    # Queues every retention policy. Called from on_tick() every RETENTION_INTERVAL seconds.
+    def retention_run(self):
+        self.last_retention = time.time()
+        now = int(time.time())
+        jobs = [AkaPurge(network, channel or None, now - days * 86400, not channel, False) for network, channel, days in self.cur.execute("SELECT network, channel, days FROM retention ORDER BY network, channel;").fetchall()]
+        if jobs:
+            self.purge_start(jobs)
+
+    def purge_start(self, jobs):
+        self.purge_jobs.extend(jobs)
+        if not self.purge_run:
+            self.purge_run = [time.time(), 0, 0]
+
+    # One step of the running purge, called from on_tick(). Deletes one batch of rows per second on the lastseen index,
+    # then hands the free pages back to the file system VACUUM_PAGES at a time with incremental_vacuum.
+    def run_purge(self):
+        if self.purge_jobs:
+            job = self.purge_jobs[0]
+            sql = "DELETE FROM user_records WHERE id IN (SELECT id FROM user_records WHERE network_id = (SELECT id FROM network_ids WHERE value = ?) AND lastseen <= ?"
+            params = [job.network, job.cutoff]
+            if job.channel:
+                sql += " AND channel_id = (SELECT id FROM channel_ids WHERE value = ?)"
+                params.append(job.channel)
+            if job.keep:
+                sql += " AND channel_id NOT IN (SELECT channel_ids.id FROM retention JOIN channel_ids ON channel_ids.value = retention.channel WHERE retention.network = ?)"
+                params.append(job.network)
+            params.append(self.settings['PURGE_BATCH'])
+            deleted = self.cur.execute(sql + " LIMIT ?);", params).rowcount
+            self.conn.commit()
+            job.deleted += deleted
+            self.purge_run[1] += deleted
+            if deleted < self.settings['PURGE_BATCH']:
+                self.purge_jobs.popleft()
+                if job.verbose:
+                    self.PutModule("Purge of {} nick(s) on {} network complete.".format(job.deleted, job.label()))
+                if not self.purge_jobs:
+                    self.purge_vacuum = True
+            return
+        free = self.cur.execute("PRAGMA freelist_count;").fetchone()[0]
+        if self.purge_vacuum and free and self.cur.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2:
+            # incremental_vacuum frees one page per step and execute() only steps a statement without result columns once,
+            # executescript() runs it to the end.
+            self.conn.executescript("PRAGMA incremental_vacuum({});".format(self.settings['VACUUM_PAGES']))
+            freed = free - self.cur.execute("PRAGMA freelist_count;").fetchone()[0]
+            self.purge_run[2] += freed
+            # Nothing freed means another connection is in the way, the rest is freed by the next purge.
+            if freed:
+                return
+        self.purge_vacuum = False
+        self.purge_last = (time.time(), self.purge_run[1], self.purge_run[2], time.time() - self.purge_run[0])
+        self.purge_run = None
+
+    def cmd_backup(self, path):
+        target = os.path.join(self.GetSavePath(), os.path.expanduser(path))
+        if os.path.abspath(target) in [os.path.abspath(self.db_path + suffix) for suffix in ("", "-wal", "-shm")]:
+            self.PutModule("Refusing to back up the database onto itself.")
+            return
+        if self.copy_start(target, False):
+            self.PutModule("Backing up \x02{}\x02 MB to \x02{}\x02 in the background, {} pages per step.".format(self.db_size() >> 20, target, self.settings['BACKUP_PAGES']))
+
+    # Events are held in the write buffer while the copy is written so nothing is lost when it replaces the database.
+    def cmd_compact(self):
+        if self.copy_job:
+            self.copy_start(None, True)
+            return
+        if self.import_job or self.purge_run:
+            self.PutModule("Wait for the running \x02{}\x02 to finish first.".format("process" if self.import_job else "purge"))
+            return
+        target = self.db_path + ".compact"
+        if os.path.exists(target):
+            os.remove(target)
+        self.flush_writes()
+        if self.writer_thread:
+            self.writer_thread.stop()
+            self.writer_thread = None
+        if self.copy_start(target, True):
+            self.compacting = True
+            self.PutModule("Compacting \x02{}\x02 MB in the background. Events are kept in memory until it is done.".format(self.db_size() >> 20))
+        else:
+            self.apply_config()
+
+    def copy_start(self, target, compact):
+        if self.copy_job:
+            self.PutModule("A \x02{}\x02 is already running. Try again when it is done.".format("compact" if self.copy_job.compact else "backup"))
+            return False
+        self.copy_job = AkaCopyThread(self.db_path, self.durability, target, compact, self.settings['BACKUP_PAGES'])
+        self.copy_job.start()
+        return True
+
+    # Called from on_tick(). Reports progress and finishes the backup or compaction once the copy thread is done.
+    def run_copy(self):
+        job = self.copy_job
+        name = "Compact" if job.compact else "Backup"
+        if job.is_alive():
+            if time.time() - job.reported >= 5:
+                job.reported = time.time()
+                self.PutModule("{}: {} of {} pages copied ({:.0f}%).".format(name, job.total - job.remaining, job.total, 100.0 * (job.total - job.remaining) / max(job.total, 1)))
+            return
+        # Swap the compacted copy in at a quiet point, not in the middle of a netsplit. A running stats recount still reads the
+        # old file, the swap waits for it.
+        if job.compact and not job.error and (self.storm or self.stats_job):
+            return
+        self.copy_job = None
+        size = self.db_size()
+        if job.error:
+            self.PutModule("\x02\x034{} failed\x03\x02: {}".format(name, job.error))
+            if job.compact and os.path.exists(job.target):
+                os.remove(job.target)
+        elif job.compact:
+            self.db_swap(job.target)
+            self.PutModule("Compact \x02complete\x02: {} MB before, {} MB after, in {:.2f}s ({:.1f} MB/s).".format(size >> 20, os.path.getsize(self.db_path) >> 20, job.finished - job.started, size / 1048576.0 / max(job.finished - job.started, 0.001)))
+        else:
+            self.PutModule("Backup to \x02{}\x02 \x02complete\x02: {} MB in {:.2f}s ({:.1f} MB/s).".format(job.target, os.path.getsize(job.target) >> 20, job.finished - job.started, os.path.getsize(job.target) / 1048576.0 / max(job.finished - job.started, 0.001)))
+        if job.compact:
+            self.compacting = False
+            self.flush_writes()
+            self.apply_config()
+
+    # Size of the database including whatever has not been checkpointed from the WAL yet.
+    def db_size(self):
+        return sum(os.path.getsize(self.db_path + suffix) for suffix in ("", "-wal") if os.path.exists(self.db_path + suffix))
+
+    # Replaces the database with the compacted copy. Ids are kept by VACUUM, so the id caches stay valid.
+    # Long results waiting for `more` read the old file through their own connection, they are dropped first.
+    def db_swap(self, target):
+        if self.pagers:
+            self.PutModule("The rest of the last long result was dropped by \x02compact\x02.")
+        for pager in self.pagers.values():
+            pager.close()
+        self.pagers = {}
+        self.rconn.close()
+        self.conn.close()
+        os.replace(target, self.db_path)
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+        self.conn = db_connect(self.db_path, self.durability)
+        self.cur = perf_cursor(self.conn, self.perf)
+        self.writer.conn = self.conn
+        self.writer.instrument(self.perf)
+        self.rconn = db_connect(self.db_path, self.durability, True)
+        self.rcur = perf_cursor(self.rconn, self.perf)
+
     def cmd_who(self, scope):
         if scope == 'all':
-            nets = self.GetUser().GetNetworks()
-            for net in nets:
-                chans = net.GetChans()
-                for chan in chans:
-                    self.PutIRC("WHO %s" % chan.GetName())
+            chans = [(net, chan.GetName()) for net in self.GetUser().GetNetworks() for chan in net.GetChans()]
         elif scope == 'network':
-            chans = self.GetNetwork().GetChans()
-            for chan in chans:
-                self.PutIRC("WHO %s" % chan.GetName())
+            chans = [(self.GetNetwork(), chan.GetName()) for chan in self.GetNetwork().GetChans()]
         else:
-           self.PutIRC("WHO %s" % scope)
-        self.PutModule("{} WHO updates triggered. Please wait several minutes for ZNC to receive the updated data from the IRC server(s) and then run \x02process\x02 to add these updates to the database".format(scope))
+            chans = [(self.GetNetwork(), scope)]
+        for net, channel in chans:
+            self.who_queue(net, channel)
+        queued = max(len(channels) for channels in self.who_queues.values()) if self.who_queues else 0
+        self.PutModule("\x02{}\x02: {} WHO request(s) queued, one every {}s per network (about {}s). Replies are written to the database as each one completes.".format(scope, len(chans), self.settings['WHO_INTERVAL'], queued * self.settings['WHO_INTERVAL']))
 
     def cmd_about(self):
         self.PutModule("\x02aka")
@@ -676,20 +2423,71 @@ class aka(znc.Module):
         #self.PutModule("\x02Documenation:\x02 http://wiki.znc.in/Aka")
         self.PutModule("\x02Source:\x02 https://github.com/RealKindOne/znc-aka")
 
+    # Runs on the read-only connection unless --write is given. Every page of output gets RAWQUERY_TIMEOUT seconds before the query
+    # is interrupted, and at most RAWQUERY_ROWS rows are printed. --csv and --tsv print a header and one delimited line per row.
+    # Reads are paged straight from the cursor. Writes are read to the end and committed before anything is printed.
     def cmd_rawquery(self, query):
+        flags = list(itertools.takewhile(lambda word: word.startswith('--'), query))
+        query = ' '.join(query[len(flags):])
+        if not query:
+            raise ValueError("no query")
+        if "--write" in flags:
+            if self.compacting:
+                self.PutModule("Wait for \x02compact\x02 to finish first.")
+                return
+            conn = self.conn
+        else:
+            conn = self.page_connection()
+        delimiter = {"--csv": ",", "--tsv": "\t"}.get(next((flag for flag in flags if flag in ("--csv", "--tsv")), None))
+        lines = self.rawquery_lines(conn, query, delimiter)
+        if conn is self.conn:
+            deadline = time.time() + self.settings['RAWQUERY_TIMEOUT']
+            conn.set_progress_handler(lambda: time.time() > deadline, RAWQUERY_STEPS)
+            # A write waits for the writer thread's current batch instead of competing with it for the database write lock.
+            try:
+                with self.write_lock:
+                    lines = list(lines)
+            finally:
+                conn.set_progress_handler(None, RAWQUERY_STEPS)
+            self.page(lines)
+        else:
+            self.page(lines, conn, self.settings['RAWQUERY_TIMEOUT'])
+
+    def rawquery_lines(self, conn, query, delimiter):
+        cur = perf_cursor(conn, self.perf)
         try:
-            query = ' '.join(query)
+            cur.execute(query)
+            if delimiter and cur.description:
+                yield self.rawquery_line([column[0] for column in cur.description], delimiter)
             count = 0
-            for row in self.cur.execute(query):
-                self.PutModule(str(row))
+            for row in cur:
+                if count >= self.settings['RAWQUERY_ROWS']:
+                    yield "Stopped after {} rows (RAWQUERY_ROWS).".format(count)
+                    break
+                yield self.rawquery_line(row, delimiter) if delimiter else str(row)
                 count += 1
-            self.conn.commit()
-            if self.cur.rowcount >= 0:
-                self.PutModule('Query successful: %s rows affected' % self.cur.rowcount)
+            if conn is self.conn:
+                conn.commit()
+            if cur.rowcount >= 0:
+                yield 'Query successful: %s rows affected' % cur.rowcount
             else:
-                self.PutModule('%s records retrieved' % count)
+                yield '%s records retrieved' % count
         except sqlite3.Error as e:
-            self.PutModule('Error: %s' % e)
+            if conn is self.conn:
+                conn.rollback()
+            if 'interrupted' in str(e):
+                yield 'Error: query took longer than {} seconds (RAWQUERY_TIMEOUT)'.format(self.settings['RAWQUERY_TIMEOUT'])
+            elif conn is not self.conn and 'readonly' in str(e):
+                yield 'Error: %s. Use \x02rawquery --write\x02 to change the database.' % e
+            else:
+                yield 'Error: %s' % e
+        finally:
+            cur.close()
+
+    def rawquery_line(self, row, delimiter):
+        line = io.StringIO()
+        csv.writer(line, delimiter=delimiter, lineterminator='').writerow(['' if value is None else value for value in row])
+        return line.getvalue()
 
     def cmd_getconfig(self):
         for key, value in self.nv.items():
@@ -702,27 +2500,30 @@ class aka(znc.Module):
         cols = "op_nick, op_host, channel, action, message, offender_nick, offender_ident, offender_host, added, time"
         if method == "user":
             if user_type == "nick":
-                self.cur.execute("SELECT host, nick FROM users WHERE network = '{0}' AND nick = '{1}' GROUP BY host ORDER BY host;".format(self.GetNetwork().GetName().lower(), user.lower()))
+                self.query("SELECT host, nick FROM users WHERE network = '{0}' AND nick = '{1}' GROUP BY host ORDER BY host;".format(self.GetNetwork().GetName().lower(), user.lower()))
                 query = "SELECT %s FROM moderated WHERE network = '%s' AND LOWER(offender_nick) = '%s' OR LOWER(offender_nick) LIKE '%s!%%' OR LOWER(offender_nick) LIKE '%s*%%'" % (cols, network, user.lower(), user.lower(), user.lower())
-                for row in self.cur:
+                for row in self.rcur:
                     query +=  " OR LOWER(offender_host) = '%s'" % row[0].lower()
                 query += " ORDER BY time;"
             elif user_type == "host":
                 query = "SELECT %s FROM moderated WHERE network = '%s' AND LOWER(offender_host) = '%s' ORDER BY time;" % (cols, network, user.lower())
         elif method == "channel":
             if user_type == "nick":
-                self.cur.execute("SELECT host, nick FROM users WHERE network = '{0}' AND nick = '{1} GROUP BY host ORDER BY host;".format(self.GetNetwork().GetName().lower(), user.lower()))
+                self.query("SELECT host, nick FROM users WHERE network = '{0}' AND nick = '{1} GROUP BY host ORDER BY host;".format(self.GetNetwork().GetName().lower(), user.lower()))
                 query = "SELECT %s FROM moderated WHERE network = '%s' AND channel = '%s' AND (LOWER(offender_nick) = '%s' OR LOWER(offender_nick) LIKE '%s!%%' OR LOWER(offender_nick) LIKE '%s*%%'" % (cols, network, channel, user.lower(), user.lower(), user.lower())
-                for row in self.cur:
+                for row in self.rcur:
                     query +=  " OR LOWER(offender_host) = '%s'" % row[0].lower()
                 query += ") ORDER BY time;"
             elif user_type == "host":
                 query = "SELECT %s FROM moderated WHERE network = '%s' AND channel = '%s' AND LOWER(offender_host) = '%s' ORDER BY time;" % (cols, network, channel, user.lower())
-        self.cur.execute(query)
-        data = self.cur.fetchall()
-        if len(data) > 0:
-            count = 0
-            for op_nick, op_host, channel, action, message, offender_nick, offender_ident, offender_host, added, time in data:
+        conn = self.page_connection()
+        self.page(self.offenses_lines(self.query(query, cursor=perf_cursor(conn, self.perf)), method, user_type, user, channel), conn)
+
+    # Reads the offenses from the cursor as `more` asks for them.
+    def offenses_lines(self, cursor, method, user_type, user, channel):
+        count = 0
+        try:
+            for op_nick, op_host, channel, action, message, offender_nick, offender_ident, offender_host, added, time in cursor:
                 count += 1
                 if user_type == "nick":
                     offender = offender_host
@@ -735,62 +2536,100 @@ class aka(znc.Module):
                         action = 'quieted'
                     if added == '0':
                         action = "un%s" % action
-                    self.PutModule("%s %s (%s!%s@%s) was %s from %s by %s on %s." % (user_type.title(), user, offender_nick, offender_ident, offender_host, action, str(channel).replace("''","'"), op_nick, time.partition('.')[0]))
+                    yield "%s %s (%s!%s@%s) was %s from %s by %s on %s." % (user_type.title(), user, offender_nick, offender_ident, offender_host, action, str(channel).replace("''","'"), op_nick, time.partition('.')[0])
                 elif action == "k" or action == "rm":
                     if action == "k":
                         action = "kicked"
-                    self.PutModule("%s %s (%s!%s@%s) was %s from %s by %s on %s. Reason: %s" % (user_type.title(), user, offender_nick, offender_ident, offender_host, action, str(channel).replace("''","'"), op_nick, time.partition('.')[0], str(message).replace("''","'")))
+                    yield "%s %s (%s!%s@%s) was %s from %s by %s on %s. Reason: %s" % (user_type.title(), user, offender_nick, offender_ident, offender_host, action, str(channel).replace("''","'"), op_nick, time.partition('.')[0], str(message).replace("''","'"))
+        finally:
+            cursor.close()
+        if count > 0:
             if method == "user":
-                self.PutModule("%s %s: %s total offenses." % (user_type.title(), user, count))
+                yield "%s %s: %s total offenses." % (user_type.title(), user, count)
             elif method == "channel":
-                self.PutModule("%s %s: %s total offenses in %s." % (user_type.title(), user, count, channel))
+                yield "%s %s: %s total offenses in %s." % (user_type.title(), user, count, channel)
         else:
             if method == "channel":
-                self.PutModule("No offenses found for %s: %s in %s" % (user_type, user, channel))
+                yield "No offenses found for %s: %s in %s" % (user_type, user, channel)
             else:
-                self.PutModule("No offenses found for %s: %s" % (user_type, user))
+                yield "No offenses found for %s: %s" % (user_type, user)
 
     def cmd_config(self, var_name, value):
         valid = True
-        bools = [
-            "ENABLE_PURGE",
-            "RECORD_KICK",
-            "RECORD_MODERATED",
-            "RECORD_WHOIS",
-            "RECORD_WHOWAS",
-            "VACUUM_ON_LOAD",
-            "WHO_ON_JOIN"
-        ]
-        if var_name.upper() in bools:
+        if var_name.upper() in DEFAULT_CONFIG and isinstance(DEFAULT_CONFIG[var_name.upper()], bool):
             if not str(value).upper() == "TRUE" and not str(value).upper() == "FALSE":
                 valid = False
                 self.PutModule("%s must be either True or False" % var_name)
+        elif var_name.upper() in DEFAULT_CONFIG and isinstance(DEFAULT_CONFIG[var_name.upper()], int):
+            if not str(value).isdigit():
+                valid = False
+                self.PutModule("%s must be a whole number" % var_name)
+            elif var_name.upper() in CONFIG_POSITIVE and int(value) < 1:
+                valid = False
+                self.PutModule("%s must be at least 1" % var_name)
+        elif var_name.upper() in CONFIG_CHOICES:
+            if str(value).upper() not in CONFIG_CHOICES[var_name.upper()]:
+                valid = False
+                self.PutModule("%s must be one of: %s" % (var_name, ', '.join(CONFIG_CHOICES[var_name.upper()])))
+        elif var_name.upper() in CONFIG_TEXT:
+            if var_name.upper() == "GEO_URL" and "{}" not in value:
+                valid = False
+                self.PutModule("%s must contain {} where the IP goes" % var_name)
         else:
             valid = False
             self.PutModule("%s is not a valid setting." % var_name)
 
         if valid:
-            self.SetNV(str(var_name).upper(), str(value).upper(), True)
-            self.PutModule("%s => %s" % (var_name.upper(), value.upper()))
+            if var_name.upper() not in CONFIG_TEXT:
+                value = str(value).upper()
+            self.SetNV(str(var_name).upper(), value, True)
+            self.PutModule("%s => %s" % (var_name.upper(), value))
+            self.apply_config()
 
     def configure(self):
 
         if not os.path.exists(self.GetSavePath() + "/.registry"):
             for setting in DEFAULT_CONFIG:
-                self.SetNV(setting.upper(), str(DEFAULT_CONFIG[setting]).upper(), True)
+                self.SetNV(setting.upper(), self.config_default(setting), True)
 
         if os.path.exists(self.GetSavePath() + "/.registry"):
             for setting in DEFAULT_CONFIG:
                 if setting not in self.nv:
-                    self.SetNV(setting.upper(), str(DEFAULT_CONFIG[setting]).upper(), True)
+                    self.SetNV(setting.upper(), self.config_default(setting), True)
             for setting in self.nv:
-                if self.nv[setting] != self.nv[setting].upper():
+                if setting not in CONFIG_TEXT and self.nv[setting] != self.nv[setting].upper():
                     self.SetNV(setting.upper(), self.nv[setting].upper(), True)
 
+    def config_default(self, setting):
+        if setting in CONFIG_TEXT:
+            return str(DEFAULT_CONFIG[setting])
+        return str(DEFAULT_CONFIG[setting]).upper()
+
     def db_setup(self):
-        self.conn = sqlite3.connect(self.GetSavePath() + "/aka.db")
+        self.db_path = self.GetSavePath() + "/aka.db"
+        self.durability = self.nv['DURABILITY']
+        self.conn = db_connect(self.db_path, self.durability)
         self.cur = self.conn.cursor()
         self.cur.execute("PRAGMA auto_vacuum=2;")
+        # Databases from before version 3 still have the old flat users and moderated tables.
+        if self.cur.execute("PRAGMA user_version;").fetchone()[0] < 3:
+            self.db_setup_legacy()
+
+        # Versioned upgrades. PRAGMA user_version holds the number of the last one that was applied.
+        version = self.cur.execute("PRAGMA user_version;").fetchone()[0]
+        for number in range(version + 1, SCHEMA_VERSION + 1):
+            self.PutModule("Upgrading database to version {}...".format(number))
+            getattr(self, "db_upgrade_{}".format(number))()
+            self.cur.execute("PRAGMA user_version = {};".format(number))
+            self.conn.commit()
+            self.PutModule("Upgrading database to version {} is done.".format(number))
+
+        # Lookups use their own read-only connection so they never wait on the writers.
+        self.rconn = db_connect(self.db_path, self.durability, True)
+        self.rcur = self.rconn.cursor()
+
+    # Creates the original tables on a new database and upgrades ones from before versioned upgrades existed.
+    def db_setup_legacy(self):
         self.cur.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, network TEXT, nick TEXT, ident TEXT, host TEXT, channel TEXT, event TEXT, message TEXT, firstseen INTEGER, lastseen INTEGER, texts INTEGER, joins INTEGER, kicks INTEGER, parts INTEGER, quits INTEGER, account TEXT, gecos TEXT, UNIQUE (network, nick, ident, host, channel));")
         # Note: The 'added' column is either going to be '0' or '1'. Just use TEXT so the number gets '' around them. Without the '' the offenses command thinks all entries are banned.
         self.cur.execute("CREATE TABLE IF NOT EXISTS moderated (network TEXT, op_nick TEXT, op_ident TEXT, op_host TEXT, channel TEXT, action TEXT, message TEXT, offender_nick TEXT, offender_ident TEXT, offender_host TEXT, added TEXT, time);")
@@ -848,29 +2687,202 @@ class aka(znc.Module):
             self.cur.execute("DROP TABLE moderated_temp;")
             self.PutModule("Updating is done.")
             self.conn.commit()
-        self.cur.execute("CREATE INDEX IF NOT EXISTS networks ON users (network ASC);")
-        self.cur.execute("CREATE INDEX IF NOT EXISTS nicks ON users (nick ASC);")
 
         # Update any existing query events that are not set at '0'.
         # self.cur.execute("UPDATE users SET joins = '0' WHERE channel = 'query' and joins = '1';")
         self.conn.commit()
 
-        if self.nv['VACUUM_ON_LOAD'] == "TRUE":
-            self.cur.execute("VACUUM;")
-            self.SetNV('VACUUM_ON_LOAD', "FALSE")
+    # Composite indexes matching the lookups: every query filters on network plus nick, ident, host, channel, or lastseen.
+    # The UNIQUE (network, nick, ident, host, channel) index already covers network + nick, so the old single column indexes are dropped.
+    def db_upgrade_1(self):
+        self.cur.execute("DROP INDEX IF EXISTS networks;")
+        self.cur.execute("DROP INDEX IF EXISTS nicks;")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS users_network_ident ON users (network, ident, nick, host, channel);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS users_network_host ON users (network, host, nick, ident, channel);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS users_network_channel ON users (network, channel, nick, ident, host);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS users_network_lastseen ON users (network, lastseen);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS moderated_network_offender_nick ON moderated (network, LOWER(offender_nick));")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS moderated_network_offender_host ON moderated (network, LOWER(offender_host));")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS moderated_network_channel ON moderated (network, channel, time);")
+        # Sample instead of reading every row, this runs on load.
+        self.cur.execute("PRAGMA analysis_limit=1000;")
+        self.cur.execute("ANALYZE;")
+
+    # Reversed copy of the host so a leading wildcard search like '*.isp.example' becomes a prefix range scan on 'elpmaxe.psi.*'.
+    def db_upgrade_2(self):
+        self.conn.create_function("reverse", 1, lambda value: value[::-1] if value is not None else None, deterministic=True)
+        self.cur.execute("ALTER TABLE users ADD COLUMN rhost TEXT;")
+        self.cur.execute("UPDATE users SET rhost = reverse(host);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS users_network_rhost ON users (network, rhost, nick, ident, channel);")
+
+    # Normalized layout: network, nick, ident, host, and channel strings are stored once in their own table and users/moderated rows reference them by id.
+    # The old table names become views so existing rawquery SELECTs keep working.
+    def db_upgrade_3(self):
+        self.conn.create_function("reverse", 1, lambda value: value[::-1] if value is not None else None, deterministic=True)
+        self.cur.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        before = os.path.getsize(self.db_path)
+        # A new database has nothing to move, `stats` only reports the sizes of a real migration.
+        migrated = self.cur.execute("SELECT EXISTS (SELECT 1 FROM users) OR EXISTS (SELECT 1 FROM moderated);").fetchone()[0]
+        self.cur.execute("CREATE TABLE IF NOT EXISTS aka_meta (key TEXT PRIMARY KEY, value);")
+        for kind, table in ID_TABLES.items():
+            if kind == "host":
+                self.cur.execute("CREATE TABLE IF NOT EXISTS host_ids (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE, rvalue TEXT NOT NULL);")
+                self.cur.execute("CREATE INDEX IF NOT EXISTS host_ids_rvalue ON host_ids (rvalue);")
+            else:
+                self.cur.execute("CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE);".format(table))
+        self.cur.execute("CREATE TABLE IF NOT EXISTS user_records (id INTEGER PRIMARY KEY, network_id INTEGER NOT NULL, nick_id INTEGER NOT NULL, ident_id INTEGER NOT NULL, host_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, event TEXT, message TEXT, firstseen INTEGER, lastseen INTEGER, texts INTEGER, joins INTEGER, kicks INTEGER, parts INTEGER, quits INTEGER, account TEXT, gecos TEXT, UNIQUE (network_id, nick_id, ident_id, host_id, channel_id));")
+        # Note: The 'added' column is either going to be '0' or '1'. Just use TEXT so the number gets '' around them. Without the '' the offenses command thinks all entries are banned.
+        self.cur.execute("CREATE TABLE IF NOT EXISTS moderated_records (id INTEGER PRIMARY KEY, network_id INTEGER NOT NULL, op_nick_id INTEGER, op_ident_id INTEGER, op_host_id INTEGER, channel_id INTEGER NOT NULL, offender_nick_id INTEGER, offender_ident_id INTEGER, offender_host_id INTEGER, action TEXT, message TEXT, added TEXT, time);")
+
+        # Missing idents and hosts (kicks of unknown users) become '' so every users row has all five ids.
+        for kind in ("network", "nick", "ident", "channel"):
+            self.cur.execute("INSERT OR IGNORE INTO {0} (value) SELECT DISTINCT IFNULL({1}, '') FROM users;".format(ID_TABLES[kind], kind))
+        self.cur.execute("INSERT OR IGNORE INTO host_ids (value, rvalue) SELECT DISTINCT IFNULL(host, ''), IFNULL(rhost, '') FROM users;")
+        self.cur.execute("INSERT OR IGNORE INTO network_ids (value) SELECT DISTINCT network FROM moderated WHERE network IS NOT NULL;")
+        self.cur.execute("INSERT OR IGNORE INTO channel_ids (value) SELECT DISTINCT channel FROM moderated WHERE channel IS NOT NULL;")
+        self.cur.execute("INSERT OR IGNORE INTO nick_ids (value) SELECT op_nick FROM moderated WHERE op_nick IS NOT NULL UNION SELECT offender_nick FROM moderated WHERE offender_nick IS NOT NULL;")
+        self.cur.execute("INSERT OR IGNORE INTO ident_ids (value) SELECT op_ident FROM moderated WHERE op_ident IS NOT NULL UNION SELECT offender_ident FROM moderated WHERE offender_ident IS NOT NULL;")
+        self.cur.execute("INSERT OR IGNORE INTO host_ids (value, rvalue) SELECT value, reverse(value) FROM (SELECT op_host AS value FROM moderated WHERE op_host IS NOT NULL UNION SELECT offender_host FROM moderated WHERE offender_host IS NOT NULL);")
+
+        # Rows that only differed by a NULL ident or host are merged. The last event, message, account, and gecos come from the
+        # row seen last, SET reads the values from before the update so the lastseen comparison is not affected by it.
+        self.cur.execute("INSERT INTO user_records (id, network_id, nick_id, ident_id, host_id, channel_id, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account, gecos) \
+            SELECT u.id, n.id, k.id, i.id, h.id, c.id, u.event, u.message, u.firstseen, u.lastseen, u.texts, u.joins, u.kicks, u.parts, u.quits, u.account, u.gecos FROM users u \
+            JOIN network_ids n ON n.value = IFNULL(u.network, '') JOIN nick_ids k ON k.value = IFNULL(u.nick, '') JOIN ident_ids i ON i.value = IFNULL(u.ident, '') \
+            JOIN host_ids h ON h.value = IFNULL(u.host, '') JOIN channel_ids c ON c.value = IFNULL(u.channel, '') WHERE true \
+            ON CONFLICT(network_id,nick_id,ident_id,host_id,channel_id) DO UPDATE SET firstseen = MIN(firstseen, EXCLUDED.firstseen), lastseen = MAX(lastseen, EXCLUDED.lastseen), \
+            event = CASE WHEN EXCLUDED.lastseen > lastseen THEN EXCLUDED.event ELSE event END, message = CASE WHEN EXCLUDED.lastseen > lastseen THEN EXCLUDED.message ELSE message END, \
+            account = CASE WHEN EXCLUDED.lastseen > lastseen THEN COALESCE(EXCLUDED.account, account) ELSE COALESCE(account, EXCLUDED.account) END, \
+            gecos = CASE WHEN EXCLUDED.lastseen > lastseen THEN COALESCE(EXCLUDED.gecos, gecos) ELSE COALESCE(gecos, EXCLUDED.gecos) END, \
+            texts = IFNULL(texts, 0) + IFNULL(EXCLUDED.texts, 0), joins = IFNULL(joins, 0) + IFNULL(EXCLUDED.joins, 0), kicks = IFNULL(kicks, 0) + IFNULL(EXCLUDED.kicks, 0), \
+            parts = IFNULL(parts, 0) + IFNULL(EXCLUDED.parts, 0), quits = IFNULL(quits, 0) + IFNULL(EXCLUDED.quits, 0);")
+        self.cur.execute("INSERT INTO moderated_records (network_id, op_nick_id, op_ident_id, op_host_id, channel_id, offender_nick_id, offender_ident_id, offender_host_id, action, message, added, time) \
+            SELECT (SELECT id FROM network_ids WHERE value = m.network), (SELECT id FROM nick_ids WHERE value = m.op_nick), (SELECT id FROM ident_ids WHERE value = m.op_ident), \
+            (SELECT id FROM host_ids WHERE value = m.op_host), (SELECT id FROM channel_ids WHERE value = m.channel), (SELECT id FROM nick_ids WHERE value = m.offender_nick), \
+            (SELECT id FROM ident_ids WHERE value = m.offender_ident), (SELECT id FROM host_ids WHERE value = m.offender_host), m.action, m.message, m.added, m.time FROM moderated m \
+            WHERE m.network IS NOT NULL AND m.channel IS NOT NULL ORDER BY m.rowid;")
+        self.cur.execute("DROP TABLE users;")
+        self.cur.execute("DROP TABLE moderated;")
+        self.db_create_views()
+
+        self.cur.execute("CREATE INDEX IF NOT EXISTS user_records_network_ident ON user_records (network_id, ident_id, nick_id, host_id, channel_id);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS user_records_network_host ON user_records (network_id, host_id, nick_id, ident_id, channel_id);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS user_records_network_channel ON user_records (network_id, channel_id, nick_id, ident_id, host_id);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS user_records_network_lastseen ON user_records (network_id, lastseen);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS moderated_records_network_offender_nick ON moderated_records (network_id, offender_nick_id);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS moderated_records_network_offender_host ON moderated_records (network_id, offender_host_id);")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS moderated_records_network_channel ON moderated_records (network_id, channel_id, time);")
+        self.conn.commit()
+        self.cur.execute("VACUUM;")
+        self.cur.execute("PRAGMA analysis_limit=1000;")
+        self.cur.execute("ANALYZE;")
+        self.cur.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        after = os.path.getsize(self.db_path)
+        if migrated:
+            self.cur.execute("INSERT OR REPLACE INTO aka_meta (key, value) VALUES ('normalize_size_before', ?), ('normalize_size_after', ?);", (before, after))
+            self.PutModule("Database size: {} KB before, {} KB after.".format(before >> 10, after >> 10))
+
+    # Append-only journal of raw events. Rows are ids and an integer event type, AUTOINCREMENT so pruned ids are never handed out again.
+    def db_upgrade_4(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS journal_events (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);")
+        self.cur.executemany("INSERT OR IGNORE INTO journal_events (id, name) VALUES (?, ?);", [(id, name) for name, id in JOURNAL_EVENTS.items()])
+        self.cur.execute("CREATE TABLE IF NOT EXISTS journal_records (id INTEGER PRIMARY KEY AUTOINCREMENT, network_id INTEGER NOT NULL, nick_id INTEGER NOT NULL, ident_id INTEGER NOT NULL, host_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, time INTEGER NOT NULL, event INTEGER NOT NULL, message TEXT, account TEXT, gecos TEXT);")
+        self.cur.execute("DROP VIEW IF EXISTS journal;")
+        self.cur.execute("CREATE VIEW journal AS SELECT j.id AS id, n.value AS network, k.value AS nick, i.value AS ident, h.value AS host, c.value AS channel, \
+            j.time AS time, e.name AS event, j.message AS message, j.account AS account, j.gecos AS gecos, \
+            j.network_id AS network_id, j.nick_id AS nick_id, j.ident_id AS ident_id, j.host_id AS host_id, j.channel_id AS channel_id \
+            FROM journal_records j JOIN network_ids n ON n.id = j.network_id JOIN nick_ids k ON k.id = j.nick_id JOIN ident_ids i ON i.id = j.ident_id \
+            JOIN host_ids h ON h.id = j.host_id JOIN channel_ids c ON c.id = j.channel_id JOIN journal_events e ON e.id = j.event;")
+
+    # Geo answers keyed by IP or host. Failed answers are kept too so they are not asked for again until they expire.
+    def db_upgrade_5(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS geo_cache (ip TEXT PRIMARY KEY, data TEXT NOT NULL, failed INTEGER NOT NULL, expires INTEGER NOT NULL);")
+
+    # Retention policies. An empty channel is the policy for the whole network.
+    def db_upgrade_6(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS retention (network TEXT NOT NULL, channel TEXT NOT NULL DEFAULT '', days INTEGER NOT NULL, PRIMARY KEY (network, channel));")
+
+    # Per network counters for `stats`, kept current by triggers on user_records. A nick/ident/host/channel is counted when its
+    # first row on the network is added and uncounted when its last one is deleted, each check is one probe of an existing index.
+    # network_growth counts the rows added per day.
+    def db_upgrade_7(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS network_stats (network_id INTEGER PRIMARY KEY, records INTEGER NOT NULL DEFAULT 0, nicks INTEGER NOT NULL DEFAULT 0, \
+            idents INTEGER NOT NULL DEFAULT 0, hosts INTEGER NOT NULL DEFAULT 0, channels INTEGER NOT NULL DEFAULT 0);")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS network_growth (network_id INTEGER NOT NULL, day INTEGER NOT NULL, records INTEGER NOT NULL, PRIMARY KEY (network_id, day)) WITHOUT ROWID;")
+        self.cur.execute("DELETE FROM network_stats;")
+        self.cur.execute("INSERT INTO network_stats (network_id, records, nicks, idents, hosts, channels) " + STATS_EXACT + ";")
+        self.cur.execute("DELETE FROM network_growth;")
+        self.cur.execute("INSERT INTO network_growth (network_id, day, records) SELECT network_id, firstseen / 86400, COUNT(*) FROM user_records WHERE firstseen >= ? GROUP BY 1, 2;", (int(time.time()) - 8 * 86400,))
+        self.cur.execute("CREATE TRIGGER IF NOT EXISTS user_records_stats_insert AFTER INSERT ON user_records BEGIN \
+            INSERT OR IGNORE INTO network_stats (network_id) VALUES (NEW.network_id); \
+            UPDATE network_stats SET records = records + 1, \
+                nicks = nicks + NOT EXISTS (SELECT 1 FROM user_records WHERE network_id = NEW.network_id AND nick_id = NEW.nick_id AND id != NEW.id), \
+                idents = idents + NOT EXISTS (SELECT 1 FROM user_records WHERE network_id = NEW.network_id AND ident_id = NEW.ident_id AND id != NEW.id), \
+                hosts = hosts + NOT EXISTS (SELECT 1 FROM user_records WHERE network_id = NEW.network_id AND host_id = NEW.host_id AND id != NEW.id), \
+                channels = channels + NOT EXISTS (SELECT 1 FROM user_records WHERE network_id = NEW.network_id AND channel_id = NEW.channel_id AND id != NEW.id) \
+            WHERE network_id = NEW.network_id; \
+            INSERT INTO network_growth (network_id, day, records) VALUES (NEW.network_id, NEW.firstseen / 86400, 1) \
+                ON CONFLICT(network_id, day) DO UPDATE SET records = records + 1; \
+            END;")
+        self.cur.execute("CREATE TRIGGER IF NOT EXISTS user_records_stats_delete AFTER DELETE ON user_records BEGIN \
+            UPDATE network_stats SET records = records - 1, \
+                nicks = nicks - NOT EXISTS (SELECT 1 FROM user_records WHERE network_id = OLD.network_id AND nick_id = OLD.nick_id), \
+                idents = idents - NOT EXISTS (SELECT 1 FROM user_records WHERE network_id = OLD.network_id AND ident_id = OLD.ident_id), \
+                hosts = hosts - NOT EXISTS (SELECT 1 FROM user_records WHERE network_id = OLD.network_id AND host_id = OLD.host_id), \
+                channels = channels - NOT EXISTS (SELECT 1 FROM user_records WHERE network_id = OLD.network_id AND channel_id = OLD.channel_id) \
+            WHERE network_id = OLD.network_id; \
+            END;")
+
+    # Account lookups (--type=account).
+    def db_upgrade_8(self):
+        self.cur.execute("CREATE INDEX IF NOT EXISTS user_records_network_account ON user_records (network_id, account);")
+
+    # Read-only views with the original column names on top of the normalized tables.
+    # The *_id columns are included so lookups can filter on the id tables' indexes.
+    def db_create_views(self):
+        self.cur.execute("DROP VIEW IF EXISTS users;")
+        self.cur.execute("CREATE VIEW users AS SELECT r.id AS id, n.value AS network, k.value AS nick, i.value AS ident, h.value AS host, c.value AS channel, \
+            r.event AS event, r.message AS message, r.firstseen AS firstseen, r.lastseen AS lastseen, r.texts AS texts, r.joins AS joins, r.kicks AS kicks, r.parts AS parts, \
+            r.quits AS quits, r.account AS account, r.gecos AS gecos, h.rvalue AS rhost, \
+            r.network_id AS network_id, r.nick_id AS nick_id, r.ident_id AS ident_id, r.host_id AS host_id, r.channel_id AS channel_id \
+            FROM user_records r JOIN network_ids n ON n.id = r.network_id JOIN nick_ids k ON k.id = r.nick_id JOIN ident_ids i ON i.id = r.ident_id \
+            JOIN host_ids h ON h.id = r.host_id JOIN channel_ids c ON c.id = r.channel_id;")
+        self.cur.execute("DROP VIEW IF EXISTS moderated;")
+        self.cur.execute("CREATE VIEW moderated AS SELECT n.value AS network, opn.value AS op_nick, opi.value AS op_ident, oph.value AS op_host, c.value AS channel, \
+            m.action AS action, m.message AS message, ofn.value AS offender_nick, ofi.value AS offender_ident, ofh.value AS offender_host, m.added AS added, m.time AS time, \
+            m.network_id AS network_id, m.channel_id AS channel_id, m.offender_nick_id AS offender_nick_id, m.offender_host_id AS offender_host_id \
+            FROM moderated_records m JOIN network_ids n ON n.id = m.network_id JOIN channel_ids c ON c.id = m.channel_id \
+            LEFT JOIN nick_ids opn ON opn.id = m.op_nick_id LEFT JOIN ident_ids opi ON opi.id = m.op_ident_id LEFT JOIN host_ids oph ON oph.id = m.op_host_id \
+            LEFT JOIN nick_ids ofn ON ofn.id = m.offender_nick_id LEFT JOIN ident_ids ofi ON ofi.id = m.offender_ident_id LEFT JOIN host_ids ofh ON ofh.id = m.offender_host_id;")
+
+    def cmd_explain(self, command):
+        if not command or command.split()[0] not in ["channels", "history", "offenses", "search", "seen", "stats", "timeline", "users"]:
+            self.PutModule("Valid commands: channels, history, offenses, search, seen, stats, timeline, users")
+            return
+        self.explaining = True
+        try:
+            self.OnModCommand(command)
+        finally:
+            self.explaining = False
 
     def OnModCommand(self, command):
+        # Make sure lookups see everything that is still sitting in the event buffer or the journal.
+        if self.settings['JOURNAL']:
+            self.rollup_journal()
+        self.flush_writes()
         line = command.lower()
         commands = line.split()
-        cmds = ["about", "all", "channels", "config", "geo", "getconfig", "help", "history", "offenses", "process", "purge", "rawquery", "seen", "sharedchans", "sharedusers", "stats", "users", "who"]
-        if commands[0] in cmds:
+        cmds = ["about", "all", "backup", "channels", "compact", "config", "explain", "geo", "getconfig", "help", "history", "more", "offenses", "perf", "process", "purge", "rawquery", "retention", "search", "seen", "sharedchans", "sharedusers", "stats", "timeline", "users", "who"]
+        if commands[0] == "explain":
+            self.cmd_explain(' '.join(command.split()[1:]))
+        elif commands[0] in cmds:
             if "--type=" in line:
-                type = (line.split('=')[1]).lower()
-                if type != 'nick' and type != 'host' and type != 'ident':
-                    self.PutModule("Valid types are \x02nick\x02, \x02ident\x02, and \x02host\x02.")
+                type = re.search(r"--type=(\S*)", line).group(1)
+                if type not in ('nick', 'ident', 'host', 'account'):
+                    self.PutModule("Valid types are \x02nick\x02, \x02ident\x02, \x02host\x02, and \x02account\x02.")
                     return znc.HALT
                 else:
-                    del commands[-1]
+                    commands.remove("--type=" + type)
             else:
                 type = None
             if commands[0] == "all":
@@ -885,23 +2897,25 @@ class aka(znc.Module):
                     self.PutModule("You must specify a user.")
             elif commands[0] == "history":
                 try:
-                    if "--deep" in line:
-                        self.cmd_history(type, commands[1], True)
-                    else:
-                        self.cmd_history(type, commands[1], False)
+                    self.cmd_history(type, commands[1], "--deep" in commands, "--geo" in commands)
                 except:
                     self.PutModule("You must specify a user.")
             elif commands[0] == "users" or commands[0] == "channels" or commands[0] == "sharedchans" or commands[0] == "sharedusers":
+                since = re.search(r"--since=(\S*)", line)
+                if since:
+                    try:
+                        since = parse_duration(since.group(1))
+                    except ValueError:
+                        self.PutModule("--since takes a number of days or a duration like \x0230m\x02, \x0212h\x02, \x027d\x02, or \x022w\x02.")
+                        return znc.HALT
+                names = [name for name in commands[1:] if not name.startswith('--')]
                 if commands[0] == 'channels' or commands[0] == 'sharedchans':
                     try:
-                        self.cmd_channels(type, commands[1:])
+                        self.cmd_channels(type, names, "--online" in commands, "--any" in commands, since)
                     except:
                         self.PutModule("You must specify at least one user.")
                 elif commands[0] == 'users' or commands[0] == 'sharedusers':
-                    try:
-                        self.cmd_users(commands[1:])
-                    except:
-                        self.PutModule("You must specify at least one channel.")
+                    self.cmd_users(names, "--any" in commands, since)
             elif commands[0] == "seen":
                 try:
                     try:
@@ -910,6 +2924,17 @@ class aka(znc.Module):
                         self.cmd_seen(type, commands[1], None)
                 except:
                     self.PutModule("You must specify a user and optional channel.")
+            elif commands[0] == "search":
+                try:
+                    # FTS5 operators are upper case, so the terms keep their case.
+                    self.cmd_search(command.split()[1:])
+                except ValueError:
+                    self.PutModule("You must specify search terms.")
+            elif commands[0] == "timeline":
+                try:
+                    self.cmd_timeline(type, commands[1])
+                except:
+                    self.PutModule("You must specify a user.")
             elif commands[0] == "geo":
                 try:
                     self.cmd_geo(type, commands[1])
@@ -928,14 +2953,31 @@ class aka(znc.Module):
                     self.cmd_rawquery(commands[1:])
                 except:
                     self.PutModule("You must specify a query.")
+            elif commands[0] == "more":
+                self.cmd_more()
+            elif commands[0] == "perf":
+                self.cmd_perf(commands[1:])
             elif commands[0] == "stats":
-                self.cmd_stats()
+                self.cmd_stats(commands[1:])
             elif commands[0] == "config":
-                self.cmd_config(commands[1], commands[2])
+                # The value keeps its case for free text settings.
+                self.cmd_config(commands[1], command.split()[2])
             elif commands[0] == "getconfig":
                 self.cmd_getconfig()
             elif commands[0] == "purge":
                 self.cmd_purge(commands[1])
+            elif commands[0] == "backup":
+                try:
+                    self.cmd_backup(command.split()[1])
+                except IndexError:
+                    self.PutModule("You must specify a file.")
+            elif commands[0] == "compact":
+                self.cmd_compact()
+            elif commands[0] == "retention":
+                try:
+                    self.cmd_retention(commands[1:])
+                except:
+                    self.PutModule("Usage: retention [<days>|off] [<#channel>]")
             elif commands[0] == "about":
                 self.cmd_about()
             elif commands[0] == "help":
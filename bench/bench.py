@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+#  Benchmarks for aka.py outside ZNC. Loads the real module on top of the stand-in znc module in this directory.
+#
+#  ingest: replays synthetic IRC traffic through the On*Message hooks and reports events/s, commits, and hook latency.
+#  query:  builds databases of the given sizes (kept in --dir and reused) and times the lookup commands on them.
+#
+#  python3 bench/bench.py ingest --events 200000 --scenario mixed --set BUFFER_WRITES=TRUE
+#  python3 bench/bench.py query --rows 100000 1000000 10000000 > bench_output.txt
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(1, os.path.dirname(HERE))
+
+import znc
+import aka
+import traffic
+
+NETWORK = "bench"
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def millis(seconds):
+    return "{:.3f} ms".format(seconds * 1000)
+
+
+# Loads the module and applies KEY=VALUE settings through the config command, the same path a user takes.
+def load(path, settings, network):
+    module = znc.load(aka.aka, path, znc.User("bench", [network]), network)
+    for setting in settings:
+        key, value = setting.split("=", 1)
+        module.OnModCommand("config {} {}".format(key, value))
+        if module.nv.get(key.upper(), '').upper() != value.upper():
+            sys.exit("Could not set {}: {}".format(key, module.output[-1]))
+    return module
+
+
+# The database file and its WAL.
+def database_size(db):
+    return sum(os.path.getsize(db + suffix) for suffix in ("", "-wal") if os.path.exists(db + suffix))
+
+
+def commits(module, thread):
+    return module.writer.commits + (thread.commits if thread else 0)
+
+
+def tick(module):
+    for timer in module.timers:
+        timer.RunJob()
+
+
+def cmd_ingest(args):
+    path = args.dir or tempfile.mkdtemp(prefix="aka-bench-")
+    network = znc.Network(NETWORK, isupport={"WHOX": ""})
+    source = traffic.Traffic(network, args.channels, args.users, args.seed)
+    module = load(path, args.set, network)
+    events = list(source.events(args.scenario, args.events))
+    ingested = module.ingested
+    hooks = []
+    ticks = []
+    start = time.perf_counter()
+    next_tick = start + 1
+    for index, (hook, params) in enumerate(events):
+        if args.rate:
+            wait = start + index / float(args.rate) - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        now = time.perf_counter()
+        while now >= next_tick:
+            tick(module)
+            ticks.append(time.perf_counter() - now)
+            next_tick += 1
+            now = time.perf_counter()
+        began = time.perf_counter()
+        getattr(module, hook)(*params)
+        hooks.append(time.perf_counter() - began)
+    replayed = time.perf_counter() - start
+    thread = module.writer_thread
+    written = commits(module, thread)
+    began = time.perf_counter()
+    module.OnShutdown()
+    shutdown = time.perf_counter() - began
+    total = replayed + shutdown
+    print("Scenario:        {} ({} events, {} channels, {} users, seed {})".format(args.scenario, len(events), args.channels, args.users, args.seed))
+    print("Settings:        {}".format(", ".join(args.set) or "defaults"))
+    print("Rate:            {}".format("{} events/s".format(args.rate) if args.rate else "unlimited"))
+    print("Replay:          {:.2f}s, {:.0f} events/s, {:.0f} rows/s".format(replayed, len(events) / replayed, (module.ingested - ingested) / replayed))
+    print("With shutdown:   {:.2f}s, {:.0f} events/s".format(total, len(events) / total))
+    print("Rows written:    {}".format(module.ingested - ingested))
+    print("Commits:         {} during replay, {} including shutdown".format(written, commits(module, thread)))
+    print("Hook latency:    p50 {}, p99 {}, max {}".format(millis(percentile(hooks, 0.5)), millis(percentile(hooks, 0.99)), millis(max(hooks or [0]))))
+    print("Timer latency:   p50 {}, p99 {}, max {} ({} ticks)".format(millis(percentile(ticks, 0.5)), millis(percentile(ticks, 0.99)), millis(max(ticks or [0])), len(ticks)))
+    print("Shutdown:        {}".format(millis(shutdown)))
+    print("Database:        {:.1f} MB".format(database_size(os.path.join(path, "aka.db")) / 1048576.0))
+    if module.perf:
+        del module.output[:]
+        module.cmd_perf()
+        print("\n".join(line.replace("\x02", "") for line in module.output))
+    if not args.dir:
+        shutil.rmtree(path)
+
+
+# Every user has 2 hosts and 4 channels, so 8 rows. Groups of 5 users share the second host and groups of 3 share an ident,
+# which gives history something to expand.
+def layout(rows):
+    users = max(rows // 8, 1)
+    return users, max(users // 250, 20)
+
+
+# lastseen is spread over the last 90 days. Every 12th user has been kicked once.
+def build(module, rows, seed):
+    rand = random.Random(seed)
+    users, channels = layout(rows)
+    now = int(time.time())
+    pending = []
+    for number in range(users):
+        nick = "u{}".format(number)
+        ident = "id{}".format(number // 3)
+        account = "acct{}".format(number) if number % 2 else "*"
+        hosts = ("h{}.isp{}.example".format(number, number % 100), "shared{}.example".format(number // 5))
+        for host in hosts:
+            for index in range(4):
+                event = aka.AkaEvent("join", NETWORK, nick, ident, host, "#c{}".format((number + index * 7919) % channels), "join", None, account, "gecos {}".format(number))
+                event.time = now - rand.randrange(90 * 86400)
+                pending.append(event)
+        if number % 12 == 0:
+            module.process_moderated(NETWORK, "op", "op", "op.example", "#c{}".format(number % channels), "k", "spam", nick, ident, hosts[0], None)
+        if len(pending) >= 20000:
+            module.ingest(*pending)
+            module.flush_writes()
+            pending = []
+    if pending:
+        module.ingest(*pending)
+    module.flush_writes()
+
+
+# Rows in a database generated by an earlier run, 0 if there is none or it was not finished.
+def generated_rows(db):
+    if not os.path.exists(db):
+        return 0
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute("SELECT IFNULL(SUM(records), 0) FROM network_stats;").fetchone()[0]
+    except sqlite3.Error:
+        return 0
+    finally:
+        conn.close()
+
+
+def cmd_query(args):
+    for rows in args.rows:
+        path = os.path.join(args.dir, str(rows))
+        db = os.path.join(path, "aka.db")
+        os.makedirs(path, exist_ok=True)
+        users, channels = layout(rows)
+        fresh = generated_rows(db) < rows
+        if fresh:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db + suffix):
+                    os.remove(db + suffix)
+        settings = ["BUFFER_WRITES=TRUE", "FLUSH_MAX_BATCH=20000"] + args.set
+        module = load(path, settings, znc.Network(NETWORK))
+        if fresh:
+            began = time.perf_counter()
+            build(module, rows, args.seed)
+            module.cur.execute("ANALYZE;")
+            module.conn.commit()
+            # Timings right after the build would read everything through the WAL, and from a connection opened before ANALYZE.
+            module.cur.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+            module.OnShutdown()
+            print("Built {} rows in {:.1f}s ({:.1f} MB)".format(rows, time.perf_counter() - began, database_size(db) / 1048576.0))
+            module = load(path, settings, znc.Network(NETWORK))
+        rand = random.Random(args.seed)
+        pick = lambda: "u{}".format(rand.randrange(users))
+        chan = lambda: "#c{}".format(rand.randrange(channels))
+        commands = [
+            ("history", lambda: "history {}".format(pick())),
+            ("history --deep", lambda: "history {} --deep".format(pick())),
+            ("history --type=host", lambda: "history *.isp{}.example --type=host".format(rand.randrange(100))),
+            ("seen", lambda: "seen {}".format(pick())),
+            ("channels", lambda: "channels {} {}".format(pick(), pick())),
+            ("users", lambda: "users {} {}".format(chan(), chan())),
+            ("users --any --since", lambda: "users {} {} -{} --any --since=30d".format(chan(), chan(), chan())),
+            ("stats", lambda: "stats"),
+            ("offenses", lambda: "offenses nick u{}".format(rand.randrange(0, users, 12))),
+        ]
+        print("{} rows, {} repeats, sqlite {}".format(rows, args.repeat, sqlite3.sqlite_version))
+        for name, command in commands:
+            times = []
+            lines = 0
+            for repeat in range(args.repeat):
+                line = command()
+                del module.output[:]
+                began = time.perf_counter()
+                module.OnModCommand(line)
+                times.append(time.perf_counter() - began)
+                lines += len(module.output)
+            print("  {:<22} median {:>12}  max {:>12}  {:>6} lines".format(name, millis(percentile(times, 0.5)), millis(max(times)), lines // args.repeat))
+        module.OnShutdown()
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--seed", type=int, default=1)
+    common.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Module setting, applied with the config command. Repeatable.")
+    parser = argparse.ArgumentParser(description="Benchmark aka.py outside ZNC.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    ingest = commands.add_parser("ingest", parents=[common], help="Replay synthetic traffic through the hooks.")
+    ingest.add_argument("--events", type=int, default=100000)
+    ingest.add_argument("--rate", type=int, default=0, help="Events per second, 0 for as fast as possible.")
+    ingest.add_argument("--scenario", default="mixed", choices=["mixed", "chatter", "netsplit", "nickstorm", "who"])
+    ingest.add_argument("--channels", type=int, default=50)
+    ingest.add_argument("--users", type=int, default=5000, help="Users already in the channels when the module loads.")
+    ingest.add_argument("--dir", help="Keep the database here instead of a temporary directory.")
+    query = commands.add_parser("query", parents=[common], help="Time lookup commands on generated databases.")
+    query.add_argument("--rows", type=int, nargs="+", default=[100000])
+    query.add_argument("--repeat", type=int, default=5)
+    query.add_argument("--dir", default="bench_data", help="Where the generated databases are kept and reused.")
+    args = parser.parse_args()
+    if args.command == "ingest":
+        cmd_ingest(args)
+    else:
+        cmd_query(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#  Synthetic IRC traffic for bench.py. Every event is a (hook, args) pair for the module, built from the fake znc objects.
+#  Channel membership is kept on the fake network the way ZNC keeps it, so the nick lists the hooks see stay consistent.
+
+import random
+
+import znc
+
+NETSPLIT_REASON = "hub.example.net leaf.example.net"
+
+# Relative weights of the events in ordinary chatter.
+CHATTER = (
+    ("text",   80),
+    ("join",    7),
+    ("part",    5),
+    ("quit",    4),
+    ("nick",    3),
+    ("kick",    1),
+)
+
+
+class Traffic(object):
+
+    def __init__(self, network, channels, users, seed=1):
+        self.network = network
+        self.random = random.Random(seed)
+        self.chans = [znc.Chan("#chan{}".format(index)) for index in range(channels)]
+        network.chans.extend(self.chans)
+        self.serial = 0
+        self.online = []
+        self.offline = []
+        self.kinds = [kind for kind, weight in CHATTER for count in range(weight)]
+        # Users that were already in the channels when the module was loaded.
+        for index in range(users):
+            nick = self.new_user()
+            for chan in self.random.sample(self.chans, min(len(self.chans), self.random.randint(1, 3))):
+                chan.nicks[nick.GetNick()] = nick
+
+    def new_user(self):
+        self.serial += 1
+        number = self.serial
+        # A few hosts are shared (NAT, cloaks, bouncers) so lookups have links to follow.
+        host = "user{}.isp{}.example".format(number, number % 100) if number % 5 else "shared{}.example".format(number % 997)
+        nick = znc.Nick("nick{}".format(number), "id{}".format(number % 5000), host)
+        nick.account = "acct{}".format(number) if number % 2 else "*"
+        nick.gecos = "Real Name {}".format(number)
+        self.online.append(nick)
+        return nick
+
+    def channels_of(self, nick):
+        return [chan for chan in self.chans if nick.GetNick() in chan.nicks]
+
+    def pick_online(self):
+        return self.online[self.random.randrange(len(self.online))]
+
+    def remove_online(self, nick):
+        index = self.online.index(nick)
+        self.online[index] = self.online[-1]
+        self.online.pop()
+
+    # Builds `count` events of one scenario: chatter, netsplit, nickstorm, who, or mixed.
+    def events(self, scenario, count):
+        produced = 0
+        while produced < count:
+            if scenario == "mixed":
+                burst = self.random.random()
+                if burst < 0.002:
+                    batch = self.netsplit(self.random.randint(50, 300))
+                elif burst < 0.004:
+                    batch = self.nickstorm(self.random.randint(20, 100))
+                elif burst < 0.006:
+                    batch = self.who(self.random.choice(self.chans))
+                else:
+                    batch = [self.chatter()]
+            elif scenario == "chatter":
+                batch = [self.chatter()]
+            elif scenario == "netsplit":
+                batch = self.netsplit(500)
+            elif scenario == "nickstorm":
+                batch = self.nickstorm(200)
+            elif scenario == "who":
+                batch = self.who(self.random.choice(self.chans))
+            else:
+                raise ValueError("unknown scenario: {}".format(scenario))
+            for event in batch[:count - produced]:
+                yield event
+            produced += len(batch)
+
+    def chatter(self):
+        kind = self.random.choice(self.kinds)
+        if len(self.online) < 10:
+            kind = "join"
+        if kind == "text":
+            nick = self.pick_online()
+            chans = self.channels_of(nick)
+            if chans:
+                text = "message {} from {}".format(self.random.randint(0, 1000000), nick.GetNick())
+                return ("OnChanTextMessage", (znc.Message(nick=nick, chan=self.random.choice(chans), text=text),))
+            kind = "join"
+        if kind == "join":
+            if self.offline and self.random.random() < 0.5:
+                nick = self.offline.pop(self.random.randrange(len(self.offline)))
+                self.online.append(nick)
+            elif self.random.random() < 0.5:
+                nick = self.new_user()
+            else:
+                nick = self.pick_online()
+            return self.join(nick, self.random.choice(self.chans))
+        if kind == "part":
+            nick = self.pick_online()
+            chans = self.channels_of(nick)
+            if not chans:
+                return self.join(nick, self.random.choice(self.chans))
+            chan = self.random.choice(chans)
+            del chan.nicks[nick.GetNick()]
+            return ("OnPartMessage", (znc.Message(nick=nick, chan=chan, reason="Leaving"),))
+        if kind == "quit":
+            return self.quit(self.pick_online(), "Quit: bye")
+        if kind == "nick":
+            return self.rename(self.pick_online())
+        nick = self.pick_online()
+        chans = self.channels_of(nick)
+        if not chans:
+            return self.join(nick, self.random.choice(self.chans))
+        chan = self.random.choice(chans)
+        del chan.nicks[nick.GetNick()]
+        op = self.network.GetIRCNick()
+        return ("OnKickMessage", (znc.Message(nick=op, chan=chan, kicked=nick.GetNick(), reason="flooding"),))
+
+    def join(self, nick, chan):
+        chan.nicks[nick.GetNick()] = nick
+        return ("OnJoinMessage", (znc.Message(nick=nick, chan=chan, params=[chan.GetName(), nick.account, nick.gecos]),))
+
+    def quit(self, nick, reason):
+        chans = self.channels_of(nick)
+        for chan in chans:
+            del chan.nicks[nick.GetNick()]
+        self.remove_online(nick)
+        self.offline.append(nick)
+        return ("OnQuitMessage", (znc.Message(nick=nick, reason=reason, tags={"account": nick.account}), chans))
+
+    def rename(self, nick):
+        chans = self.channels_of(nick)
+        old = nick.GetNick()
+        self.serial += 1
+        nick.nick = "{}_{}".format(old.split('_')[0], self.serial)
+        for chan in chans:
+            chan.nicks[nick.GetNick()] = chan.nicks.pop(old)
+        return ("OnNickMessage", (znc.Message(nick=nick, old_nick=old, new_nick=nick.GetNick()), chans))
+
+    # The users quit with a netsplit reason within the same second and come back once it heals.
+    def netsplit(self, count):
+        users = self.random.sample(self.online, min(count, len(self.online) - 10)) if len(self.online) > 10 else []
+        rejoins = [(nick, self.channels_of(nick)) for nick in users]
+        events = [self.quit(nick, NETSPLIT_REASON) for nick in users]
+        for nick, chans in rejoins:
+            self.offline.remove(nick)
+            self.online.append(nick)
+            for chan in chans:
+                events.append(self.join(nick, chan))
+        return events
+
+    def nickstorm(self, count):
+        return [self.rename(self.pick_online()) for index in range(count)]
+
+    # WHOX replies for every user in the channel, then RPL_ENDOFWHO.
+    def who(self, chan):
+        me = self.network.GetCurNick()
+        events = []
+        for nick in list(chan.nicks.values()):
+            account = nick.account if nick.account != "*" else "0"
+            params = [me, "995", chan.GetName(), nick.GetIdent(), nick.GetHost(), "irc.example.net", nick.GetNick(), "H", "0", "0", account, nick.gecos]
+            events.append(("OnNumericMessage", (znc.Message(code=354, params=params),)))
+        events.append(("OnNumericMessage", (znc.Message(code=315, params=[me, chan.GetName(), "End of /WHO list."]),)))
+        return events
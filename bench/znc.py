@@ -0,0 +1,233 @@
+#  Stand-in for the `znc` module that ZNC's modpython provides, with just enough of it to load aka.py and call its hooks
+#  outside a bouncer. Used by bench.py and tests/, never loaded by ZNC itself.
+
+CONTINUE = 1
+HALT = 2
+HALTMODS = 3
+HALTCORE = 4
+
+
+class CModInfo(object):
+    UserModule = 1
+    NetworkModule = 2
+    GlobalModule = 3
+
+
+class CTable(object):
+
+    def __init__(self):
+        self.columns = []
+        self.rows = []
+
+    def AddColumn(self, name):
+        self.columns.append(name)
+
+    def AddRow(self):
+        self.rows.append({})
+
+    def SetCell(self, column, value):
+        self.rows[-1][column] = value
+
+    def __str__(self):
+        return "\n".join(" | ".join(str(row.get(column, '')) for column in self.columns) for row in self.rows)
+
+
+class Timer(object):
+
+    def GetModule(self):
+        return self.module
+
+    def RunJob(self):
+        pass
+
+
+class Nick(object):
+
+    def __init__(self, nick, ident='', host=''):
+        self.nick = nick
+        self.ident = ident
+        self.host = host
+
+    def GetNick(self):
+        return self.nick
+
+    def GetIdent(self):
+        return self.ident
+
+    def GetHost(self):
+        return self.host
+
+
+class Chan(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.nicks = {}
+
+    def GetName(self):
+        return self.name
+
+    def GetNicks(self):
+        return self.nicks
+
+
+class Socket(object):
+
+    def __init__(self, isupport):
+        self.isupport = isupport
+
+    def GetISupport(self, key, default=''):
+        return self.isupport.get(key, default)
+
+
+class Network(object):
+
+    def __init__(self, name, nick='aka', ident='aka', host='aka.example', isupport=None):
+        self.name = name
+        self.chans = []
+        self.nick = Nick(nick, ident, host)
+        self.sock = Socket(isupport or {})
+        self.sent = []
+
+    def GetName(self):
+        return self.name
+
+    def GetChans(self):
+        return self.chans
+
+    def FindChan(self, name):
+        for chan in self.chans:
+            if chan.GetName().lower() == name.lower():
+                return chan
+        return None
+
+    def GetCurNick(self):
+        return self.nick.GetNick()
+
+    def GetIRCNick(self):
+        return self.nick
+
+    def GetRealName(self):
+        return "aka bench"
+
+    def IsIRCConnected(self):
+        return True
+
+    def GetIRCSock(self):
+        return self.sock
+
+    def PutIRC(self, line):
+        self.sent.append(line)
+        return True
+
+
+class User(object):
+
+    def __init__(self, name, networks):
+        self.name = name
+        self.networks = networks
+
+    def GetUserName(self):
+        return self.name
+
+    def GetNetworks(self):
+        return self.networks
+
+
+# One class for every message type, each hook only calls the getters that belong to it.
+class Message(object):
+
+    def __init__(self, nick=None, chan=None, params=(), tags=None, text='', target='', reason='', old_nick='', new_nick='', kicked='', code=0):
+        self.nick = nick
+        self.chan = chan
+        self.params = list(params)
+        self.tags = tags or {}
+        self.text = text
+        self.target = target
+        self.reason = reason
+        self.old_nick = old_nick
+        self.new_nick = new_nick
+        self.kicked = kicked
+        self.code = code
+
+    def GetNick(self):
+        return self.nick
+
+    def GetChan(self):
+        return self.chan
+
+    def GetParam(self, index):
+        return self.params[index] if index < len(self.params) else ''
+
+    def GetTag(self, name):
+        return self.tags.get(name, '')
+
+    def GetText(self):
+        return self.text
+
+    def GetTarget(self):
+        return self.target
+
+    def GetReason(self):
+        return self.reason
+
+    def GetOldNick(self):
+        return self.old_nick
+
+    def GetNewNick(self):
+        return self.new_nick
+
+    def GetKickedNick(self):
+        return self.kicked
+
+    def GetCode(self):
+        return self.code
+
+
+class Module(object):
+
+    def __init__(self):
+        self.nv = {}
+        self.timers = []
+        self.output = []
+        self.save_path = None
+        self.user = None
+        self.network = None
+
+    def SetNV(self, key, value, write=True):
+        self.nv[key] = value
+
+    def GetNV(self, key):
+        return self.nv.get(key, '')
+
+    def GetSavePath(self):
+        return self.save_path
+
+    def GetUser(self):
+        return self.user
+
+    def GetNetwork(self):
+        return self.network
+
+    def PutModule(self, line):
+        self.output.append(str(line))
+
+    def PutIRC(self, line):
+        return self.network.PutIRC(line)
+
+    def CreateTimer(self, timer, interval=10, cycles=1, label='pytimer', description=''):
+        instance = timer()
+        instance.module = self
+        instance.interval = interval
+        self.timers.append(instance)
+        return instance
+
+
+# Creates the module the way ZNC does and calls OnLoad.
+def load(cls, save_path, user, network):
+    module = cls()
+    module.save_path = save_path
+    module.user = user
+    module.network = network
+    module.OnLoad('', '')
+    return module
@@ -0,0 +1,64 @@
+#  Loads aka.py for the tests on top of the stand-in znc module in bench/.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+sys.path.insert(1, ROOT)
+
+import znc
+import aka
+
+NETWORK = "test"
+
+
+class ModuleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix="aka-test-")
+        self.addCleanup(shutil.rmtree, self.path, True)
+        self.modules = []
+        self.addCleanup(self.unload)
+
+    def unload(self):
+        for module in self.modules:
+            module.OnShutdown()
+            module.conn.close()
+            module.rconn.close()
+
+    # Applies KEY=VALUE settings through the config command, the same way bench.py does.
+    def load(self, *settings):
+        network = znc.Network(NETWORK)
+        module = znc.load(aka.aka, self.path, znc.User("test", [network]), network)
+        self.modules.append(module)
+        for setting in settings:
+            key, value = setting.split("=", 1)
+            module.OnModCommand("config {} {}".format(key, value))
+        return module
+
+    # One join per nick, the way ZNC reports them.
+    def join(self, module, count, channel="#chan", prefix="user"):
+        for number in range(count):
+            nick = "{}{}".format(prefix, number)
+            module.OnJoinMessage(znc.Message(nick=znc.Nick(nick, nick, "{}.example".format(nick)), chan=znc.Chan(channel), params=(channel, "*", "gecos " + "x" * 200)))
+
+    # Records last seen `age` seconds ago, one per nick.
+    def ingest(self, module, count, age=0, channel="#chan", prefix="user"):
+        now = int(aka.time.time())
+        events = []
+        for number in range(count):
+            nick = "{}{}".format(prefix, number)
+            event = aka.AkaEvent("join", NETWORK, nick, nick, "{}.example".format(nick), channel, "join", None, "*", "gecos " + "x" * 200)
+            event.time = now - age
+            events.append(event)
+        module.ingest(*events)
+        module.flush_writes()
+
+    def output(self, module, command):
+        del module.output[:]
+        module.OnModCommand(command)
+        return list(module.output)
@@ -0,0 +1,38 @@
+import os
+
+from support import ModuleTestCase
+
+
+class CheckpointTest(ModuleTestCase):
+
+    def wal_size(self, module):
+        return os.path.getsize(module.db_path + "-wal")
+
+    def test_checkpoint_truncates_the_wal(self):
+        module = self.load()
+        self.join(module, 200)
+        self.assertGreater(self.wal_size(module), 0)
+        module.checkpoint()
+        self.assertEqual(self.wal_size(module), 0)
+        self.assertEqual(module.cur.execute("PRAGMA busy_timeout;").fetchone()[0], 30000)
+
+    def test_open_reader_gets_a_passive_checkpoint(self):
+        module = self.load("PAGE_SIZE=5")
+        self.join(module, 200)
+        module.OnModCommand("rawquery SELECT nick FROM users")
+        self.assertTrue(module.pagers)
+        module.checkpoint()
+        self.assertGreater(self.wal_size(module), 0)
+        self.assertEqual(module.cur.execute("PRAGMA busy_timeout;").fetchone()[0], 30000)
+        for pager in module.pagers.values():
+            pager.close()
+        module.pagers.clear()
+        module.checkpoint()
+        self.assertEqual(self.wal_size(module), 0)
+
+    def test_wal_is_bounded_without_the_timer(self):
+        module = self.load("BUFFER_WRITES=TRUE", "FLUSH_MAX_BATCH=5000")
+        for batch in range(8):
+            self.join(module, 5000, prefix="batch{}x".format(batch))
+        module.flush_writes()
+        self.assertLessEqual(self.wal_size(module), 2 * module.cur.execute("PRAGMA journal_size_limit;").fetchone()[0])
@@ -0,0 +1,51 @@
+from support import ModuleTestCase, aka
+
+
+class CompactTest(ModuleTestCase):
+
+    def copy_done(self, module):
+        for tick in range(200):
+            if not module.copy_job.is_alive():
+                return
+            aka.time.sleep(0.05)
+        self.fail("compact did not finish")
+
+    def test_events_during_compact_reach_the_new_file(self):
+        module = self.load()
+        self.ingest(module, 500)
+        module.OnModCommand("compact")
+        self.assertTrue(module.compacting)
+        self.ingest(module, 10, prefix="during")
+        module.checkpoint()
+        self.copy_done(module)
+        module.run_copy()
+        self.assertFalse(module.compacting)
+        self.assertEqual(module.cur.execute("SELECT COUNT(*) FROM user_records;").fetchone()[0], 510)
+
+    def test_swap_waits_for_stats_and_drops_pagers(self):
+        module = self.load("PAGE_SIZE=5")
+        self.ingest(module, 500)
+        module.OnModCommand("rawquery SELECT nick FROM users")
+        self.assertTrue(module.pagers)
+        stats = module.stats_job = aka.AkaStatsThread(module.db_path, module.durability)
+        module.OnModCommand("compact")
+        self.assertTrue(module.compacting)
+        self.copy_done(module)
+        module.run_copy()
+        self.assertTrue(module.compacting)
+        self.assertIs(module.stats_job, stats)
+        module.stats_job = None
+        module.run_copy()
+        self.assertFalse(module.compacting)
+        self.assertEqual(module.pagers, {})
+        self.assertIn("Nothing more to show.", self.output(module, "more"))
+        self.assertEqual(module.cur.execute("SELECT COUNT(*) FROM user_records;").fetchone()[0], 500)
+
+    def test_retention_waits_for_compact(self):
+        module = self.load()
+        self.ingest(module, 10)
+        module.OnModCommand("compact")
+        self.assertEqual(self.output(module, "retention 30"), ["Wait for \x02compact\x02 to finish first."])
+        self.copy_done(module)
+        module.run_copy()
+        self.assertEqual(module.cur.execute("SELECT COUNT(*) FROM retention;").fetchone()[0], 0)
@@ -0,0 +1,17 @@
+from support import ModuleTestCase, aka
+
+
+class ConfigTest(ModuleTestCase):
+
+    def test_sizes_must_be_at_least_one(self):
+        module = self.load()
+        for name in aka.CONFIG_POSITIVE:
+            self.assertEqual(self.output(module, "config {} 0".format(name)), ["{} must be at least 1".format(name.lower())])
+            self.assertEqual(module.nv[name], str(aka.DEFAULT_CONFIG[name]))
+            self.assertEqual(self.output(module, "config {} 1".format(name)), ["{} => 1".format(name)])
+            self.assertEqual(module.nv[name], "1")
+
+    def test_other_numbers_take_zero(self):
+        module = self.load()
+        self.assertEqual(self.output(module, "config FLUSH_INTERVAL 0"), ["FLUSH_INTERVAL => 0"])
+        self.assertEqual(self.output(module, "config FLUSH_MAX_BATCH -1"), ["flush_max_batch must be a whole number"])
@@ -0,0 +1,101 @@
+import http.server
+import json
+import threading
+import time
+import unittest.mock
+
+from support import ModuleTestCase, aka
+
+ANSWERS = {
+    "192.0.2.1": {"status": "success", "country": "Testland", "regionName": "North", "city": "Testville", "lat": 1.5, "lon": 2.5,
+                  "timezone": "UTC", "mobile": False, "proxy": False, "query": "192.0.2.1", "reverse": ""},
+    "10.0.0.1": {"status": "fail", "message": "private range", "query": "10.0.0.1"},
+}
+
+
+# Answers GEO_URL requests from ANSWERS. 192.0.2.50 gets a 500 and 192.0.2.99 only answers after the client gave up.
+class GeoHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        ip = self.path.strip("/")
+        self.server.requests.append(ip)
+        if ip == "192.0.2.99":
+            time.sleep(1)
+        if ip not in ANSWERS:
+            self.send_error(500)
+            return
+        body = json.dumps(ANSWERS[ip]).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GeoTest(ModuleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), GeoHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.module = self.load("GEO_URL=http://127.0.0.1:{}/{{}}".format(self.server.server_address[1]))
+
+    # Runs a geo lookup and hands the module the geo thread's answer the way on_tick() does.
+    def geo(self, ip):
+        del self.module.output[:]
+        self.module.OnModCommand("geo {}".format(ip))
+        deadline = time.monotonic() + 5
+        while self.module.geo_pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+            self.module.geo_results()
+        self.assertEqual(self.module.geo_pending, {})
+        return self.module.output[-1]
+
+    def test_answer_is_cached(self):
+        self.assertIn("\x02Testville, North, Testland\x02", self.geo("192.0.2.1"))
+        self.assertIn("\x02Testville, North, Testland\x02", self.geo("192.0.2.1"))
+        self.assertEqual(self.server.requests, ["192.0.2.1"])
+        self.assertEqual((self.module.geo_hits, self.module.geo_misses), (1, 1))
+
+        # A new LRU still finds the answer in the geo_cache table.
+        self.module.flush_writes()
+        self.module.geo_cache.clear()
+        self.assertIn("\x02Testville, North, Testland\x02", self.geo("192.0.2.1"))
+        self.assertEqual(self.server.requests, ["192.0.2.1"])
+
+    def test_failed_answer_expires_after_negative_ttl(self):
+        self.module.OnModCommand("config GEO_NEGATIVE_TTL 60")
+        now = time.time()
+        self.assertIn("(Reason: private range)", self.geo("10.0.0.1"))
+        self.assertIn("(Reason: private range)", self.geo("10.0.0.1"))
+        self.assertEqual(self.server.requests, ["10.0.0.1"])
+        self.module.flush_writes()
+        self.assertEqual(self.module.cur.execute("SELECT failed FROM geo_cache WHERE ip = '10.0.0.1';").fetchone(), (1,))
+
+        with unittest.mock.patch.object(aka.time, "time", return_value=now + 30):
+            self.assertIn("(Reason: private range)", self.geo("10.0.0.1"))
+        self.assertEqual(self.server.requests, ["10.0.0.1"])
+        with unittest.mock.patch.object(aka.time, "time", return_value=now + 62):
+            self.assertIn("(Reason: private range)", self.geo("10.0.0.1"))
+        self.assertEqual(self.server.requests, ["10.0.0.1", "10.0.0.1"])
+
+    def test_http_error_is_not_cached(self):
+        self.assertIn("(Reason: HTTP Error 500", self.geo("192.0.2.50"))
+        self.assertIn("(Reason: HTTP Error 500", self.geo("192.0.2.50"))
+        self.assertEqual(self.server.requests, ["192.0.2.50", "192.0.2.50"])
+        self.assertNotIn("192.0.2.50", self.module.geo_cache)
+
+    def test_timeout_is_not_cached(self):
+        with unittest.mock.patch.object(aka, "GEO_TIMEOUT", 0.2):
+            self.assertIn("(Reason: timed out)", self.geo("192.0.2.99"))
+        self.assertNotIn("192.0.2.99", self.module.geo_cache)
+        self.module.flush_writes()
+        self.assertEqual(self.module.cur.execute("SELECT COUNT(*) FROM geo_cache;").fetchone(), (0,))
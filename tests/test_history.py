@@ -0,0 +1,21 @@
+from support import ModuleTestCase, znc
+
+
+class HistoryTest(ModuleTestCase):
+
+    def complete(self, module, command):
+        return [line for line in self.output(module, command) if "\x02complete\x02" in line][0]
+
+    # More hosts than fit in one 500 value chunk of the expansion query.
+    def test_host_wildcard_expands_every_host(self):
+        module = self.load()
+        self.join(module, 700)
+        self.assertIn("(700 identities, 1 level(s)", self.complete(module, "history *.example --type=host"))
+
+    def test_deep_follows_shared_values(self):
+        module = self.load()
+        self.join(module, 3)
+        # user0 reconnects from user1's host with another ident, which ties the two together.
+        module.OnJoinMessage(znc.Message(nick=znc.Nick("user0", "other", "user1.example"), chan=znc.Chan("#chan"), params=("#chan", "*", "gecos")))
+        self.assertIn("(2 identities", self.complete(module, "history user0 --type=nick"))
+        self.assertIn("(3 identities", self.complete(module, "history user0 --deep"))
@@ -0,0 +1,28 @@
+import threading
+
+from support import ModuleTestCase, NETWORK, aka, znc
+
+
+class PresenceTest(ModuleTestCase):
+
+    def test_seen_answers_the_latest_join(self):
+        module = self.load()
+        nick = znc.Nick("bob", "bident", "bob.example")
+        module.OnJoinMessage(znc.Message(nick=nick, chan=znc.Chan("#a"), params=("#a", "*", "real name")))
+        module.OnChanTextMessage(znc.Message(nick=nick, chan=znc.Chan("#a"), text="hello"))
+        module.OnJoinMessage(znc.Message(nick=nick, chan=znc.Chan("#b"), params=("#b", "*", "real name")))
+        lines = self.output(module, "seen bob")
+        self.assertIn("last seen in \x02#b\x02", lines[0])
+        self.assertIn("doing \x02join\x02", lines[0])
+        self.assertIn("last seen in \x02#a\x02", self.output(module, "seen bob #a")[0])
+
+    # The kicked nick is not in the presence index and its join is still waiting for the writer thread.
+    def test_kick_waits_for_the_writer_thread(self):
+        module = self.load("WRITER_THREAD=TRUE")
+        module.write_lock.acquire()
+        threading.Timer(0.2, module.write_lock.release).start()
+        module.ingest(aka.AkaEvent("join", NETWORK, "victim", "vident", "victim.example", "#chan", "join", None, "*", None))
+        module.OnKickMessage(znc.Message(nick=znc.Nick("op", "opident", "op.example"), chan=znc.Chan("#chan"), kicked="victim", reason="bye"))
+        module.OnModCommand("config WRITER_THREAD FALSE")
+        row = module.cur.execute("SELECT ident, host, kicks FROM users WHERE nick = 'victim' AND event = 'kicked';").fetchone()
+        self.assertEqual(row, ("vident", "victim.example", 1))
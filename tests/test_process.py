@@ -0,0 +1,30 @@
+from support import ModuleTestCase, aka, znc
+
+
+class ProcessTest(ModuleTestCase):
+
+    def network(self, module, users):
+        chan = znc.Chan("#chan")
+        for number in range(users):
+            nick = znc.Nick("user{}".format(number), "ident", "host{}.example".format(number))
+            chan.nicks[nick.GetNick()] = nick
+        module.GetNetwork().chans.append(chan)
+
+    def test_completion_waits_for_the_writer_thread(self):
+        module = self.load("WRITER_THREAD=TRUE", "PROCESS_CHUNK=100000")
+        self.network(module, 300)
+        # Holding the lock keeps the writer thread from writing anything.
+        with module.write_lock:
+            module.OnModCommand("process #chan")
+            for tick in range(3):
+                module.run_import()
+            self.assertIsNotNone(module.import_job)
+            self.assertFalse(any("processed" in line for line in module.output))
+        for tick in range(100):
+            if not module.import_job:
+                break
+            aka.time.sleep(0.05)
+            module.run_import()
+        self.assertIsNone(module.import_job)
+        self.assertTrue(any("processed: 300 rows" in line for line in module.output))
+        self.assertEqual(module.cur.execute("SELECT COUNT(*) FROM user_records;").fetchone()[0], 300)
@@ -0,0 +1,22 @@
+from support import ModuleTestCase
+
+
+class PurgeTest(ModuleTestCase):
+
+    def purge(self, module, ticks=100):
+        for tick in range(ticks):
+            if not module.purge_run:
+                return tick
+            module.run_purge()
+        self.fail("purge still running after {} ticks".format(ticks))
+
+    def test_purge_returns_free_pages(self):
+        module = self.load("ENABLE_PURGE=TRUE", "PURGE_BATCH=500", "VACUUM_PAGES=100")
+        self.ingest(module, 3000, age=10 * 86400)
+        self.ingest(module, 10, prefix="recent")
+        self.assertEqual(module.cur.execute("PRAGMA auto_vacuum;").fetchone()[0], 2)
+        module.OnModCommand("purge 5")
+        self.purge(module)
+        self.assertEqual(module.cur.execute("PRAGMA freelist_count;").fetchone()[0], 0)
+        self.assertEqual(module.cur.execute("SELECT COUNT(*) FROM user_records;").fetchone()[0], 10)
+        self.assertGreater(module.purge_last[2], 0)
@@ -0,0 +1,21 @@
+from support import ModuleTestCase
+
+
+class RetentionTest(ModuleTestCase):
+
+    def policies(self, module):
+        return module.cur.execute("SELECT channel, days FROM retention;").fetchall()
+
+    def test_rejects_days_that_are_not_positive(self):
+        module = self.load()
+        for days in ("0", "-5", "1.5", "x", "+3"):
+            self.assertIn("Usage:", self.output(module, "retention {}".format(days))[0])
+        self.assertEqual(self.policies(module), [])
+
+    def test_sets_and_removes_policies(self):
+        module = self.load()
+        module.OnModCommand("retention 30")
+        module.OnModCommand("retention 7 #chan")
+        self.assertEqual(sorted(self.policies(module)), [("", 30), ("#chan", 7)])
+        module.OnModCommand("retention off #chan")
+        self.assertEqual(self.policies(module), [("", 30)])
@@ -0,0 +1,22 @@
+from support import ModuleTestCase
+
+
+class SearchTest(ModuleTestCase):
+
+    def build(self, module, ticks=100):
+        for tick in range(ticks):
+            if not module.search_run:
+                return tick
+            module.run_search()
+        self.fail("search index still building after {} ticks".format(ticks))
+
+    def test_index_is_built_in_batches(self):
+        module = self.load("SEARCH_BATCH=100")
+        self.ingest(module, 250)
+        module.OnModCommand("config SEARCH_INDEX TRUE")
+        self.assertEqual(self.build(module), 3)
+        self.assertEqual(module.cur.execute("SELECT COUNT(*) FROM user_search;").fetchone()[0], 250)
+        self.ingest(module, 1, prefix="later")
+        self.assertEqual(module.cur.execute("SELECT COUNT(*) FROM user_search;").fetchone()[0], 251)
+        module.OnModCommand("config SEARCH_INDEX FALSE")
+        self.assertFalse(module.search_exists())
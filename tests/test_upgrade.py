@@ -0,0 +1,50 @@
+import os
+import sqlite3
+
+from support import ModuleTestCase, NETWORK, aka
+
+
+# A database as the 2.x/3.0 releases left it: flat users and moderated tables and user_version 0.
+def legacy_database(path, rows):
+    conn = sqlite3.connect(os.path.join(path, "aka.db"))
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, network TEXT, nick TEXT, ident TEXT, host TEXT, channel TEXT, event TEXT, message TEXT, firstseen INTEGER, lastseen INTEGER, texts INTEGER, joins INTEGER, kicks INTEGER, parts INTEGER, quits INTEGER, account TEXT, gecos TEXT, UNIQUE (network, nick, ident, host, channel));")
+    conn.execute("CREATE TABLE moderated (network TEXT, op_nick TEXT, op_ident TEXT, op_host TEXT, channel TEXT, action TEXT, message TEXT, offender_nick TEXT, offender_ident TEXT, offender_host TEXT, added TEXT, time);")
+    conn.executemany("INSERT INTO users (network, nick, ident, host, channel, event, message, firstseen, lastseen, texts, joins, kicks, parts, quits, account, gecos) \
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, 1, 0, 0, 0, ?, ?);", rows)
+    conn.commit()
+    conn.close()
+
+
+class UpgradeTest(ModuleTestCase):
+
+    def record(self, module, nick):
+        return module.cur.execute("SELECT event, message, firstseen, lastseen, texts, joins, account, gecos FROM users WHERE nick = ?;", (nick,)).fetchall()
+
+    def test_merged_duplicates_keep_the_newest_event(self):
+        legacy_database(self.path, [
+            (NETWORK, "bob", None, None, "#chan", "part", "bye", 100, 1000, None, "Bob Old"),
+            (NETWORK, "bob", None, None, "#chan", "quit", "bye2", 500, 2000, "bob", None),
+        ])
+        module = self.load()
+        self.assertEqual(module.cur.execute("PRAGMA user_version;").fetchone()[0], aka.SCHEMA_VERSION)
+        self.assertEqual(self.record(module, "bob"), [("quit", "bye2", 100, 2000, 2, 2, "bob", "Bob Old")])
+
+    def test_merged_duplicates_keep_the_newest_event_in_any_order(self):
+        legacy_database(self.path, [
+            (NETWORK, "bob", None, None, "#chan", "quit", "bye2", 500, 2000, None, "Bob New"),
+            (NETWORK, "bob", None, None, "#chan", "part", "bye", 100, 1000, "bob", "Bob Old"),
+        ])
+        module = self.load()
+        self.assertEqual(self.record(module, "bob"), [("quit", "bye2", 100, 2000, 2, 2, "bob", "Bob New")])
+        self.assertIn('"bye2"', self.output(module, "seen bob")[0])
+
+    def test_stats_shows_the_migrated_size(self):
+        legacy_database(self.path, [(NETWORK, "bob", "bob", "bob.example", "#chan", "join", None, 100, 1000, None, None)])
+        module = self.load()
+        sizes = [line for line in self.output(module, "stats") if "Normalized Storage" in line]
+        self.assertEqual(len(sizes), 1)
+        self.assertRegex(sizes[0], r" [1-9][0-9]* KB before, [1-9][0-9]* KB after")
+
+    def test_new_database_has_no_migrated_size(self):
+        module = self.load()
+        self.assertFalse(any("Normalized Storage" in line for line in self.output(module, "stats")))
@@ -0,0 +1,66 @@
+from support import ModuleTestCase, NETWORK, aka
+
+# network_ids already has id 1 once anything was written, so this fails with an IntegrityError.
+BAD_WRITE = ("INSERT INTO network_ids (id, value) VALUES (1, 'duplicate');", ())
+
+
+class WriterTest(ModuleTestCase):
+
+    def events(self, count, prefix="user"):
+        return [aka.AkaEvent("join", NETWORK, "{}{}".format(prefix, number), "ident", "host.example", "#chan", "join", None, "*", None) for number in range(count)]
+
+    def records(self, module):
+        return module.cur.execute("SELECT COUNT(*) FROM user_records;").fetchone()[0]
+
+    def test_unbuffered_by_default(self):
+        module = self.load()
+        self.join(module, 3)
+        self.assertEqual(self.records(module), 3)
+        self.assertEqual(module.writer.rows, 0)
+
+    def test_max_batch_counts_rows(self):
+        module = self.load("BUFFER_WRITES=TRUE", "FLUSH_MAX_BATCH=100")
+        module.flush_writes()
+        module.ingest(*self.events(150))
+        # Written as multi-row statements, the buffer is flushed as soon as they add up to 100 rows.
+        self.assertGreaterEqual(self.records(module), aka.EVENT_ROWS["join"])
+        self.assertLess(module.writer.rows, 100)
+        self.assertEqual(self.records(module) + module.writer.rows, 150)
+
+    def test_bad_write_only_drops_itself(self):
+        module = self.load("BUFFER_WRITES=TRUE", "FLUSH_MAX_BATCH=100000")
+        self.join(module, 1)
+        module.flush_writes()
+        self.join(module, 50, prefix="before")
+        module.write(*BAD_WRITE)
+        self.join(module, 50, prefix="after")
+        self.assertEqual(module.flush_writes(), 100)
+        self.assertEqual(self.records(module), 101)
+        self.assertEqual(module.writer.failed, 1)
+
+    def test_bad_write_on_the_writer_thread(self):
+        module = self.load("WRITER_THREAD=TRUE", "FLUSH_MAX_BATCH=100000")
+        thread = module.writer_thread
+        self.join(module, 1)
+        with module.write_lock:
+            self.join(module, 50, prefix="before")
+            module.write(*BAD_WRITE)
+            self.join(module, 50, prefix="after")
+        module.OnModCommand("config WRITER_THREAD FALSE")
+        self.assertEqual(thread.errors, 1)
+        self.assertEqual(thread.applied, thread.queued - 1)
+        self.assertEqual(self.records(module), 101)
+
+    def test_writer_thread_waits_for_direct_writes(self):
+        module = self.load("WRITER_THREAD=TRUE", "ENABLE_PURGE=TRUE")
+        thread = module.writer_thread
+        with module.write_lock:
+            self.join(module, 10)
+            aka.time.sleep(0.2)
+            self.assertEqual(thread.applied, 0)
+        module.OnModCommand("retention 30")
+        module.OnModCommand("rawquery --write UPDATE retention SET days = 31")
+        self.assertEqual(module.cur.execute("SELECT days FROM retention;").fetchall(), [(31,)])
+        module.OnModCommand("config WRITER_THREAD FALSE")
+        self.assertEqual(thread.applied, thread.queued)
+        self.assertEqual(self.records(module), 10)